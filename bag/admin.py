@@ -1,3 +1,16 @@
 from django.contrib import admin
+from .models import Cart, CartLine
 
-# Register your models here.
+
+class CartLineAdminInline(admin.TabularInline):
+    model = CartLine
+    raw_id_fields = ('product',)
+
+
+class CartAdmin(admin.ModelAdmin):
+    inlines = (CartLineAdminInline,)
+    list_display = ('user', 'updated')
+    raw_id_fields = ('user',)
+
+
+admin.site.register(Cart, CartAdmin)
@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class BagConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'bag'
+
+    def ready(self):
+        # merge the anonymous bag into the saved cart when a user logs in
+        import bag.signals
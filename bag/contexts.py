@@ -1,33 +1,78 @@
+import json
 from decimal import Decimal
 from django.conf import settings
-from django.shortcuts import get_object_or_404
+from django.http import Http404
+from performance.timing import timed
 from products.models import Product
+from .storage import get_bag, is_product_id
 
-def bag_contents(request):
+
+def get_bag_products(request, bag):
     """
-    This is what's known as a context processor.
-    its purpose is to make this dictionary available to all 
-    templates across the entire application.You can use 
-    request.user in any template due to the presence of the
-    built-in request context processor.
-    This context concept is the same as the context we've been using in our views
-    the only difference is we're returning it directly and making it available to
-    all templates by putting it in settings.py.
+    Return a dictionary of item_id -> Product for every item in the bag.
+    Rather than calling get_object_or_404 once per bag line we fetch all
+    the products with a single in_bulk query.The results are memoized on
+    the request, so the context processor, the checkout view and the
+    webhook handler can share them without hitting the database again.
+    Any item id that no longer exists in the database maps to None and
+    it's up to the caller to decide how to handle it.
+    """
+    memo = getattr(request, '_bag_products', None)
+    if memo is None:
+        memo = {}
+        request._bag_products = memo
+
+    missing = [str(item_id) for item_id in bag if str(item_id) not in memo]
+    if missing:
+        # anything that isn't a number can't be a product id, so don't ask the database for it
+        products = Product.objects.select_related('category').in_bulk(
+            [item_id for item_id in missing if is_product_id(item_id)])
+        for item_id in missing:
+            memo[item_id] = products.get(int(item_id)) if is_product_id(item_id) else None
+
+    return {str(item_id): memo[str(item_id)] for item_id in bag}
+
+
+def get_bag_contents(request):
+    """
+    Work out the bag items, totals and delivery costs for the stored bag.
+    The result is memoized on the request against the current bag contents,
+    so the context processor and any views that need the totals (like checkout)
+    only pay for it once per request, and a bag changed later in the same
+    request is recalculated rather than served stale.
+    """
+    bag = get_bag(request)
+    bag_key = json.dumps(bag, sort_keys=True)
+    memo = getattr(request, '_bag_contents', None)
+    if memo is not None and memo[0] == bag_key:
+        return memo[1]
+
+    with timed('bag'):
+        context = _calculate_bag_contents(request, bag)
+    request._bag_contents = (bag_key, context)
+    return context
+
+
+def _calculate_bag_contents(request, bag):
+    """
+    Build the bag dictionary from scratch for the given bag.
     """
     bag_items = [] # empty list for bag items to live
     total = 0
     product_count = 0
-    # In order to add all the bags current items to the context of all templates.
-    # Accessing the shopping bag in the session, retrieve bag if it exixts else initialize it to an empty dictionary
-    bag = request.session.get('bag', {})
     """
     We need to iterate through all the items in the shopping bag.
     tally up the total cost and product count.
     And add the products and their data to the bag items list.
     display them on the shopping bag page and throughout the site.
     """
-    # bag from session
+    # fetch every product in the bag at once instead of one query per line
+    products = get_bag_products(request, bag)
+    # bag from the bag storage
     for item_id, item_data in bag.items():
+        product = products[str(item_id)]
+        if product is None:
+            raise Http404(f'No product matches the id {item_id}.')
         """
         only want to execute this code if the item has no sizes.
         Which will be evident by checking whether or not the item
@@ -38,7 +83,6 @@ def bag_contents(request):
         these items, we'll add the size to the bag items returned to the template as well.
         """
         if isinstance(item_data, int):
-            product = get_object_or_404(Product, pk=item_id)
             total += item_data * product.price
             product_count += item_data
             """
@@ -60,7 +104,6 @@ def bag_contents(request):
             returned to the template as well.This is how we'll be able to
             render the sizes in the template.
             """
-            product = get_object_or_404(Product, pk=item_id)
             for size, quantity in item_data['items_by_size'].items():
                 total += quantity * product.price
                 product_count += quantity
@@ -85,7 +128,6 @@ def bag_contents(request):
         free_delivery_delta = 0
 
     grand_total = delivery + total
-    # all these items in the context would be available in all templates across the site.
     context = {
         'bag_items': bag_items,
         'total': total,
@@ -96,4 +138,38 @@ def bag_contents(request):
         'grand_total': grand_total,
     }
 
-    return context
\ No newline at end of file
+    return context
+
+
+def bag_contents(request):
+    """
+    This is what's known as a context processor.
+    its purpose is to make this dictionary available to all 
+    templates across the entire application.You can use 
+    request.user in any template due to the presence of the
+    built-in request context processor.
+    This context concept is the same as the context we've been using in our views
+    the only difference is we're returning it directly and making it available to
+    all templates by putting it in settings.py.
+    Each value is a callable rather than the value itself.The template engine
+    calls callables when it looks them up, so the bag is only worked out
+    (and the products only fetched) if a template actually reads one of these
+    variables.Once it has been worked out it is memoized for the rest of the request.
+    """
+    def lazy_value(key):
+        return lambda: get_bag_contents(request)[key]
+
+    # all these items in the context would be available in all templates across the site.
+    context = {
+        key: lazy_value(key) for key in (
+            'bag_items',
+            'total',
+            'product_count',
+            'delivery',
+            'free_delivery_delta',
+            'grand_total',
+        )
+    }
+    context['free_delivery_threshold'] = settings.FREE_DELIVERY_THRESHOLD
+
+    return context
@@ -0,0 +1,78 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import Client, override_settings
+from django.test.utils import CaptureQueriesContext, setup_test_environment, teardown_test_environment
+
+from products.models import Product
+
+BACKENDS = (
+    'bag.storage.SessionBagStorage',
+    'bag.storage.SignedCookieBagStorage',
+    'bag.storage.CacheBagStorage',
+)
+
+# every cache the bag views can touch, swapped for empty in-memory ones for the run
+BENCHMARK_CACHES = {
+    alias: {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': f'benchmark-bag-storage-{alias}'}
+    for alias in ('default', 'bags', 'shared')
+}
+
+
+class Command(BaseCommand):
+    help = (
+        'Run add, adjust and remove bag operations against each bag storage '
+        'backend and report session table writes and time per operation.'
+        'It runs against a test database and in-memory caches, like the tests do, '
+        'so the sessions and bags it makes never reach the real ones'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rounds', type=int, default=20,
+                            help='How many add/adjust/remove rounds to run per backend')
+        parser.add_argument('--products', type=int, default=5,
+                            help='How many different products to put in the bag')
+
+    def _run(self, backend, products, rounds):
+        """ Return (operations, session writes, total seconds) for one backend """
+        client = Client()
+        operations = 0
+        with override_settings(BAG_STORAGE=backend), CaptureQueriesContext(connection) as queries:
+            start = time.perf_counter()
+            for _ in range(rounds):
+                for product in products:
+                    client.post(f'/bag/add/{product.id}/', {'quantity': 1, 'redirect_url': '/bag/'})
+                    client.post(f'/bag/adjust/{product.id}/', {'quantity': 3})
+                    operations += 2
+                for product in products:
+                    client.post(f'/bag/remove/{product.id}/')
+                    operations += 1
+            elapsed = time.perf_counter() - start
+        writes = sum(
+            1 for q in queries.captured_queries
+            if 'django_session' in q['sql'] and not q['sql'].startswith('SELECT')
+        )
+        return operations, writes, elapsed
+
+    def handle(self, *args, **options):
+        # lets the test client talk to the site and keeps emails out of the way
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        caches = override_settings(CACHES=BENCHMARK_CACHES)
+        caches.enable()
+        try:
+            products = [
+                Product.objects.create(name=f'Benchmark product {i}', description='', price=10)
+                for i in range(options['products'])
+            ]
+            self.stdout.write(f'{"backend":<40}{"ops":>6}{"session writes/op":>19}{"ms/op":>9}')
+            for backend in BACKENDS:
+                operations, writes, elapsed = self._run(backend, products, options['rounds'])
+                self.stdout.write(
+                    f'{backend:<40}{operations:>6}{writes / operations:>19.2f}'
+                    f'{elapsed * 1000 / operations:>9.2f}')
+        finally:
+            caches.disable()
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
@@ -0,0 +1,17 @@
+from .storage import get_bag_storage
+
+
+class BagStorageMiddleware:
+    """
+    Let the bag storage add its cookie to the response.
+    Only requests that actually used the bag have a storage attached,
+    so every other request passes straight through.
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        if getattr(request, '_bag_storage', None) is not None:
+            get_bag_storage(request).update_response(response)
+        return response
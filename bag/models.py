@@ -1,3 +1,37 @@
+from django.conf import settings
 from django.db import models
 
-# Create your models here.
+from products.models import Product
+
+"""
+A shopping bag kept in the database for logged in users, so the same bag
+follows them from one device to another.Anonymous shoppers still keep
+their bag in the browser (see bag/storage.py) and it's merged into the
+cart when they log in.
+Each cart line is one product in one size, so a product without sizes
+has a single line with an empty size.
+"""
+class Cart(models.Model):
+    # one cart per user, the one-to-one gives a unique index to look it up by user
+    user = models.OneToOneField(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='cart')
+    updated = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f'Cart for {self.user}'
+
+
+class CartLine(models.Model):
+    cart = models.ForeignKey(Cart, on_delete=models.CASCADE, related_name='lines')
+    # if a product is deleted it simply disappears from everyone's cart
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='+')
+    size = models.CharField(max_length=2, blank=True, default='')
+    quantity = models.PositiveIntegerField()
+
+    class Meta:
+        constraints = [
+            # the upserts in bag/storage.py rely on this to find the line to update
+            models.UniqueConstraint(fields=['cart', 'product', 'size'], name='cartline_unique_product_size'),
+        ]
+
+    def __str__(self):
+        return f'{self.quantity} x {self.product_id} {self.size}'.strip()
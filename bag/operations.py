@@ -0,0 +1,96 @@
+import copy
+
+"""
+Changing the bag without a page reload.
+The bag api applies a list of add, adjust and remove operations like
+    {"op": "add", "item_id": "12", "quantity": 2, "size": "m"}
+to the bag in one go.They're checked and applied to a copy of the bag,
+so if any of them is invalid none of them are saved.
+"""
+
+MAX_QUANTITY = 99  # the same limit as the quantity inputs on the site
+# the sizes on the product page, anything else could never be stored in a cart line
+SIZES = ('xs', 's', 'm', 'l', 'xl')
+
+
+class BagOperationError(ValueError):
+    """ An operation in the list couldn't be applied to the bag """
+
+
+def _get_quantity(operation, minimum):
+    quantity = operation.get('quantity')
+    if isinstance(quantity, bool) or not isinstance(quantity, int) \
+            or not minimum <= quantity <= MAX_QUANTITY:
+        raise BagOperationError(
+            f'quantity must be a whole number from {minimum} to {MAX_QUANTITY}')
+    return quantity
+
+
+def _set_quantity(bag, item_id, size, quantity):
+    """ Set the quantity of a product (and size) in the bag, removing it at zero """
+    if size:
+        if isinstance(bag.get(item_id), int):
+            raise BagOperationError(f'Product {item_id} is in the bag without a size')
+        sizes = bag.setdefault(item_id, {'items_by_size': {}})['items_by_size']
+        if quantity:
+            sizes[size] = quantity
+        else:
+            sizes.pop(size, None)
+            if not sizes:
+                bag.pop(item_id)
+    else:
+        if isinstance(bag.get(item_id), dict):
+            raise BagOperationError(f'Product {item_id} is in the bag by size, give a size')
+        if quantity:
+            bag[item_id] = quantity
+        else:
+            bag.pop(item_id, None)
+
+
+def _get_current_quantity(bag, item_id, size):
+    item_data = bag.get(item_id)
+    if item_data is None:
+        return 0
+    if size:
+        if isinstance(item_data, int):
+            raise BagOperationError(f'Product {item_id} is in the bag without a size')
+        return item_data['items_by_size'].get(size, 0)
+    if isinstance(item_data, dict):
+        raise BagOperationError(f'Product {item_id} is in the bag by size, give a size')
+    return item_data
+
+
+def apply_bag_operations(bag, operations, products):
+    """
+    Return a new bag with the operations applied, leaving the original alone.
+    products is a dictionary of item_id -> Product (or None for a missing
+    product) covering every item id in the operations.
+    """
+    if not isinstance(operations, list) or not operations:
+        raise BagOperationError('operations must be a non-empty list')
+
+    bag = copy.deepcopy(bag)
+    for operation in operations:
+        if not isinstance(operation, dict):
+            raise BagOperationError('each operation must be an object')
+        op = operation.get('op')
+        item_id = str(operation.get('item_id'))
+        size = operation.get('size') or None
+        if products.get(item_id) is None:
+            raise BagOperationError(f'Product {item_id} was not found')
+        if size is not None and size not in SIZES:
+            raise BagOperationError(f'size must be one of {", ".join(SIZES)}')
+
+        current = _get_current_quantity(bag, item_id, size)
+        if op == 'add':
+            quantity = current + _get_quantity(operation, 1)
+            if quantity > MAX_QUANTITY:
+                raise BagOperationError(f'You can have at most {MAX_QUANTITY} of each product')
+            _set_quantity(bag, item_id, size, quantity)
+        elif op == 'adjust':
+            _set_quantity(bag, item_id, size, _get_quantity(operation, 0))
+        elif op == 'remove':
+            _set_quantity(bag, item_id, size, 0)
+        else:
+            raise BagOperationError('op must be one of add, adjust or remove')
+    return bag
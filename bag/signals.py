@@ -0,0 +1,18 @@
+from django.contrib.auth.signals import user_logged_in
+from django.dispatch import receiver
+
+from .storage import get_bag_storage
+
+
+@receiver(user_logged_in)
+def merge_bag_on_login(sender, request, user, **kwargs):
+    """
+    allauth logs users in through django's login, so this runs for every
+    login.If the bag is kept in the cart tables, anything the shopper put
+    in their bag before logging in is added to their saved cart.
+    """
+    if request is None:
+        return
+    storage = get_bag_storage(request)
+    if hasattr(storage, 'merge_anonymous_bag'):
+        storage.merge_anonymous_bag(user)
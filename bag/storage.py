@@ -0,0 +1,373 @@
+import json
+import uuid
+
+from django.conf import settings
+from django.core import signing
+from django.core.cache import caches
+from django.db import connection, models, transaction
+from django.utils.module_loading import import_string
+
+from products.models import Product
+from .models import Cart, CartLine
+from .operations import MAX_QUANTITY, SIZES
+
+"""
+Where the shopping bag lives between requests.
+Storing the bag in the session meant every bag click (and every flash
+message) rewrote the session row in the database, so the bag now has its
+own storage with swappable backends, picked with the BAG_STORAGE setting:
+    SignedCookieBagStorage - the bag itself, signed and compressed, in a cookie
+    CacheBagStorage - the bag in a cache, found with a random id kept in a cookie
+    SessionBagStorage - the bag in the session, as it always used to be
+    CartBagStorage - the bag in the Cart and CartLine tables for logged in
+        users, and in the BAG_ANONYMOUS_STORAGE backend for everyone else
+Views use get_bag, save_bag and clear_bag rather than touching the storage
+directly, and BagStorageMiddleware writes any cookie the storage needs
+onto the response.
+"""
+
+BAG_FORMAT_VERSION = 1
+
+
+def serialize_bag(bag):
+    """
+    Turn the bag into a compact string.The keys are sorted so the same bag
+    always serializes the same way, and the format is versioned so a
+    future change to the bag structure can tell old bags apart.
+    """
+    return json.dumps({'v': BAG_FORMAT_VERSION, 'items': bag},
+                      sort_keys=True, separators=(',', ':'))
+
+
+def deserialize_bag(data):
+    """
+    Turn a serialized bag back into a dictionary.Anything that isn't a bag
+    in the current format (an old or damaged value) gives an empty bag.
+    """
+    try:
+        payload = json.loads(data)
+    except (TypeError, ValueError):
+        return {}
+    if not isinstance(payload, dict) or payload.get('v') != BAG_FORMAT_VERSION:
+        return {}
+    items = payload.get('items')
+    return items if isinstance(items, dict) else {}
+
+
+class SessionBagStorage:
+    """ Keep the bag in the session """
+    def __init__(self, request):
+        self.request = request
+
+    def load(self):
+        return self.request.session.get('bag', {})
+
+    def save(self, bag):
+        self.request.session['bag'] = bag
+
+    def clear(self):
+        if 'bag' in self.request.session:
+            del self.request.session['bag']
+
+    def update_response(self, response):
+        pass
+
+
+class SignedCookieBagStorage:
+    """
+    Keep the whole bag in a signed cookie, so there's nothing to store on
+    the server at all.The cookie is signed so it can't be edited in the
+    browser (the prices are always looked up again anyway) and compressed
+    to stay well inside the browser's cookie size limit.
+    """
+    cookie_name = 'bag'
+    salt = 'bag.storage.SignedCookieBagStorage'
+
+    def __init__(self, request):
+        self.request = request
+        self.bag = None
+        self.changed = False
+
+    def load(self):
+        if self.bag is None:
+            value = self.request.COOKIES.get(self.cookie_name)
+            self.bag = {}
+            if value:
+                try:
+                    self.bag = deserialize_bag(signing.loads(
+                        value, salt=self.salt, max_age=settings.BAG_COOKIE_AGE))
+                except signing.BadSignature:
+                    pass
+        return self.bag
+
+    def save(self, bag):
+        self.bag = bag
+        self.changed = True
+
+    def clear(self):
+        self.save({})
+
+    def update_response(self, response):
+        if not self.changed:
+            return
+        if self.bag:
+            response.set_cookie(
+                self.cookie_name,
+                signing.dumps(serialize_bag(self.bag), salt=self.salt, compress=True),
+                max_age=settings.BAG_COOKIE_AGE,
+                secure=settings.SESSION_COOKIE_SECURE,
+                httponly=True,
+                samesite='Lax',
+            )
+        else:
+            response.delete_cookie(self.cookie_name, samesite='Lax')
+
+
+class CacheBagStorage:
+    """
+    Keep the bag in the cache named by the BAG_CACHE_ALIAS setting, found
+    with a random id in a cookie.The cache can be the local memory cache
+    for a single process, the file cache to share bags between the workers
+    on one server, or memcached/redis in production.
+    """
+    cookie_name = 'bag_id'
+
+    def __init__(self, request):
+        self.request = request
+        self.cache = caches[settings.BAG_CACHE_ALIAS]
+        self.bag_id = request.COOKIES.get(self.cookie_name)
+        self.bag = None
+        self.new_id = False
+
+    def _key(self):
+        return f'bag:{self.bag_id}'
+
+    def load(self):
+        if self.bag is None:
+            self.bag = {}
+            if self.bag_id:
+                self.bag = deserialize_bag(self.cache.get(self._key()))
+        return self.bag
+
+    def save(self, bag):
+        self.bag = bag
+        if not self.bag_id:
+            self.bag_id = uuid.uuid4().hex
+            self.new_id = True
+        self.cache.set(self._key(), serialize_bag(bag), settings.BAG_COOKIE_AGE)
+
+    def clear(self):
+        self.bag = {}
+        if self.bag_id:
+            self.cache.delete(self._key())
+
+    def update_response(self, response):
+        if self.new_id:
+            response.set_cookie(
+                self.cookie_name, self.bag_id,
+                max_age=settings.BAG_COOKIE_AGE,
+                secure=settings.SESSION_COOKIE_SECURE,
+                httponly=True,
+                samesite='Lax',
+            )
+
+
+def is_product_id(item_id):
+    """
+    Whether a bag key could be a product id. str.isdigit() isn't enough
+    as it's also true for things like '²' that int() won't accept.
+    """
+    return item_id.isascii() and item_id.isdecimal()
+
+
+def bag_to_lines(bag):
+    """
+    Flatten a bag into a dictionary of (product id, size) -> quantity,
+    using an empty size for products without sizes.
+    Anything that can't be a cart line (a size that isn't one of ours) is left out.
+    """
+    lines = {}
+    for item_id, item_data in bag.items():
+        if not is_product_id(str(item_id)):
+            continue
+        if isinstance(item_data, int):
+            lines[(int(item_id), '')] = item_data
+        else:
+            for size, quantity in item_data['items_by_size'].items():
+                if size in SIZES:
+                    lines[(int(item_id), size)] = quantity
+    return lines
+
+
+def lines_to_bag(lines):
+    """ The reverse of bag_to_lines, giving the bag structure the views work with """
+    bag = {}
+    for (product_id, size), quantity in lines.items():
+        if size:
+            bag.setdefault(str(product_id), {'items_by_size': {}})['items_by_size'][size] = quantity
+        else:
+            bag[str(product_id)] = quantity
+    return bag
+
+
+class CartBagStorage:
+    """
+    Keep a logged in user's bag in the database so it follows them between
+    devices, and hand anonymous bags to the BAG_ANONYMOUS_STORAGE backend.
+    Loading the cart is one query joining the lines to their products (and
+    categories), and the products are put straight into the memo used by
+    bag.contexts.get_bag_products, so the bag totals and checkout don't
+    have to fetch them again.
+    Saving only writes the lines that changed: one upsert for the new and
+    changed lines and one delete for the removed ones.
+    """
+    def __init__(self, request):
+        self.request = request
+        self.anonymous = import_string(settings.BAG_ANONYMOUS_STORAGE)(request)
+        self.bag = None
+        self.lines = {}
+
+    def _user(self):
+        user = getattr(self.request, 'user', None)
+        return user if user is not None and user.is_authenticated else None
+
+    def load(self):
+        user = self._user()
+        if user is None:
+            return self.anonymous.load()
+        if self.bag is None:
+            cart_lines = CartLine.objects.filter(cart__user=user).select_related('product__category')
+            products = getattr(self.request, '_bag_products', None)
+            if products is None:
+                products = {}
+                self.request._bag_products = products
+            self.lines = {}
+            for line in cart_lines:
+                self.lines[(line.product_id, line.size)] = line.quantity
+                products[str(line.product_id)] = line.product
+            self.bag = lines_to_bag(self.lines)
+        return self.bag
+
+    def save(self, bag):
+        user = self._user()
+        if user is None:
+            self.anonymous.save(bag)
+            return
+        # the views change the loaded bag in place, so compare against the lines as loaded
+        self.load()
+        lines = bag_to_lines(bag)
+        changed = {key: quantity for key, quantity in lines.items() if self.lines.get(key) != quantity}
+        removed = [key for key in self.lines if key not in lines]
+        with transaction.atomic():
+            cart = _get_cart(user)
+            _upsert_cart_lines(cart, changed)
+            _delete_cart_lines(cart, removed)
+        self.bag = bag
+        self.lines = lines
+
+    def clear(self):
+        user = self._user()
+        if user is None:
+            self.anonymous.clear()
+            return
+        CartLine.objects.filter(cart__user=user).delete()
+        self.bag = {}
+        self.lines = {}
+
+    def merge_anonymous_bag(self, user):
+        """
+        Add everything in the anonymous bag to the user's cart in a single
+        transaction, then empty the anonymous bag.Quantities of anything
+        already in the cart are added together (up to the usual limit), and
+        anything that is no longer in the catalogue is dropped.
+        """
+        anonymous_lines = bag_to_lines(self.anonymous.load())
+        if not anonymous_lines:
+            return
+        product_ids = set(Product.objects.filter(
+            id__in={product_id for product_id, size in anonymous_lines}).values_list('id', flat=True))
+        with transaction.atomic():
+            # lock the cart so two logins at once can't both add the same bag
+            cart = _get_cart(user, lock=True)
+            existing = {
+                (line.product_id, line.size): line.quantity
+                for line in CartLine.objects.filter(cart=cart)
+            }
+            merged = {
+                key: min(existing.get(key, 0) + quantity, MAX_QUANTITY)
+                for key, quantity in anonymous_lines.items() if key[0] in product_ids
+            }
+            _upsert_cart_lines(cart, merged)
+        self.anonymous.clear()
+        # load the merged cart next time it's needed
+        self.bag = None
+
+    def update_response(self, response):
+        self.anonymous.update_response(response)
+
+
+def _get_cart(user, lock=False):
+    cart, created = Cart.objects.get_or_create(user=user)
+    if lock and not created:
+        cart = Cart.objects.select_for_update().get(pk=cart.pk)
+    return cart
+
+
+def _upsert_cart_lines(cart, lines):
+    """
+    Insert or update the cart lines in one statement, using the unique
+    (cart, product, size) constraint to find the lines that already exist.
+    INSERT ... ON CONFLICT works on both SQLite and PostgreSQL.
+    """
+    if not lines:
+        return
+    table = connection.ops.quote_name(CartLine._meta.db_table)
+    values = ', '.join(['(%s, %s, %s, %s)'] * len(lines))
+    params = []
+    for (product_id, size), quantity in lines.items():
+        params += [cart.pk, product_id, size, quantity]
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'INSERT INTO {table} (cart_id, product_id, size, quantity) VALUES {values} '
+            'ON CONFLICT (cart_id, product_id, size) DO UPDATE SET quantity = excluded.quantity',
+            params)
+    # keep the cart's updated time current, the raw insert doesn't touch it
+    cart.save(update_fields=['updated'])
+
+
+def _delete_cart_lines(cart, keys):
+    """ Delete the given (product id, size) lines with a single query """
+    if not keys:
+        return
+    sizes = {}
+    for product_id, size in keys:
+        sizes.setdefault(size, []).append(product_id)
+    query = None
+    for size, product_ids in sizes.items():
+        condition = models.Q(size=size, product_id__in=product_ids)
+        query = condition if query is None else query | condition
+    CartLine.objects.filter(query, cart=cart).delete()
+
+
+def get_bag_storage(request):
+    """ Return the bag storage for this request, creating it the first time """
+    storage = getattr(request, '_bag_storage', None)
+    if storage is None:
+        storage = import_string(settings.BAG_STORAGE)(request)
+        request._bag_storage = storage
+    return storage
+
+
+def get_bag(request):
+    """ Return the shopping bag for this request, or an empty bag """
+    return get_bag_storage(request).load()
+
+
+def save_bag(request, bag):
+    """ Store the updated shopping bag """
+    get_bag_storage(request).save(bag)
+
+
+def clear_bag(request):
+    """ Empty the shopping bag, e.g. once an order has been placed """
+    get_bag_storage(request).clear()
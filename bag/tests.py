@@ -1,3 +1,239 @@
-from django.test import TestCase
+import json
 
-# Create your tests here.
+from allauth.account.models import EmailAddress
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import Client, TestCase, RequestFactory, override_settings
+from django.test.utils import CaptureQueriesContext
+
+from products.models import Category, Product
+from .contexts import bag_contents, get_bag_contents, get_bag_products
+from .models import Cart, CartLine
+from .storage import bag_to_lines, serialize_bag, deserialize_bag
+
+
+@override_settings(BAG_STORAGE='bag.storage.SessionBagStorage')
+class BagContentsQueryTests(TestCase):
+    """
+    The bag context processor runs on every page, so the number of
+    queries it issues must not grow with the number of items in the bag.
+    """
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(name='activewear', friendly_name='Activewear')
+        cls.products = [
+            Product.objects.create(category=category, name=f'Product {i}',
+                                   description='A product', price=10)
+            for i in range(30)
+        ]
+
+    def _request_with_bag(self, bag):
+        request = RequestFactory().get('/')
+        request.session = {'bag': bag}
+        return request
+
+    def test_query_count_is_constant_in_bag_size(self):
+        for size in (1, 30):
+            bag = {str(p.id): 1 for p in self.products[:size]}
+            request = self._request_with_bag(bag)
+            with self.assertNumQueries(1):
+                context = get_bag_contents(request)
+            self.assertEqual(len(context['bag_items']), size)
+
+    def test_products_are_memoized_per_request(self):
+        bag = {str(self.products[0].id): {'items_by_size': {'s': 1, 'm': 2}}}
+        request = self._request_with_bag(bag)
+        get_bag_contents(request)
+        with self.assertNumQueries(0):
+            context = get_bag_contents(request)
+        self.assertEqual(context['product_count'], 3)
+        self.assertEqual(context['total'], 30)
+
+    def test_context_processor_is_lazy(self):
+        bag = {str(self.products[0].id): 2}
+        request = self._request_with_bag(bag)
+        with self.assertNumQueries(0):
+            context = bag_contents(request)
+        with self.assertNumQueries(1):
+            self.assertEqual(context['grand_total'](), context['total']() + context['delivery']())
+            self.assertEqual(context['product_count'](), 2)
+
+    def test_tampered_item_ids_map_to_none(self):
+        bag = {str(self.products[0].id): 1, 'abc': 1, '1 OR 1=1': 1, '\u00b2': 1}
+        request = self._request_with_bag(bag)
+        with self.assertNumQueries(1):
+            products = get_bag_products(request, bag)
+        self.assertEqual(products[str(self.products[0].id)], self.products[0])
+        self.assertIsNone(products['abc'])
+        self.assertIsNone(products['1 OR 1=1'])
+        self.assertIsNone(products['\u00b2'])
+
+
+
+class BagStorageTests(TestCase):
+    """
+    Every bag backend should keep the bag between requests, and only
+    the session backend should write to the session table.
+    """
+    backends = (
+        'bag.storage.SignedCookieBagStorage',
+        'bag.storage.CacheBagStorage',
+        'bag.storage.SessionBagStorage',
+    )
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.product = Product.objects.create(name='Jacket', description='A jacket', price=10)
+
+    def _session_writes(self, queries):
+        return [
+            q for q in queries.captured_queries
+            if 'django_session' in q['sql'] and not q['sql'].startswith('SELECT')
+        ]
+
+    def test_bag_is_kept_between_requests(self):
+        for backend in self.backends:
+            with self.subTest(backend=backend), override_settings(BAG_STORAGE=backend):
+                self.client.cookies.clear()
+                with CaptureQueriesContext(connection) as queries:
+                    self.client.post(f'/bag/add/{self.product.id}/',
+                                     {'quantity': 2, 'redirect_url': '/bag/'})
+                    response = self.client.get('/bag/')
+                self.assertContains(response, 'Grand Total : $22.00')
+                if backend == 'bag.storage.SessionBagStorage':
+                    self.assertTrue(self._session_writes(queries))
+                else:
+                    self.assertEqual(self._session_writes(queries), [])
+
+    def test_tampered_cookie_gives_an_empty_bag(self):
+        self.client.cookies['bag'] = 'not-a-signed-bag'
+        response = self.client.get('/bag/')
+        self.assertEqual(response.context['bag_items'](), [])
+
+    def test_serialization_is_stable_and_versioned(self):
+        bag = {'2': {'items_by_size': {'m': 1, 's': 2}}, '1': 3}
+        self.assertEqual(
+            serialize_bag(bag),
+            '{"items":{"1":3,"2":{"items_by_size":{"m":1,"s":2}}},"v":1}')
+        self.assertEqual(deserialize_bag(serialize_bag(bag)), bag)
+        self.assertEqual(deserialize_bag('{"v":0,"items":{"1":3}}'), {})
+
+
+class BagApiTests(TestCase):
+    """
+    The bag api applies a batch of operations and returns the new totals.
+    """
+    @classmethod
+    def setUpTestData(cls):
+        cls.shirt = Product.objects.create(name='Shirt', description='A shirt', price=10, has_sizes=True)
+        cls.hat = Product.objects.create(name='Hat', description='A hat', price=20)
+
+    def _post(self, operations):
+        return self.client.post('/bag/api/', json.dumps({'operations': operations}),
+                                content_type='application/json')
+
+    def test_batched_operations_return_totals_and_badge(self):
+        response = self._post([
+            {'op': 'add', 'item_id': self.shirt.id, 'quantity': 2, 'size': 'm'},
+            {'op': 'add', 'item_id': self.hat.id, 'quantity': 1},
+            {'op': 'adjust', 'item_id': self.shirt.id, 'quantity': 1, 'size': 'm'},
+        ])
+        data = response.json()
+        self.assertEqual(data['subtotal'], '30.00')
+        self.assertEqual(data['delivery'], '3.00')
+        self.assertEqual(data['free_delivery_delta'], '20.00')
+        self.assertEqual(data['grand_total'], '33.00')
+        self.assertEqual(data['product_count'], 2)
+        self.assertIn('$33.00', data['badge_html'])
+
+        data = self._post([{'op': 'remove', 'item_id': self.hat.id}]).json()
+        self.assertEqual(data['bag'], {str(self.shirt.id): {'items_by_size': {'m': 1}}})
+
+    def test_invalid_operation_saves_nothing(self):
+        self._post([{'op': 'add', 'item_id': self.hat.id, 'quantity': 1}])
+        response = self._post([
+            {'op': 'add', 'item_id': self.hat.id, 'quantity': 1},
+            {'op': 'add', 'item_id': 999999, 'quantity': 1},
+        ])
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get('/bag/')
+        self.assertEqual(response.context['product_count'](), 1)
+
+    def test_non_ascii_digits_are_not_product_ids(self):
+        # '\u00b2' (superscript two) passes str.isdigit() but not int()
+        response = self._post([{'op': 'add', 'item_id': '\u00b2', 'quantity': 1}])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(bag_to_lines({'\u00b2': 1, str(self.hat.id): 2}), {(self.hat.id, ''): 2})
+
+
+class CartBagStorageTests(TestCase):
+    """
+    Logged in users keep their bag in the cart tables, and whatever they
+    put in their bag before logging in is merged into it when they do.
+    """
+    @classmethod
+    def setUpTestData(cls):
+        cls.shirt = Product.objects.create(name='Shirt', description='A shirt', price=10, has_sizes=True)
+        cls.hat = Product.objects.create(name='Hat', description='A hat', price=20)
+        cls.user = User.objects.create_user('shopper', 'shopper@example.com', 'password')
+        EmailAddress.objects.create(user=cls.user, email='shopper@example.com', primary=True, verified=True)
+
+    def _add(self, client, product, quantity, size=None):
+        data = {'quantity': quantity, 'redirect_url': '/bag/'}
+        if size:
+            data['product_size'] = size
+        client.post(f'/bag/add/{product.id}/', data)
+
+    def test_cart_follows_the_user_between_devices(self):
+        laptop = Client()
+        laptop.force_login(self.user)
+        self._add(laptop, self.shirt, 2, 'm')
+        self._add(laptop, self.hat, 1)
+        laptop.post(f'/bag/adjust/{self.shirt.id}/', {'quantity': 3, 'product_size': 'm'})
+        self.assertEqual(CartLine.objects.filter(cart__user=self.user).count(), 2)
+
+        phone = Client()
+        phone.force_login(self.user)
+        response = phone.get('/bag/')
+        self.assertEqual(response.context['product_count'](), 4)
+
+        phone.post(f'/bag/remove/{self.hat.id}/')
+        self.assertEqual(
+            list(CartLine.objects.values_list('product_id', 'size', 'quantity')),
+            [(self.shirt.id, 'm', 3)])
+
+    def test_unknown_sizes_are_never_stored(self):
+        self.client.force_login(self.user)
+        self._add(self.client, self.shirt, 1, 'extra large')
+        response = self.client.post('/bag/api/', json.dumps({'operations': [
+            {'op': 'add', 'item_id': self.shirt.id, 'quantity': 1, 'size': 'xxxl'},
+        ]}), content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(CartLine.objects.exists())
+        self.assertEqual(bag_to_lines({str(self.shirt.id): {'items_by_size': {'m': 1, 'huge': 2}}}),
+                         {(self.shirt.id, 'm'): 1})
+
+    def test_bag_is_read_with_one_joined_query(self):
+        cart = Cart.objects.create(user=self.user)
+        CartLine.objects.create(cart=cart, product=self.shirt, size='s', quantity=1)
+        CartLine.objects.create(cart=cart, product=self.hat, quantity=2)
+        request = RequestFactory().get('/')
+        request.user = self.user
+        with self.assertNumQueries(1):
+            context = get_bag_contents(request)
+        self.assertEqual(context['total'], 50)
+
+    def test_anonymous_bag_is_merged_on_login(self):
+        cart = Cart.objects.create(user=self.user)
+        CartLine.objects.create(cart=cart, product=self.hat, quantity=1)
+        self._add(self.client, self.hat, 2)
+        self._add(self.client, self.shirt, 1, 'l')
+
+        self.client.post('/accounts/login/', {'login': 'shopper', 'password': 'password'})
+        self.assertEqual(
+            sorted(CartLine.objects.values_list('product_id', 'size', 'quantity')),
+            sorted([(self.hat.id, '', 3), (self.shirt.id, 'l', 1)]))
+        # the anonymous bag is emptied so it isn't merged again
+        self.assertEqual(self.client.cookies['bag'].value, '')
+        response = self.client.get('/bag/')
+        self.assertEqual(response.context['product_count'](), 4)
@@ -1,14 +1,22 @@
+import json
+
 from django.shortcuts import render, redirect, reverse, HttpResponse, get_object_or_404
 from django.contrib import messages
+from django.http import JsonResponse
+from django.template.loader import render_to_string
+from django.views.decorators.http import require_POST
 
 from products.models import Product
+from .contexts import get_bag_contents, get_bag_products
+from .operations import SIZES, BagOperationError, apply_bag_operations
+from .storage import get_bag, save_bag
 
 
 def view_bag(request):
     """ A view that renders the bag contents page """
     return render(request, 'bag/bag.html')
 
-# This view we'll get the bag variable if it exists in the session or create it if it doesn't.
+# This view we'll get the bag variable if it exists in the bag storage or create it if it doesn't.
 # Then add the item to the bag or update the quantity if it already exists.
 def add_to_bag(request, item_id):
     """ Add a quantity of the specified product to the shopping bag """
@@ -21,17 +29,22 @@ def add_to_bag(request, item_id):
     # If the size is in the post request, set it to S, M, L, XL, etc
     if 'product_size' in request.POST:
         size = request.POST['product_size']
+        # only the sizes on the product page, anything else can't be stored in the cart
+        if size not in SIZES:
+            messages.error(request, f"Sorry, {product.name} doesn't come in that size")
+            return redirect(redirect_url)
     """
     This is handy in a situation like an e-commerce store
     Because it allows us to store the contents of the shopping bag
-    in the HTTP session while the user browses the site and adds items to be purchased.
-    By storing the shopping bag in the session.
-    It will persist until the user closes their browser so that they can add something to the bag.
+    (in the database for logged in users, or a signed cookie, a cache or the session, see storage.py)
+    while the user browses the site and adds items to be purchased.
+    By storing the shopping bag this way.
+    It will persist between visits so that they can add something to the bag.
     Then browse to a different part of the site add something else
     and so on without losing the contents of their bag
     """
-    # we first check to see if there's a bag variable in the session and if not we'll create one.
-    bag = request.session.get('bag', {})
+    # we first check to see if there's a bag already and if not we'll create one.
+    bag = get_bag(request)
     
     # If size is not None
     if size:
@@ -80,9 +93,9 @@ def add_to_bag(request, item_id):
             # using some string formatting to let the user know they've added this product to their bag.
             messages.success(request, f'Added { product.name } to your bag')
 
-    # putting this the bag variable into the session.
-    # To overwrite the variable in the session with the updated version.
-    request.session['bag'] = bag
+    # putting this the bag variable into the bag storage (see storage.py).
+    # To overwrite the stored bag with the updated version.
+    save_bag(request, bag)
     return redirect(redirect_url)
 
 
@@ -93,7 +106,10 @@ def adjust_bag(request, item_id):
     size = None
     if 'product_size' in request.POST:
         size = request.POST['product_size']
-    bag = request.session.get('bag', {})
+        if size not in SIZES:
+            messages.error(request, f"Sorry, {product.name} doesn't come in that size")
+            return redirect(reverse('view_bag'))
+    bag = get_bag(request)
 
     if size:
         """
@@ -125,7 +141,7 @@ def adjust_bag(request, item_id):
             bag.pop(item_id)
             messages.success(request, f'Removed {product.name} from your bag')
 
-    request.session['bag'] = bag
+    save_bag(request, bag)
     return redirect(reverse('view_bag'))
 
 def remove_from_bag(request, item_id):
@@ -140,7 +156,7 @@ def remove_from_bag(request, item_id):
         size = None
         if 'product_size' in request.POST:
             size = request.POST['product_size']
-        bag = request.session.get('bag', {})
+        bag = get_bag(request)
 
         if size:
             """
@@ -161,10 +177,49 @@ def remove_from_bag(request, item_id):
             bag.pop(item_id)
             messages.success(request, f'Removed {product.name} from your bag')
 
-        request.session['bag'] = bag
+        save_bag(request, bag)
         return HttpResponse(status=200)
 
     except Exception as e:
         # if any error occurs in the removal process,the user will get a notification about it
         messages.error(request, f'Error removing item: {e}')
         return HttpResponse(status=500)
+
+
+@require_POST
+def bag_api(request):
+    """
+    Apply a list of add, adjust and remove operations to the bag in one request
+    and return the new totals along with the html for the bag badge in the header,
+    so the page can be updated without a redirect and a full reload.
+    The request body is JSON like {"operations": [{"op": "add", "item_id": "1", "quantity": 1}]}
+    Nothing is saved if any of the operations is invalid.
+    """
+    try:
+        operations = json.loads(request.body)['operations']
+    except (ValueError, KeyError, TypeError):
+        return JsonResponse({'error': 'Expected a JSON object with a list of operations'}, status=400)
+
+    bag = get_bag(request)
+    item_ids = [
+        str(operation.get('item_id')) for operation in operations
+        if isinstance(operation, dict)
+    ] if isinstance(operations, list) else []
+    try:
+        # one query for all the products, shared with the totals worked out below
+        bag = apply_bag_operations(bag, operations, get_bag_products(request, item_ids))
+    except BagOperationError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+
+    save_bag(request, bag)
+    contents = get_bag_contents(request)
+    return JsonResponse({
+        'bag': bag,
+        'product_count': contents['product_count'],
+        'subtotal': f"{contents['total']:.2f}",
+        'delivery': f"{contents['delivery']:.2f}",
+        'free_delivery_delta': f"{contents['free_delivery_delta']:.2f}",
+        'grand_total': f"{contents['grand_total']:.2f}",
+        'badge_html': render_to_string(
+            'includes/bag_badge.html', {'grand_total': contents['grand_total']}, request),
+    })
@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/3.2/ref/settings/
 """
 import os
+import tempfile
 import dj_database_url
 from pathlib import Path
 
@@ -50,6 +51,7 @@ INSTALLED_APPS = [
     'bag',
     'checkout',
     'profiles',
+    'performance',
 
     # Other
 
@@ -58,12 +60,17 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # first, so its total covers all the other middleware too, see performance/middleware.py
+    'performance.middleware.InstrumentationMiddleware',
+    'performance.middleware.QueryLogMiddleware',  # reports N+1 queries, see performance/querylog.py
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'performance.middleware.ProfilingMiddleware',  # opt-in request profiling, see performance/profiler.py
     'django.contrib.messages.middleware.MessageMiddleware',
+    'bag.middleware.BagStorageMiddleware',  # writes the bag cookie, see bag/storage.py
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
 
@@ -99,8 +106,9 @@ TEMPLATES = [
     },
 ]
 
-# To store messages in session
-MESSAGE_STORAGE = 'django.contrib.messages.storage.session.SessionStorage'
+# To store messages in a cookie, falling back to the session only for messages too big for
+# the cookie, so that showing a message doesn't mean writing the session to the database
+MESSAGE_STORAGE = 'django.contrib.messages.storage.fallback.FallbackStorage'
 
 AUTHENTICATION_BACKENDS = [
     # Needed to login by username in Django admin, regardless of `allauth`
@@ -186,6 +194,12 @@ STATIC_ROOT = os.path.join(BASE_DIR, 'staticfiles')
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
+# the smaller copies of product images made for srcset, see products/images.py.
+# The widths cover the listing cards up to a 2x screen and the detail page image
+PRODUCT_IMAGE_WIDTHS = [300, 600, 1000]
+# best first, any format Pillow can't write is skipped and jpeg is always made as the fallback
+PRODUCT_IMAGE_FORMATS = ['avif', 'webp', 'jpeg']
+
 
 # connect django to s3 
 if 'USE_AWS' in os.environ:
@@ -215,6 +229,59 @@ if 'USE_AWS' in os.environ:
     MEDIA_URL = f'https://{AWS_S3_CUSTOM_DOMAIN}/{MEDIAFILES_LOCATION}/'
     
 
+# product listing pagination
+# how many products to show per page and the most a user can ask for with ?per_page=
+PRODUCTS_PER_PAGE = 24
+PRODUCTS_MAX_PAGE_SIZE = 96
+# how long (in seconds) to remember the number of products matching a listing
+PRODUCTS_COUNT_CACHE_TIMEOUT = 60
+# how long (in seconds) to cache a page of the product listing. Changing a product
+# invalidates the listings straight away in every worker, through the listing
+# version kept in the shared cache (see products/caching.py)
+PRODUCTS_LISTING_CACHE_TIMEOUT = 300
+PRODUCTS_LISTING_VERSION_CACHE_ALIAS = 'shared'
+
+# how many orders to show per page in the profile's order history
+ORDERS_PER_PAGE = 10
+
+# The local memory cache keeps the most recently used entries, once it holds
+# MAX_ENTRIES it drops the least recently used 1/CULL_FREQUENCY of them.
+# The bags cache is only used by the CacheBagStorage bag backend. It's a file cache
+# so all the workers on a server share the bags, swap it for memcached or redis
+# if there's more than one server.
+# The shared cache is for the few small values every worker has to agree on, like
+# the product listing version, and is a file cache for the same reason.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'boutique-ado',
+        'OPTIONS': {
+            'MAX_ENTRIES': 1000,
+            'CULL_FREQUENCY': 10,
+        },
+    },
+    'bags': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(tempfile.gettempdir(), 'boutique_ado_bags'),
+        'OPTIONS': {
+            'MAX_ENTRIES': 100000,
+        },
+    },
+    'shared': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(tempfile.gettempdir(), 'boutique_ado_shared'),
+    },
+}
+
+# Where the shopping bag is kept between requests, one of the backends in bag/storage.py:
+# CartBagStorage (the database for logged in users, BAG_ANONYMOUS_STORAGE for everyone else),
+# SignedCookieBagStorage, CacheBagStorage (using the BAG_CACHE_ALIAS cache) or SessionBagStorage
+BAG_STORAGE = os.environ.get('BAG_STORAGE', 'bag.storage.CartBagStorage')
+BAG_ANONYMOUS_STORAGE = os.environ.get('BAG_ANONYMOUS_STORAGE', 'bag.storage.SignedCookieBagStorage')
+BAG_CACHE_ALIAS = 'bags'
+# how long (in seconds) a bag is kept, two weeks like the session
+BAG_COOKIE_AGE = 60 * 60 * 24 * 14
+
 # stripe
 # used to calculate delivery costs
 FREE_DELIVERY_THRESHOLD = 50
@@ -229,6 +296,20 @@ safe to keep secret key out of version control
 STRIPE_PUBLIC_KEY = os.getenv('STRIPE_PUBLIC_KEY', '')
 STRIPE_SECRET_KEY = os.getenv('STRIPE_SECRET_KEY', '')
 STRIPE_WH_SECRET = os.getenv('STRIPE_WH_SECRET', '')
+# use the in-memory stand-in for stripe in checkout/fake_stripe.py, to run the checkout offline
+STRIPE_FAKE = 'STRIPE_FAKE' in os.environ
+# how the checkout talks to stripe, see checkout/stripe_gateway.py.
+# STRIPE_API_BASE can point at the stub server (manage.py stripe_stub_server) to benchmark offline
+STRIPE_API_BASE = os.getenv('STRIPE_API_BASE', 'https://api.stripe.com')
+STRIPE_POOL_SIZE = 10  # kept alive connections to stripe per process
+STRIPE_CONNECT_TIMEOUT = 3  # seconds
+STRIPE_READ_TIMEOUT = 10  # seconds
+STRIPE_MAX_NETWORK_RETRIES = 2
+STRIPE_RETRY_DELAY = 0.5  # seconds before the first retry, doubled for each one after
+STRIPE_MAX_RETRY_DELAY = 2
+# how long to remember processed webhook events for, see the prune_stripe_events command.
+# Stripe retries a failed event for up to three days
+STRIPE_EVENT_RETENTION_DAYS = 30
 
 # To determine which email setup to use.
 if 'DEVELOPMENT' in os.environ:
@@ -244,6 +325,50 @@ else:
     EMAIL_HOST_PASSWORD = os.environ.get('EMAIL_HOST_PASS')
     DEFAULT_FROM_EMAIL = os.environ.get('EMAIL_HOST_USER')
 
+# The email outbox (checkout/outbox.py), sent by the send_outbox_emails command.
+# How many emails to send over one connection to the mail server
+EMAIL_OUTBOX_BATCH_SIZE = 50
+# give up on an email after this many failed attempts
+EMAIL_OUTBOX_MAX_ATTEMPTS = 8
+# seconds to wait after the first failure, doubled after each one after that
+EMAIL_OUTBOX_RETRY_DELAY = 30
+# seconds a worker has to send the batch it claimed before another worker may take it
+EMAIL_OUTBOX_CLAIM_TIMEOUT = 300
+
+# Per request timings and metrics, see the performance app.
+# Light enough to leave on in production, set PERFORMANCE_INSTRUMENTATION=off to turn it off
+PERFORMANCE_INSTRUMENTATION = os.environ.get('PERFORMANCE_INSTRUMENTATION', 'on') != 'off'
+# each worker process writes its metrics here so the metrics endpoint can add them all up
+PERFORMANCE_METRICS_DIR = os.environ.get(
+    'PERFORMANCE_METRICS_DIR', os.path.join(tempfile.gettempdir(), 'boutique_ado_metrics'))
+PERFORMANCE_METRICS_FLUSH_INTERVAL = 5  # seconds
+# a bearer token for the prometheus scraper, superusers can always see /metrics/
+PERFORMANCE_METRICS_TOKEN = os.environ.get('PERFORMANCE_METRICS_TOKEN', '')
+
+# Request profiling: superusers can profile a request with an X-Profile header or ?profile=1,
+# and PERFORMANCE_PROFILE_SAMPLE_RATE (0 to 1) profiles that share of all requests at random.
+PERFORMANCE_PROFILE_SAMPLE_RATE = float(os.environ.get('PERFORMANCE_PROFILE_SAMPLE_RATE', 0))
+PERFORMANCE_PROFILE_INTERVAL = 0.001  # seconds between samples
+PERFORMANCE_PROFILE_DIR = os.environ.get(
+    'PERFORMANCE_PROFILE_DIR', os.path.join(tempfile.gettempdir(), 'boutique_ado_profiles'))
+
+# The slow query log, see performance/querylog.py
+PERFORMANCE_QUERY_LOG = os.environ.get('PERFORMANCE_QUERY_LOG', 'on') != 'off'
+PERFORMANCE_SLOW_QUERY_MS = float(os.environ.get('PERFORMANCE_SLOW_QUERY_MS', 100))
+# how many times the same query shape can run in one request before it's reported as an N+1
+PERFORMANCE_REPEATED_QUERY_THRESHOLD = 5
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler'},
+    },
+    'loggers': {
+        'performance.queries': {'handlers': ['console'], 'level': 'WARNING', 'propagate': False},
+    },
+}
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/3.2/ref/settings/#default-auto-field
 
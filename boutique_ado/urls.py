@@ -26,4 +26,5 @@ urlpatterns = [
     path('bag/', include('bag.urls')),
     path('checkout/', include('checkout.urls')),
     path('profile/', include('profiles.urls')),
+    path('metrics/', include('performance.urls')),
 ] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
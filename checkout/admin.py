@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import Order, OrderLineItem
+from .models import Order, OrderLineItem, OutboxEmail, ProcessedStripeEvent
 
 # Register your models here.
 class OrderLineItemAdminInline(admin.TabularInline):
@@ -41,4 +41,22 @@ class OrderAdmin(admin.ModelAdmin):
     ordering = ('-date',)
 
 # going to skip registering the OrderLineItem model. Since it's accessible via the inline on the order model.
-admin.site.register(Order, OrderAdmin)
\ No newline at end of file
+admin.site.register(Order, OrderAdmin)
+
+
+class OutboxEmailAdmin(admin.ModelAdmin):
+    # to see what's waiting to be sent and why anything failed
+    list_display = ('to_email', 'kind', 'status', 'attempts', 'next_attempt_at', 'sent_at')
+    list_filter = ('status', 'kind')
+    readonly_fields = ('order', 'created', 'sent_at', 'last_error')
+    ordering = ('-created',)
+
+admin.site.register(OutboxEmail, OutboxEmailAdmin)
+
+
+class ProcessedStripeEventAdmin(admin.ModelAdmin):
+    list_display = ('event_id', 'event_type', 'processed_at')
+    search_fields = ('event_id',)
+    ordering = ('-processed_at',)
+
+admin.site.register(ProcessedStripeEvent, ProcessedStripeEventAdmin)
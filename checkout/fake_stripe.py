@@ -0,0 +1,73 @@
+import uuid
+
+import stripe
+
+"""
+An in-memory stand-in for the parts of the stripe library the checkout uses,
+so the checkout pages can be run and tested without a network connection
+or Stripe keys.Turn it on with the STRIPE_FAKE setting.
+It returns real stripe objects (built with construct_from) and raises the
+real stripe errors, and records every call in calls so tests can check
+how often Stripe would have been contacted.
+"""
+
+error = stripe.error
+api_key = None
+
+payment_intents = {}
+calls = []
+
+
+def reset():
+    """ Forget every payment intent and call, e.g. between tests """
+    payment_intents.clear()
+    calls.clear()
+
+
+def _not_found(pid):
+    return error.InvalidRequestError(f"No such payment_intent: '{pid}'", 'intent', code='resource_missing')
+
+
+class PaymentIntent:
+    @staticmethod
+    def _object(data):
+        return stripe.PaymentIntent.construct_from(data, 'sk_fake')
+
+    @classmethod
+    def create(cls, amount, currency, **params):
+        calls.append(('create', None))
+        pid = f'pi_fake_{uuid.uuid4().hex[:24]}'
+        payment_intents[pid] = {
+            'id': pid,
+            'object': 'payment_intent',
+            'amount': amount,
+            'currency': currency,
+            'client_secret': f'{pid}_secret_{uuid.uuid4().hex[:24]}',
+            'metadata': params.get('metadata', {}),
+            'status': 'requires_payment_method',
+        }
+        return cls._object(payment_intents[pid])
+
+    @classmethod
+    def retrieve(cls, pid, **params):
+        calls.append(('retrieve', pid))
+        if pid not in payment_intents:
+            raise _not_found(pid)
+        return cls._object(payment_intents[pid])
+
+    @classmethod
+    def modify(cls, pid, **params):
+        calls.append(('modify', pid))
+        intent = payment_intents.get(pid)
+        if intent is None:
+            raise _not_found(pid)
+        # like stripe, a paid or cancelled intent can't be changed any more
+        if intent['status'] in ('succeeded', 'canceled'):
+            raise error.InvalidRequestError(
+                f'This PaymentIntent could not be updated because it has a status of {intent["status"]}.',
+                'intent', code='payment_intent_unexpected_state')
+        metadata = params.pop('metadata', None)
+        if metadata:
+            intent['metadata'] = {**intent['metadata'], **{key: str(value) for key, value in metadata.items()}}
+        intent.update(params)
+        return cls._object(intent)
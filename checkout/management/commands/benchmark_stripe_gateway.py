@@ -0,0 +1,79 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+import stripe
+from django.core.management.base import BaseCommand
+from django.test import override_settings
+from stripe.http_client import RequestsClient
+
+from checkout import stripe_gateway
+from checkout.stripe_gateway import PooledStripeClient, StripeGateway, gateway_metrics
+from checkout.stripe_stub import StripeStubServer
+
+
+class UnpooledClient(RequestsClient):
+    """ A new connection for every call, like a client without keep-alive """
+    def _request_internal(self, method, url, headers, post_data, is_streaming):
+        self._thread_local.session = requests.Session()
+        try:
+            return super()._request_internal(method, url, headers, post_data, is_streaming)
+        finally:
+            self._thread_local.session.close()
+
+
+class Command(BaseCommand):
+    help = (
+        'Benchmark create/modify PaymentIntent calls through the stripe gateway '
+        'against the local stub server, with and without connection pooling'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--calls', type=int, default=500, help='How many create + modify pairs to make')
+        parser.add_argument('--threads', type=int, default=8, help='How many threads make calls at once')
+        parser.add_argument('--latency', type=float, default=0.0,
+                            help='Seconds the stub waits before every response')
+
+    def _run(self, client, calls, threads):
+        """ Return (seconds, connections opened, metrics) for one client """
+        stripe_gateway._client = client
+        stripe.default_http_client = client
+        gateway_metrics.reset()
+        self.server.connections = 0
+        gateway = StripeGateway(stripe, 'sk_test_stub')
+
+        def checkout(i):
+            intent = gateway.create_payment_intent(amount=1000 + i, currency='usd')
+            gateway.modify_payment_intent(intent.id, amount=2000 + i)
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            list(pool.map(checkout, range(calls)))
+        return time.perf_counter() - start, self.server.connections, gateway_metrics.snapshot()
+
+    def handle(self, *args, **options):
+        self.server = StripeStubServer(('127.0.0.1', 0), latency=options['latency'])
+        self.server.start()
+        clients = {
+            'pooled keep-alive': PooledStripeClient(
+                pool_size=options['threads'], connect_timeout=3, read_timeout=10,
+                max_retries=2, retry_delay=0.5, max_retry_delay=2),
+            'new connection per call': UnpooledClient(timeout=(3, 10)),
+        }
+        previous_client = stripe_gateway._client
+        try:
+            with override_settings(STRIPE_API_BASE=self.server.url, STRIPE_FAKE=False):
+                self.stdout.write(f'{"client":<26}{"calls/s":>9}{"connections":>13}{"p50 ms":>9}{"p95 ms":>9}')
+                # the latencies are for PaymentIntent.create, as seen by the caller
+                for name, client in clients.items():
+                    seconds, connections, metrics = self._run(client, options['calls'], options['threads'])
+                    create, modify = metrics['payment_intent.create'], metrics['payment_intent.modify']
+                    self.stdout.write(
+                        f'{name:<26}{(create["count"] + modify["count"]) / seconds:>9.0f}{connections:>13}'
+                        f'{create["p50_ms"]:>9.2f}{create["p95_ms"]:>9.2f}')
+        finally:
+            stripe_gateway._client = previous_client
+            stripe.default_http_client = previous_client
+            stripe.api_base = 'https://api.stripe.com'
+            self.server.shutdown()
+            self.server.server_close()
@@ -0,0 +1,31 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from checkout.models import ProcessedStripeEvent
+
+
+class Command(BaseCommand):
+    help = 'Delete processed Stripe webhook events older than STRIPE_EVENT_RETENTION_DAYS, in batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=None,
+                            help='Keep this many days of events (STRIPE_EVENT_RETENTION_DAYS by default)')
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='How many rows to delete per query, so no delete holds locks for long')
+
+    def handle(self, *args, **options):
+        days = options['days'] if options['days'] is not None else settings.STRIPE_EVENT_RETENTION_DAYS
+        cutoff = timezone.now() - timedelta(days=days)
+        old_events = ProcessedStripeEvent.objects.filter(processed_at__lt=cutoff)
+        deleted = 0
+        while True:
+            # the ids come from the processed_at index, then each batch is deleted by primary key
+            batch = list(old_events.order_by('processed_at').values_list('pk', flat=True)[:options['batch_size']])
+            if not batch:
+                break
+            ProcessedStripeEvent.objects.filter(pk__in=batch).delete()
+            deleted += len(batch)
+        self.stdout.write(self.style.SUCCESS(f'Deleted {deleted} processed Stripe events older than {days} days'))
@@ -0,0 +1,37 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from checkout.outbox import send_pending_emails
+
+
+class Command(BaseCommand):
+    help = (
+        'Send the emails waiting in the outbox in batches, retrying failures '
+        'with backoff. Runs once by default or keeps polling with --loop'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=None,
+                            help='How many emails to send per connection (EMAIL_OUTBOX_BATCH_SIZE by default)')
+        parser.add_argument('--loop', action='store_true',
+                            help='Keep running, checking for new emails every --interval seconds')
+        parser.add_argument('--interval', type=float, default=5,
+                            help='How long to wait between checks when the outbox is empty')
+
+    def handle(self, *args, **options):
+        total_sent = total_failed = 0
+        while True:
+            sent, failed = send_pending_emails(options['batch_size'])
+            total_sent += sent
+            total_failed += failed
+            if sent or failed:
+                self.stdout.write(f'Sent {sent} emails, {failed} failed')
+                # there may be more waiting, so go straight round again.
+                # Failed emails are rescheduled for later so they won't come straight back
+                continue
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
+        self.stdout.write(self.style.SUCCESS(
+            f'Outbox empty: sent {total_sent} emails, {total_failed} failed'))
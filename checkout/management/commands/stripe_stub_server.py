@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+
+from checkout.stripe_stub import StripeStubServer
+
+
+class Command(BaseCommand):
+    help = (
+        'Run a local stand-in for the Stripe PaymentIntent API. '
+        'Set STRIPE_API_BASE to the url it prints to use it'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=12111)
+        parser.add_argument('--latency', type=float, default=0.0,
+                            help='Seconds to wait before every response, to act like a real network')
+
+    def handle(self, *args, **options):
+        server = StripeStubServer((options['host'], options['port']), latency=options['latency'])
+        self.stdout.write(f'Stripe stub listening on {server.url}')
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
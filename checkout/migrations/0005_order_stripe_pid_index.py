@@ -0,0 +1,18 @@
+# Generated by Django 3.2 on 2026-10-18 20:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('checkout', '0004_order_user_profile'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='order',
+            name='stripe_pid',
+            field=models.CharField(db_index=True, default='', max_length=254),
+        ),
+    ]
@@ -0,0 +1,54 @@
+from django.db import migrations, models
+from django.db.models import Count
+
+"""
+Get the orders table ready for unique order numbers and payment intent ids.
+Orders without a payment intent get a null stripe_pid instead of a blank one,
+since a unique column can hold any number of nulls but only one blank.
+Then any existing duplicates are reported before the unique indexes are
+added in the next migration, as merging or deleting orders is a decision
+for a person, not a migration.
+"""
+
+
+def check_for_duplicate_orders(apps, schema_editor):
+    Order = apps.get_model('checkout', 'Order')
+    Order.objects.filter(stripe_pid='').update(stripe_pid=None)
+
+    problems = []
+    for field in ('order_number', 'stripe_pid'):
+        duplicates = (
+            Order.objects.exclude(**{f'{field}__isnull': True})
+            .values(field)
+            .annotate(orders=Count('id'))
+            .filter(orders__gt=1)
+        )
+        for duplicate in duplicates:
+            ids = list(Order.objects.filter(**{field: duplicate[field]}).values_list('id', flat=True))
+            problems.append(f'{field}={duplicate[field]!r} is shared by orders {ids}')
+
+    if problems:
+        raise RuntimeError(
+            'Duplicate orders must be resolved before order_number and stripe_pid '
+            'can be made unique:\n  ' + '\n  '.join(problems))
+
+
+def restore_blank_stripe_pids(apps, schema_editor):
+    Order = apps.get_model('checkout', 'Order')
+    Order.objects.filter(stripe_pid__isnull=True).update(stripe_pid='')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('checkout', '0005_order_stripe_pid_index'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='order',
+            name='stripe_pid',
+            field=models.CharField(db_index=True, default=None, max_length=254, null=True),
+        ),
+        migrations.RunPython(check_for_duplicate_orders, restore_blank_stripe_pids),
+    ]
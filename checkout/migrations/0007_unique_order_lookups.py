@@ -0,0 +1,21 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('checkout', '0006_order_stripe_pid_nullable'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='order',
+            name='order_number',
+            field=models.CharField(editable=False, max_length=32, unique=True),
+        ),
+        migrations.AlterField(
+            model_name='order',
+            name='stripe_pid',
+            field=models.CharField(default=None, max_length=254, null=True, unique=True),
+        ),
+    ]
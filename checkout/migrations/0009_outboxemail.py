@@ -0,0 +1,41 @@
+# Generated by Django 3.2 on 2026-10-18 20:49
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('checkout', '0008_order_profile_date_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OutboxEmail',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('order_confirmation', 'Order confirmation')], max_length=32)),
+                ('subject', models.CharField(max_length=254)),
+                ('body', models.TextField()),
+                ('from_email', models.EmailField(max_length=254)),
+                ('to_email', models.EmailField(max_length=254)),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('sent', 'Sent'), ('failed', 'Failed')], default='pending', max_length=10)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('next_attempt_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('last_error', models.TextField(blank=True, default='')),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('sent_at', models.DateTimeField(blank=True, null=True)),
+                ('order', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='emails', to='checkout.order')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='outboxemail',
+            index=models.Index(condition=models.Q(status='pending'), fields=['next_attempt_at'], name='outbox_pending_due_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='outboxemail',
+            constraint=models.UniqueConstraint(fields=('order', 'kind'), name='outbox_one_email_per_order_kind'),
+        ),
+    ]
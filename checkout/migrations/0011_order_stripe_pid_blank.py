@@ -0,0 +1,18 @@
+# Generated by Django 3.2 on 2026-10-18 21:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('checkout', '0010_processedstripeevent'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='order',
+            name='stripe_pid',
+            field=models.CharField(blank=True, default=None, max_length=254, null=True, unique=True),
+        ),
+    ]
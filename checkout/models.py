@@ -3,6 +3,7 @@ import uuid # generate order number
 from django.db import models
 from django.db.models import Sum
 from django.conf import settings
+from django.utils import timezone
 
 from django_countries.fields import CountryField  # to assist the country field turned to a drop down menu
  
@@ -20,7 +21,7 @@ the users orders by calling something like user.userprofile.orders
 """
 class Order(models.Model):
     # We're gonna automatically generate this order number and we'll want it to be unique and permanent so users can find their previous orders.
-    order_number = models.CharField(max_length=32, null=False, editable=False)
+    order_number = models.CharField(max_length=32, null=False, editable=False, unique=True)  # unique, so looking an order up by its number is a single index probe
     user_profile = models.ForeignKey(UserProfile, on_delete=models.SET_NULL,
                                      null=True, blank=True, related_name='orders')
     full_name = models.CharField(max_length=50, null=False, blank=False)
@@ -39,7 +40,16 @@ class Order(models.Model):
     grand_total = models.DecimalField(max_digits=10, decimal_places=2, null=False, default=0)
     # To assist customers to purchase the same things twice on separate occasions
     original_bag = models.TextField(null=False, blank=False, default='')  # contains the original shopping bag that created it
-    stripe_pid = models.CharField(max_length=254, null=False, blank=False, default='')  # contains the stripe payment intent id which is unique
+    # contains the stripe payment intent id which is unique, the webhook looks orders up by it.
+    # Orders added by hand in the admin have no payment intent, so it can be left blank,
+    # and it's stored as null rather than '' so any number of them can leave it out.
+    stripe_pid = models.CharField(max_length=254, null=True, blank=True, default=None, unique=True)
+
+    class Meta:
+        # the profile page lists a user's orders newest first
+        indexes = [
+            models.Index(fields=['user_profile', 'date'], name='order_profile_date_idx'),
+        ]
 
     # quick model methods it's prepended with an underscore by convention to indicate it's a private method
     def _generate_order_number(self):
@@ -65,7 +75,15 @@ class Order(models.Model):
         line would cause an error because it would try to determine if
         none is less than or equal to the delivery threshold
         """
-        self.order_total = self.lineitems.aggregate(Sum('lineitem_total'))['lineitem_total__sum'] or 0
+        self.set_totals(self.lineitems.aggregate(Sum('lineitem_total'))['lineitem_total__sum'] or 0)
+        self.save()
+
+    def set_totals(self, order_total):
+        """
+        Set the order total, delivery cost and grand total from the
+        sum of the line items without saving the order.
+        """
+        self.order_total = order_total
         if self.order_total < settings.FREE_DELIVERY_THRESHOLD:
             self.delivery_cost = self.order_total * settings.STANDARD_DELIVERY_PERCENTAGE / 100
         else:
@@ -73,7 +91,6 @@ class Order(models.Model):
             self.delivery_cost = 0
         # calculate grand total
         self.grand_total = self.order_total + self.delivery_cost
-        self.save()
 
     def save(self, *args, **kwargs):
         """
@@ -127,3 +144,66 @@ class OrderLineItem(models.Model):
     def __str__(self):
         # returning the SKU of the product along with the order number it's part of for each order line item.
         return f'SKU {self.product.sku} on order {self.order.order_number}'
+
+
+"""
+Emails waiting to be sent.
+Rather than talking to the mail server in the middle of a Stripe webhook
+(a slow SMTP server would make Stripe time out and retry the webhook),
+the webhook writes the email into this table in the same transaction as
+the order, and the send_outbox_emails command sends them in the background.
+See checkout/outbox.py.
+"""
+class OutboxEmail(models.Model):
+    PENDING = 'pending'
+    SENT = 'sent'
+    FAILED = 'failed'
+    STATUS_CHOICES = [(PENDING, 'Pending'), (SENT, 'Sent'), (FAILED, 'Failed')]
+
+    ORDER_CONFIRMATION = 'order_confirmation'
+    KIND_CHOICES = [(ORDER_CONFIRMATION, 'Order confirmation')]
+
+    order = models.ForeignKey(Order, null=True, blank=True, on_delete=models.SET_NULL, related_name='emails')
+    kind = models.CharField(max_length=32, choices=KIND_CHOICES)
+    subject = models.CharField(max_length=254)
+    body = models.TextField()
+    from_email = models.EmailField(max_length=254)
+    to_email = models.EmailField(max_length=254)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    # when the worker should next try to send it, pushed back after each failure
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True, default='')
+    created = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        constraints = [
+            # Stripe can send the same webhook more than once, but each order only gets one confirmation
+            models.UniqueConstraint(fields=['order', 'kind'], name='outbox_one_email_per_order_kind'),
+        ]
+        indexes = [
+            # the worker only ever looks for pending emails that are due, so only index those
+            models.Index(fields=['next_attempt_at'], name='outbox_pending_due_idx',
+                         condition=models.Q(status='pending')),
+        ]
+
+    def __str__(self):
+        return f'{self.get_kind_display()} to {self.to_email} ({self.status})'
+
+
+"""
+The Stripe webhook events we've already handled.
+Stripe sends the same event more than once (retries and the occasional
+duplicate), so the webhook looks the event id up here first and skips
+anything it has already processed without doing any of the work again.
+Old rows are pruned by the prune_stripe_events command.
+"""
+class ProcessedStripeEvent(models.Model):
+    event_id = models.CharField(max_length=255, unique=True)  # the unique index makes the duplicate check a single index probe
+    event_type = models.CharField(max_length=100)
+    processed_at = models.DateTimeField(default=timezone.now, db_index=True)  # indexed for the pruning
+
+    def __str__(self):
+        return f'{self.event_type} {self.event_id}'
+
@@ -0,0 +1,73 @@
+from django.db import transaction
+from django.db.models import Prefetch
+from django.shortcuts import get_object_or_404
+
+from .models import Order, OrderLineItem
+from products.models import Product
+
+"""
+Building an order from a shopping bag.
+Both the checkout view and the webhook handler turn a bag into an order
+with its line items.Saving each line item one at a time fires the post_save
+signal, which recalculates and saves the whole order again for every line,
+so instead we work the totals out once in Python and insert all of the
+line items with a single bulk_create.
+"""
+
+
+def get_bag_lineitems(order, bag, products):
+    """
+    Make (but don't save) a line item for each product and size in the bag.
+    products is a dictionary of item_id -> Product such as the one returned
+    by bag.contexts.get_bag_products, so no extra queries are needed.
+    Raises Product.DoesNotExist if a product in the bag has been deleted.
+    """
+    lineitems = []
+    for item_id, item_data in bag.items():
+        product = products.get(str(item_id))
+        if product is None:
+            raise Product.DoesNotExist(f'Product {item_id} not found')
+        # items without sizes just store the quantity
+        if isinstance(item_data, int):
+            quantities = {None: item_data}
+        else:
+            quantities = item_data['items_by_size']
+        for size, quantity in quantities.items():
+            lineitems.append(OrderLineItem(
+                order=order,
+                product=product,
+                quantity=quantity,
+                product_size=size,
+                lineitem_total=product.price * quantity,
+            ))
+    return lineitems
+
+
+def create_order_from_bag(order, bag, products):
+    """
+    Save an unsaved order along with a line item for everything in the bag.
+    The totals are set before the order is saved, so it's written just once,
+    and everything happens in one transaction so a missing product never
+    leaves a half built order behind.
+    """
+    lineitems = get_bag_lineitems(order, bag, products)
+    with transaction.atomic():
+        order.set_totals(sum(lineitem.lineitem_total for lineitem in lineitems))
+        order.save()
+        # the order has its id now, so the line items can point at it
+        for lineitem in lineitems:
+            lineitem.order = order
+        OrderLineItem.objects.bulk_create(lineitems)
+    return order
+
+
+def get_order_detail(order_number):
+    """
+    Get an order along with its line items and their products in two
+    queries, one for the order and one for all of the line items, ready
+    for the order confirmation template.Raises Http404 if there's no such order.
+    """
+    orders = Order.objects.prefetch_related(
+        Prefetch('lineitems', queryset=OrderLineItem.objects.select_related('product'))
+    )
+    return get_object_or_404(orders, order_number=order_number)
@@ -0,0 +1,110 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.db import transaction
+from django.template.loader import render_to_string
+from django.utils import timezone
+
+from .models import OutboxEmail
+
+"""
+The email outbox.
+enqueue_order_confirmation renders the confirmation email and stores it in
+the OutboxEmail table, so it commits (or rolls back) along with the order.
+send_pending_emails is run by the send_outbox_emails management command:
+it claims a batch of due emails, sends them all over one connection to
+the mail server and reschedules any that fail, waiting twice as long after
+each failure, until EMAIL_OUTBOX_MAX_ATTEMPTS is reached.
+"""
+
+
+def enqueue_order_confirmation(order):
+    """
+    Queue the confirmation email for an order, unless it has already been
+    queued (the webhook and its retries can all get here for the same order).
+    """
+    subject = render_to_string(
+        'checkout/confirmation_emails/confirmation_email_subject.txt',
+        {'order': order})
+    body = render_to_string(
+        'checkout/confirmation_emails/confirmation_email_body.txt',
+        {'order': order, 'contact_email': settings.DEFAULT_FROM_EMAIL})
+    email, created = OutboxEmail.objects.get_or_create(
+        order=order, kind=OutboxEmail.ORDER_CONFIRMATION,
+        defaults={
+            # a header can't contain a newline, and the template ends with one
+            'subject': ' '.join(subject.split()),
+            'body': body,
+            'from_email': settings.DEFAULT_FROM_EMAIL,
+            'to_email': order.email,
+        })
+    return email
+
+
+def get_retry_delay(attempts):
+    """ How long to wait after the given number of failed attempts, doubling each time """
+    return timedelta(seconds=settings.EMAIL_OUTBOX_RETRY_DELAY * 2 ** (attempts - 1))
+
+
+def _claim_batch(batch_size):
+    """
+    Take the next batch of due emails for this worker.Their next attempt is
+    pushed back by EMAIL_OUTBOX_CLAIM_TIMEOUT while we send them, so another
+    worker won't pick them up, and if this worker dies they're tried again
+    once it runs out.On PostgreSQL skip_locked lets several workers claim
+    batches at the same time, SQLite just runs one transaction at a time.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        emails = list(
+            OutboxEmail.objects.select_for_update(skip_locked=True)
+            .filter(status=OutboxEmail.PENDING, next_attempt_at__lte=now)
+            .order_by('next_attempt_at')[:batch_size]
+        )
+        if emails:
+            OutboxEmail.objects.filter(pk__in=[email.pk for email in emails]).update(
+                next_attempt_at=now + timedelta(seconds=settings.EMAIL_OUTBOX_CLAIM_TIMEOUT))
+    return emails
+
+
+def send_pending_emails(batch_size=None):
+    """
+    Send one batch of due emails and return (sent, failed).
+    The connection to the mail server is opened once for the whole batch
+    rather than once per email, which is where most of the time goes with
+    SMTP over TLS.
+    """
+    emails = _claim_batch(batch_size or settings.EMAIL_OUTBOX_BATCH_SIZE)
+    if not emails:
+        return 0, 0
+
+    sent = failed = 0
+    connection = get_connection()
+    try:
+        for email in emails:
+            message = EmailMessage(email.subject, email.body, email.from_email, [email.to_email],
+                                   connection=connection)
+            email.attempts += 1
+            try:
+                # opens the connection if it isn't open, e.g. after an error closed it
+                connection.open()
+                message.send()
+            except Exception as e:
+                failed += 1
+                email.last_error = f'{type(e).__name__}: {e}'
+                if email.attempts >= settings.EMAIL_OUTBOX_MAX_ATTEMPTS:
+                    email.status = OutboxEmail.FAILED
+                else:
+                    email.next_attempt_at = timezone.now() + get_retry_delay(email.attempts)
+                email.save(update_fields=['attempts', 'last_error', 'status', 'next_attempt_at'])
+                # the connection may be broken, start a fresh one for the next email
+                connection.close()
+            else:
+                sent += 1
+                email.status = OutboxEmail.SENT
+                email.sent_at = timezone.now()
+                email.save(update_fields=['attempts', 'status', 'sent_at'])
+    finally:
+        connection.close()
+    return sent, failed
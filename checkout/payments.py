@@ -0,0 +1,69 @@
+import hashlib
+
+from django.conf import settings
+
+from bag.storage import serialize_bag
+from .models import Order
+from .stripe_gateway import get_gateway
+
+"""
+Stripe PaymentIntents for the checkout page.
+Creating a new payment intent every time the checkout page is shown meant
+a round trip to Stripe on every page load (and a refresh left the old
+intent behind, never to be used).Instead the intent is remembered in the
+session along with a fingerprint of the bag it was made for:
+    same bag - the same intent is used again without contacting Stripe
+    changed bag, same total - still no need to contact Stripe
+    changed total - the intent's amount is updated with PaymentIntent.modify
+A new intent is only created when there isn't one yet, or the old one
+can't be changed any more (it has been paid for or cancelled).
+"""
+
+SESSION_KEY = 'checkout_payment_intent'
+
+
+def get_bag_fingerprint(bag, amount):
+    data = f'{serialize_bag(bag)}:{amount}:{settings.STRIPE_CURRENCY}'
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+def get_payment_intent_secret(request, bag, amount):
+    """
+    Return the client secret of a payment intent for the given bag and
+    amount (in cents), reusing the one in the session whenever we can.
+    """
+    gateway = get_gateway()
+    fingerprint = get_bag_fingerprint(bag, amount)
+    stored = request.session.get(SESSION_KEY)
+    # an intent that already paid for an order can't be used again
+    if stored and Order.objects.filter(stripe_pid=stored['id']).exists():
+        stored = None
+
+    if stored and stored['fingerprint'] == fingerprint:
+        return stored['client_secret']
+
+    if stored and stored['amount'] != amount:
+        try:
+            gateway.modify_payment_intent(stored['id'], amount=amount)
+        except gateway.error.InvalidRequestError:
+            # it has been paid for, cancelled or has expired, so we need a new one
+            stored = None
+
+    if stored:
+        pid, client_secret = stored['id'], stored['client_secret']
+    else:
+        intent = gateway.create_payment_intent(amount=amount, currency=settings.STRIPE_CURRENCY)
+        pid, client_secret = intent.id, intent.client_secret
+
+    request.session[SESSION_KEY] = {
+        'id': pid,
+        'client_secret': client_secret,
+        'amount': amount,
+        'fingerprint': fingerprint,
+    }
+    return client_secret
+
+
+def forget_payment_intent(request):
+    """ Once an order has been placed the next checkout needs a new intent """
+    request.session.pop(SESSION_KEY, None)
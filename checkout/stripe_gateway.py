@@ -0,0 +1,229 @@
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import requests
+import stripe
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from stripe.http_client import RequestsClient
+
+from performance.timing import add_timing
+
+"""
+Everything that talks to Stripe goes through here.
+The stripe library on its own opens connections with no timeout (a slow
+Stripe response could hold a worker for as long as it liked) and doesn't
+retry, and our views were setting the global api key on every request.
+The gateway instead uses one HTTP client for the whole process:
+    a pooled requests session, so connections to Stripe are kept alive
+        and reused rather than doing a TLS handshake for every call
+    a connect and read timeout on every call, which a call can shorten
+    up to STRIPE_MAX_NETWORK_RETRIES retries of connection errors and of
+        the responses Stripe marks as safe to retry, waiting a little
+        longer (with random jitter) each time.The library sends an
+        idempotency key with every POST so a retried create is never doubled
+    latency and error counts for every call, see gateway_metrics
+Setting STRIPE_API_BASE points it at another server, like the stub in
+checkout/stripe_stub.py, and STRIPE_FAKE swaps Stripe for the in-memory
+fake in checkout/fake_stripe.py.
+"""
+
+
+class GatewayMetrics:
+    """
+    Call counts, errors and recent latencies per operation, kept in memory
+    for this process.Only the last `window` latencies are kept per operation.
+    """
+    def __init__(self, window=1000):
+        self.window = window
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.operations = {}
+
+    def record(self, name, seconds, ok=True):
+        with self.lock:
+            operation = self.operations.setdefault(
+                name, {'count': 0, 'errors': 0, 'latencies': deque(maxlen=self.window)})
+            operation['count'] += 1
+            operation['errors'] += 0 if ok else 1
+            operation['latencies'].append(seconds)
+
+    def snapshot(self):
+        """ A dictionary of name -> count, errors and p50/p95/max latency in milliseconds """
+        with self.lock:
+            operations = {name: dict(op, latencies=sorted(op['latencies'])) for name, op in self.operations.items()}
+        result = {}
+        for name, operation in operations.items():
+            latencies = operation['latencies']
+
+            def percentile(p):
+                return latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000 if latencies else 0
+
+            result[name] = {
+                'count': operation['count'],
+                'errors': operation['errors'],
+                'p50_ms': round(percentile(0.5), 2),
+                'p95_ms': round(percentile(0.95), 2),
+                'max_ms': round(latencies[-1] * 1000, 2) if latencies else 0,
+            }
+        return result
+
+
+gateway_metrics = GatewayMetrics()
+
+
+class PooledStripeClient(RequestsClient):
+    """
+    The stripe library's requests client with one shared, pooled session,
+    our own timeouts and retry limits, and latency metrics for every HTTP
+    attempt (retries included) under the name 'http'.
+    """
+    name = 'pooled-requests'
+
+    def __init__(self, pool_size, connect_timeout, read_timeout, max_retries, retry_delay, max_retry_delay):
+        session = requests.Session()
+        # the library does its own retries, so urllib3 mustn't retry as well
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        self.local = threading.local()
+        super().__init__(timeout=(connect_timeout, read_timeout), session=session)
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+
+    @property
+    def _timeout(self):
+        """
+        The (connect, read) timeout the library's requests client uses,
+        with the read timeout shortened for this thread inside timeout()
+        """
+        read_timeout = getattr(self.local, 'timeout', None)
+        if read_timeout is None:
+            return self.default_timeout
+        return self.default_timeout[0], min(read_timeout, self.default_timeout[1])
+
+    @_timeout.setter
+    def _timeout(self, value):
+        self.default_timeout = value
+
+    @contextmanager
+    def timeout(self, seconds):
+        """ Use a shorter read timeout for the calls made inside the block (on this thread) """
+        previous = getattr(self.local, 'timeout', None)
+        self.local.timeout = seconds
+        try:
+            yield
+        finally:
+            self.local.timeout = previous
+
+    def _request_internal(self, method, url, headers, post_data, is_streaming):
+        start = time.perf_counter()
+        ok = False
+        try:
+            content, status_code, headers = super()._request_internal(
+                method, url, headers, post_data, is_streaming)
+            ok = status_code < 500
+            return content, status_code, headers
+        finally:
+            gateway_metrics.record('http', time.perf_counter() - start, ok)
+
+    def _max_network_retries(self):
+        return self.max_retries
+
+    def _sleep_time_seconds(self, num_retries, response=None):
+        # double the wait each time, up to the limit, and add jitter so
+        # retries from several workers don't all arrive at once
+        sleep_seconds = min(self.retry_delay * 2 ** (num_retries - 1), self.max_retry_delay)
+        sleep_seconds = self._add_jitter_time(sleep_seconds)
+        retry_after = self._retry_after_header(response) or 0
+        if retry_after <= self.max_retry_delay:
+            sleep_seconds = max(retry_after, sleep_seconds)
+        return sleep_seconds
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_http_client():
+    """ The shared HTTP client, created (and handed to the stripe library) the first time it's needed """
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = PooledStripeClient(
+                    pool_size=settings.STRIPE_POOL_SIZE,
+                    connect_timeout=settings.STRIPE_CONNECT_TIMEOUT,
+                    read_timeout=settings.STRIPE_READ_TIMEOUT,
+                    max_retries=settings.STRIPE_MAX_NETWORK_RETRIES,
+                    retry_delay=settings.STRIPE_RETRY_DELAY,
+                    max_retry_delay=settings.STRIPE_MAX_RETRY_DELAY,
+                )
+                stripe.default_http_client = _client
+    return _client
+
+
+class StripeGateway:
+    """
+    The Stripe calls the shop makes.Each takes an optional timeout in
+    seconds to wait for Stripe's response, and is recorded in
+    gateway_metrics under its own name.
+    api is the stripe library or checkout.fake_stripe.
+    """
+    def __init__(self, api, api_key=None):
+        self.api = api
+        self.api_key = api_key
+        self.error = api.error
+
+    def _call(self, name, func, *args, timeout=None, **params):
+        if self.api is stripe:
+            client = get_http_client()
+            stripe.api_base = settings.STRIPE_API_BASE
+            params['api_key'] = self.api_key
+        start = time.perf_counter()
+        ok = False
+        try:
+            if self.api is stripe and timeout is not None:
+                with client.timeout(timeout):
+                    result = func(*args, **params)
+            else:
+                result = func(*args, **params)
+            ok = True
+            return result
+        finally:
+            elapsed = time.perf_counter() - start
+            gateway_metrics.record(name, elapsed, ok)
+            # and in the current request's Server-Timing breakdown
+            add_timing('stripe', elapsed)
+
+    def create_payment_intent(self, amount, currency, timeout=None, **params):
+        return self._call('payment_intent.create', self.api.PaymentIntent.create,
+                          amount=amount, currency=currency, timeout=timeout, **params)
+
+    def modify_payment_intent(self, pid, timeout=None, **params):
+        return self._call('payment_intent.modify', self.api.PaymentIntent.modify, pid, timeout=timeout, **params)
+
+    def retrieve_payment_intent(self, pid, timeout=None):
+        return self._call('payment_intent.retrieve', self.api.PaymentIntent.retrieve, pid, timeout=timeout)
+
+    def construct_webhook_event(self, payload, sig_header):
+        """ Check the signature on a webhook and turn it into an event, no call to Stripe needed """
+        return stripe.Webhook.construct_event(payload, sig_header, settings.STRIPE_WH_SECRET)
+
+
+def get_gateway():
+    """
+    The gateway for the current settings, using the in-memory fake stripe
+    when the STRIPE_FAKE setting is on.It's cheap to make, the HTTP client
+    behind it is shared by the whole process.
+    """
+    if settings.STRIPE_FAKE:
+        from . import fake_stripe
+        return StripeGateway(fake_stripe)
+    return StripeGateway(stripe, settings.STRIPE_SECRET_KEY)
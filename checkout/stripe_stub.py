@@ -0,0 +1,145 @@
+import json
+import socket
+import sys
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl
+
+"""
+A small local stand-in for the Stripe API, covering the PaymentIntent
+calls the shop makes:
+    POST /v1/payment_intents        create
+    GET  /v1/payment_intents/<id>   retrieve
+    POST /v1/payment_intents/<id>   modify
+Point STRIPE_API_BASE at it (manage.py stripe_stub_server) to run the
+checkout or benchmark the stripe gateway without a network connection.
+It speaks HTTP/1.1 with keep-alive like the real API, can add a fixed
+latency to every response, and can be told to fail the next few requests
+with a 503 to exercise the gateway's retries.
+"""
+
+
+class StripeStubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, latency=0.0):
+        super().__init__(address, StripeStubHandler)
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.payment_intents = {}
+        self.connections = 0
+        self.requests = 0
+        self.fail_next = 0
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def handle_error(self, request, client_address):
+        # a client that gave up waiting (a timeout) isn't an error worth printing
+        if isinstance(sys.exc_info()[1], ConnectionError):
+            return
+        super().handle_error(request, client_address)
+
+    def start(self):
+        """ Serve from a background thread, e.g. in a test or the benchmark """
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+
+class StripeStubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        # the headers and body go out in separate writes, without this a kept alive
+        # connection waits on the client's delayed ACK (around 40ms) for every response
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        with self.server.lock:
+            self.server.connections += 1
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, data, headers=None):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Request-Id', f'req_stub_{uuid.uuid4().hex[:14]}')
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _error(self, status, message, code):
+        self._send(status, {'error': {'type': 'invalid_request_error', 'message': message, 'code': code}})
+
+    def _params(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        params = {}
+        metadata = {}
+        for key, value in parse_qsl(self.rfile.read(length).decode()):
+            if key.startswith('metadata[') and key.endswith(']'):
+                metadata[key[len('metadata['):-1]] = value
+            else:
+                params[key] = value
+        if 'amount' in params:
+            params['amount'] = int(params['amount'])
+        return params, metadata
+
+    def _handle(self, method):
+        params, metadata = self._params() if method == 'POST' else ({}, {})
+        with self.server.lock:
+            self.server.requests += 1
+            fail = self.server.fail_next > 0
+            if fail:
+                self.server.fail_next -= 1
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if fail:
+            self._send(503, {'error': {'type': 'api_error', 'message': 'Stub failure'}})
+            return
+
+        path = self.path.split('?')[0].rstrip('/')
+        parts = path.split('/')
+        if parts[:3] != ['', 'v1', 'payment_intents'] or len(parts) > 4:
+            self._error(404, f'Unrecognized request URL ({method}: {path}).', 'resource_missing')
+            return
+
+        with self.server.lock:
+            intents = self.server.payment_intents
+            if len(parts) == 3 and method == 'POST':
+                pid = f'pi_stub_{uuid.uuid4().hex[:24]}'
+                intents[pid] = {
+                    'id': pid,
+                    'object': 'payment_intent',
+                    'amount': params.get('amount'),
+                    'currency': params.get('currency'),
+                    'client_secret': f'{pid}_secret_{uuid.uuid4().hex[:24]}',
+                    'metadata': metadata,
+                    'status': 'requires_payment_method',
+                }
+                intent = dict(intents[pid])
+            elif len(parts) == 4:
+                intent = intents.get(parts[3])
+                if intent is not None and method == 'POST':
+                    intent.update(params)
+                    intent['metadata'] = {**intent['metadata'], **metadata}
+                intent = dict(intent) if intent is not None else None
+            else:
+                intent = None
+        if intent is None:
+            self._error(404, f"No such payment_intent: '{parts[-1]}'", 'resource_missing')
+            return
+        self._send(200, intent)
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
@@ -1,3 +1,390 @@
-from django.test import TestCase
+import json
+import time
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+import stripe
+from django.contrib.auth.models import User
+from django.core import mail
+from django.core.management import call_command
+from django.core.mail.backends.locmem import EmailBackend
+from django.db import IntegrityError
+from django.http import HttpResponse
+from django.test import TestCase, RequestFactory, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from products.models import Product
+from . import fake_stripe
+from .models import Order, OutboxEmail, ProcessedStripeEvent
+from .orders import create_order_from_bag, get_order_detail
+from .outbox import send_pending_emails
+from . import stripe_gateway
+from .stripe_gateway import PooledStripeClient, gateway_metrics, get_gateway
+from .stripe_stub import StripeStubServer
+from .webhook_handler import StripeWH_Handler
+
+
+def make_payment_intent_event(pid, bag, username='AnonymousUser', amount=2200):
+    """ Build a payment_intent.succeeded event like the ones stripe sends """
+    address = {
+        'line1': '1 Main Street', 'line2': '', 'city': 'Dublin',
+        'state': '', 'postal_code': 'D01', 'country': 'IE',
+    }
+    return stripe.Event.construct_from({
+        'id': f'evt_{pid}',
+        'type': 'payment_intent.succeeded',
+        'data': {'object': {
+            'id': pid,
+            'object': 'payment_intent',
+            'metadata': {'bag': json.dumps(bag), 'save_info': '', 'username': username},
+            'charges': {'data': [{
+                'amount': amount,
+                'billing_details': {'email': 'customer@example.com'},
+            }]},
+            'shipping': {'name': 'A Customer', 'phone': '123456', 'address': address},
+        }},
+    }, 'sk_test')
+
+
+@override_settings(DEFAULT_FROM_EMAIL='shop@example.com')
+class PaymentIntentSucceededTests(TestCase):
+    """
+    The webhook should find or create the order for a payment intent straight away.
+    """
+    def setUp(self):
+        self.product = Product.objects.create(name='Jacket', description='A jacket', price=20)
+        self.bag = {str(self.product.id): 1}
+        self.handler = StripeWH_Handler(RequestFactory().post('/checkout/wh/'))
+
+    def test_creates_order_when_missing(self):
+        response = self.handler.handle_payment_intent_succeeded(
+            make_payment_intent_event('pi_new', self.bag))
+        self.assertContains(response, 'Created order in webhook')
+        order = Order.objects.get(stripe_pid='pi_new')
+        self.assertEqual(order.lineitems.count(), 1)
+        self.assertEqual(order.grand_total, 22)
+        # the email is queued with the order rather than sent during the webhook
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(order.emails.get().status, OutboxEmail.PENDING)
+
+    def test_existing_order_is_found_by_payment_intent(self):
+        self.handler.handle_payment_intent_succeeded(make_payment_intent_event('pi_dup', self.bag))
+        response = self.handler.handle_payment_intent_succeeded(
+            make_payment_intent_event('pi_dup', self.bag))
+        self.assertContains(response, 'Verified order already in database')
+        self.assertEqual(Order.objects.filter(stripe_pid='pi_dup').count(), 1)
+        self.assertEqual(OutboxEmail.objects.count(), 1)
+
+    def test_missing_product_rolls_back_the_order(self):
+        response = self.handler.handle_payment_intent_succeeded(
+            make_payment_intent_event('pi_bad', {'999999': 1}))
+        self.assertEqual(response.status_code, 500)
+        self.assertFalse(Order.objects.filter(stripe_pid='pi_bad').exists())
+        self.assertFalse(OutboxEmail.objects.exists())
+
+    def test_payment_intent_can_only_have_one_order(self):
+        self.handler.handle_payment_intent_succeeded(make_payment_intent_event('pi_one', self.bag))
+        order = Order.objects.get(stripe_pid='pi_one')
+        order.pk = None
+        order.order_number = ''
+        with self.assertRaises(IntegrityError):
+            order.save()
+
+
+class CreateOrderFromBagTests(TestCase):
+    """
+    Building an order should cost the same number of queries whatever the bag size.
+    """
+    def setUp(self):
+        self.products = {
+            str(p.id): p for p in (
+                Product.objects.create(name=f'Product {i}', description='A product', price=5)
+                for i in range(12)
+            )
+        }
+
+    def _order(self):
+        return Order(full_name='A Customer', email='customer@example.com',
+                     phone_number='123', country='IE', town_or_city='Dublin',
+                     street_address1='1 Main Street')
+
+    def test_query_count_is_constant_in_bag_size(self):
+        small_bag = {item_id: 1 for item_id in list(self.products)[:1]}
+        with self.assertNumQueries(4) as small:
+            create_order_from_bag(self._order(), small_bag, self.products)
+
+        big_bag = {item_id: {'items_by_size': {'s': 1, 'm': 2}} for item_id in self.products}
+        with self.assertNumQueries(len(small.captured_queries)):
+            order = create_order_from_bag(self._order(), big_bag, self.products)
+
+        order.refresh_from_db()
+        self.assertEqual(order.lineitems.count(), 24)
+        self.assertEqual(order.order_total, 180)
+        self.assertEqual(order.delivery_cost, 0)
+        self.assertEqual(order.grand_total, 180)
+
+    def test_totals_include_delivery_under_threshold(self):
+        bag = {list(self.products)[0]: 2}
+        order = create_order_from_bag(self._order(), bag, self.products)
+        order.refresh_from_db()
+        self.assertEqual(order.order_total, 10)
+        self.assertEqual(order.delivery_cost, 1)
+        self.assertEqual(order.grand_total, 11)
+
+
+class CheckoutSuccessTests(TestCase):
+    """
+    The order confirmation loads the order in two queries and
+    only updates the user's profile the first time it's shown.
+    """
+    def setUp(self):
+        products = {
+            str(p.id): p for p in (
+                Product.objects.create(name=f'Product {i}', description='A product', price=5)
+                for i in range(3)
+            )
+        }
+        self.order = create_order_from_bag(Order(
+            full_name='A Shopper', email='shopper@example.com', phone_number='555',
+            country='IE', town_or_city='Dublin', street_address1='1 Main Street',
+        ), {item_id: 2 for item_id in products}, products)
+        self.user = User.objects.create_user('shopper', 'shopper@example.com', 'password')
+
+    def test_order_detail_loads_in_two_queries(self):
+        with self.assertNumQueries(2):
+            order = get_order_detail(self.order.order_number)
+            names = [item.product.name for item in order.lineitems.all()]
+        self.assertEqual(len(names), 3)
+
+    def test_profile_is_saved_once_per_order(self):
+        self.client.force_login(self.user)
+        session = self.client.session
+        session['save_info'] = True
+        session.save()
+        url = reverse('checkout_success', args=[self.order.order_number])
+        self.client.get(url)
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.user_profile, self.user.userprofile)
+        self.user.userprofile.refresh_from_db()
+        self.assertEqual(self.user.userprofile.default_phone_number, '555')
+
+        # a refresh leaves the profile alone
+        self.user.userprofile.default_phone_number = '999'
+        self.user.userprofile.save()
+        self.client.get(url)
+        self.user.userprofile.refresh_from_db()
+        self.assertEqual(self.user.userprofile.default_phone_number, '999')
+
+
+class FlakyEmailBackend(EmailBackend):
+    """ A locmem backend that fails for one address, and counts the connections opened """
+    opened = 0
+    is_open = False
+
+    def open(self):
+        # like the smtp backend, only connect if we aren't connected already
+        if self.is_open:
+            return False
+        FlakyEmailBackend.opened += 1
+        self.is_open = True
+        return True
+
+    def close(self):
+        self.is_open = False
+
+    def send_messages(self, messages):
+        if any('fail@example.com' in message.to for message in messages):
+            raise ConnectionError('Mail server went away')
+        return super().send_messages(messages)
+
+
+@override_settings(DEFAULT_FROM_EMAIL='shop@example.com', EMAIL_OUTBOX_RETRY_DELAY=30, EMAIL_OUTBOX_MAX_ATTEMPTS=2,
+                   EMAIL_BACKEND='checkout.tests.FlakyEmailBackend')
+class OutboxTests(TestCase):
+    """
+    The outbox worker sends due emails over one connection and retries failures with backoff.
+    """
+    def setUp(self):
+        FlakyEmailBackend.opened = 0
+        product = Product.objects.create(name='Jacket', description='A jacket', price=20)
+        self.handler = StripeWH_Handler(RequestFactory().post('/checkout/wh/'))
+        for i in range(3):
+            self.handler.handle_payment_intent_succeeded(
+                make_payment_intent_event(f'pi_{i}', {str(product.id): 1}))
+
+    def test_batch_is_sent_over_one_connection(self):
+        self.assertEqual(send_pending_emails(), (3, 0))
+        self.assertEqual(len(mail.outbox), 3)
+        self.assertEqual(FlakyEmailBackend.opened, 1)
+        self.assertIn('Boutique Ado Confirmation', mail.outbox[0].subject)
+        self.assertFalse(OutboxEmail.objects.exclude(status=OutboxEmail.SENT).exists())
+        # nothing is sent twice
+        self.assertEqual(send_pending_emails(), (0, 0))
+
+    def test_failures_are_retried_with_backoff_then_given_up(self):
+        email = OutboxEmail.objects.first()
+        OutboxEmail.objects.filter(pk=email.pk).update(to_email='fail@example.com')
+        now = timezone.now()
+        with mock.patch('django.utils.timezone.now', return_value=now):
+            self.assertEqual(send_pending_emails(), (2, 1))
+        email.refresh_from_db()
+        self.assertEqual((email.status, email.attempts), (OutboxEmail.PENDING, 1))
+        self.assertEqual(email.next_attempt_at, now + timedelta(seconds=30))
+        self.assertIn('Mail server went away', email.last_error)
+
+        # not due yet
+        self.assertEqual(send_pending_emails(), (0, 0))
+        with mock.patch('django.utils.timezone.now', return_value=now + timedelta(seconds=31)):
+            self.assertEqual(send_pending_emails(), (0, 1))
+        email.refresh_from_db()
+        self.assertEqual((email.status, email.attempts), (OutboxEmail.FAILED, 2))
+
+
+@override_settings(STRIPE_FAKE=True)
+class PaymentIntentReuseTests(TestCase):
+    """
+    Showing the checkout page again reuses the payment intent, updating its
+    amount if the total changed, and only creates a new one when it has to.
+    """
+    def setUp(self):
+        fake_stripe.reset()
+        self.jacket = Product.objects.create(name='Jacket', description='A jacket', price=20)
+        self.hat = Product.objects.create(name='Hat', description='A hat', price=5)
+        self._add(self.jacket)
+
+    def _add(self, product):
+        self.client.post(f'/bag/add/{product.id}/', {'quantity': 1, 'redirect_url': '/bag/'})
+
+    def _checkout(self):
+        return self.client.get(reverse('checkout')).context['client_secret']
+
+    def test_refresh_reuses_the_intent_without_calling_stripe(self):
+        first = self._checkout()
+        second = self._checkout()
+        self.assertEqual(first, second)
+        self.assertEqual([call for call, pid in fake_stripe.calls], ['create'])
+
+    def test_changed_total_modifies_the_intent(self):
+        secret = self._checkout()
+        self._add(self.hat)
+        self.assertEqual(self._checkout(), secret)
+        pid = secret.split('_secret')[0]
+        self.assertEqual(fake_stripe.calls, [('create', None), ('modify', pid)])
+        self.assertEqual(fake_stripe.payment_intents[pid]['amount'], 2750)
+
+    def test_paid_intent_is_replaced(self):
+        secret = self._checkout()
+        pid = secret.split('_secret')[0]
+        fake_stripe.payment_intents[pid]['status'] = 'succeeded'
+        self._add(self.hat)
+        self.assertNotEqual(self._checkout(), secret)
+        self.assertEqual([call for call, pid in fake_stripe.calls], ['create', 'modify', 'create'])
+
+
+@override_settings(STRIPE_FAKE=False, STRIPE_SECRET_KEY='sk_test_stub')
+class StripeGatewayTests(TestCase):
+    """
+    The gateway talks to the stub server over kept alive connections,
+    retries failures and records how long each call took.
+    """
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = StripeStubServer(('127.0.0.1', 0))
+        cls.server.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        stripe.api_base = 'https://api.stripe.com'
+        super().tearDownClass()
+
+    def setUp(self):
+        self.client_ = PooledStripeClient(pool_size=2, connect_timeout=1, read_timeout=2,
+                                          max_retries=2, retry_delay=0.01, max_retry_delay=0.02)
+        for patcher in (mock.patch.object(stripe_gateway, '_client', self.client_),
+                        mock.patch.object(stripe, 'default_http_client', self.client_)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        settings_override = override_settings(STRIPE_API_BASE=self.server.url)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.server.connections = 0
+        self.server.fail_next = 0
+        gateway_metrics.reset()
+
+    def test_calls_reuse_one_connection(self):
+        gateway = get_gateway()
+        intent = gateway.create_payment_intent(amount=1000, currency='usd', metadata={'bag': '{}'})
+        gateway.modify_payment_intent(intent.id, amount=1500)
+        intent = gateway.retrieve_payment_intent(intent.id)
+        self.assertEqual((intent.amount, intent.metadata.bag), (1500, '{}'))
+        self.assertEqual(self.server.connections, 1)
+        metrics = gateway_metrics.snapshot()
+        self.assertEqual(metrics['payment_intent.create']['count'], 1)
+        self.assertEqual(metrics['http']['count'], 3)
+
+    def test_server_errors_are_retried(self):
+        self.server.fail_next = 2
+        intent = get_gateway().create_payment_intent(amount=1000, currency='usd')
+        self.assertTrue(intent.id.startswith('pi_stub_'))
+        self.assertEqual(gateway_metrics.snapshot()['http']['errors'], 2)
+
+    def test_retries_are_bounded(self):
+        self.server.fail_next = 3
+        with self.assertRaises(stripe.error.APIError):
+            get_gateway().create_payment_intent(amount=1000, currency='usd')
+        self.assertEqual(gateway_metrics.snapshot()['payment_intent.create']['errors'], 1)
+
+    def test_slow_responses_time_out(self):
+        self.server.latency = 0.5
+        self.addCleanup(setattr, self.server, 'latency', 0)
+        with self.assertRaises(stripe.error.APIConnectionError):
+            get_gateway().retrieve_payment_intent('pi_missing', timeout=0.1)
+
+
+@override_settings(STRIPE_WH_SECRET='whsec_test', DEFAULT_FROM_EMAIL='shop@example.com')
+class ProcessedStripeEventTests(TestCase):
+    """
+    Each webhook event is only processed once, repeat deliveries are answered
+    from the processed events table, and old rows can be pruned in batches.
+    """
+    def setUp(self):
+        product = Product.objects.create(name='Jacket', description='A jacket', price=20)
+        self.payload = json.dumps(make_payment_intent_event('pi_evt', {str(product.id): 1}))
+
+    def _deliver(self):
+        timestamp = int(time.time())
+        signature = stripe.WebhookSignature._compute_signature(f'{timestamp}.{self.payload}', 'whsec_test')
+        return self.client.post(reverse('webhook'), self.payload, content_type='application/json',
+                                HTTP_STRIPE_SIGNATURE=f't={timestamp},v1={signature}')
+
+    def test_duplicate_delivery_is_skipped_with_one_query(self):
+        self.assertContains(self._deliver(), 'Created order in webhook')
+        self.assertTrue(ProcessedStripeEvent.objects.filter(event_id='evt_pi_evt').exists())
+
+        with mock.patch.object(StripeWH_Handler, 'handle_payment_intent_succeeded') as handler:
+            with self.assertNumQueries(1):
+                response = self._deliver()
+        handler.assert_not_called()
+        self.assertContains(response, 'Event already processed')
+
+    def test_failed_event_is_not_recorded(self):
+        with mock.patch.object(StripeWH_Handler, 'handle_payment_intent_succeeded',
+                               return_value=HttpResponse(status=500)):
+            self.assertEqual(self._deliver().status_code, 500)
+        self.assertFalse(ProcessedStripeEvent.objects.exists())
+        self.assertContains(self._deliver(), 'Created order in webhook')
+
+    def test_prune_deletes_old_events_in_batches(self):
+        old = timezone.now() - timedelta(days=40)
+        ProcessedStripeEvent.objects.bulk_create(
+            [ProcessedStripeEvent(event_id=f'evt_old_{i}', event_type='x', processed_at=old) for i in range(5)]
+            + [ProcessedStripeEvent(event_id='evt_new', event_type='x')])
+        out = StringIO()
+        call_command('prune_stripe_events', days=30, batch_size=2, stdout=out)
+        self.assertIn('Deleted 5', out.getvalue())
+        self.assertEqual(list(ProcessedStripeEvent.objects.values_list('event_id', flat=True)), ['evt_new'])
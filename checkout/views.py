@@ -1,17 +1,21 @@
-from django.shortcuts import render, redirect, reverse, get_object_or_404, HttpResponse
+from django.shortcuts import render, redirect, reverse, HttpResponse
 from django.views.decorators.http import require_POST
 from django.contrib import messages
 from django.conf import settings
+from django.db import IntegrityError
 
 from .forms import OrderForm
-from .models import Order, OrderLineItem
+from .models import Order
+from .orders import create_order_from_bag, get_order_detail
+from .payments import forget_payment_intent, get_payment_intent_secret
+from .stripe_gateway import get_gateway
 
 from products.models import Product
 from profiles.models import UserProfile
 from profiles.forms import UserProfileForm
-from bag.contexts import bag_contents
+from bag.contexts import get_bag_contents, get_bag_products
+from bag.storage import get_bag, clear_bag
 
-import stripe
 import json
 
 
@@ -20,11 +24,10 @@ def cache_checkout_data(request):
     # a way to determine in the webhoook whether a user had saved the save info box checked.
     try:
         pid = request.POST.get('client_secret').split('_secret')[0]  # retrieve client secret if form is valid and split it to get the payment intent id
-        stripe.api_key = settings.STRIPE_SECRET_KEY
         # tell it what we want to modify in our case we'll add some metadata.  Let's add the user who's placing the order.
         # Will add whether or not they wanted to save their information and add a JSON dump of their shopping bag
-        stripe.PaymentIntent.modify(pid, metadata={
-            'bag': json.dumps(request.session.get('bag', {})),
+        get_gateway().modify_payment_intent(pid, metadata={
+            'bag': json.dumps(get_bag(request)),
             'save_info': request.POST.get('save_info'),
             'username': request.user,
         })
@@ -37,10 +40,9 @@ def cache_checkout_data(request):
 
 def checkout(request):
     stripe_public_key = settings.STRIPE_PUBLIC_KEY
-    stripe_secret_key = settings.STRIPE_SECRET_KEY
 
     if request.method == 'POST':
-        bag = request.session.get('bag', {})
+        bag = get_bag(request)
         # put form data into a dictionary(fields from checkout form)
         form_data = {
             'full_name': request.POST['full_name'],
@@ -61,48 +63,40 @@ def checkout(request):
         prevent multiple save events from being executed on the database.
         """
         if order_form.is_valid():  
-            order = order_form.save(commit=False)
             pid = request.POST.get('client_secret').split('_secret')[0]
+            """
+            The webhook no longer waits for this form before creating the
+            order itself, so if it got there first we use the order it
+            created rather than making a second one for the same payment.
+            """
+            existing_order = Order.objects.filter(stripe_pid=pid).first()
+            if existing_order:
+                request.session['save_info'] = 'save-info' in request.POST
+                return redirect(reverse('checkout_success', args=[existing_order.order_number]))
+
+            order = order_form.save(commit=False)
             order.stripe_pid = pid
             order.original_bag = json.dumps(bag)  # dump shopping to a JSON string set it on the order and save
-            order.save()
-            # iterate through the bag items to create each line item
-            # code similar to context.py
             """
-            First we get the Product ID out of the bag.
-            Then if its value is an integer we know 
-            we're working with an item that doesn't have sizes.
-            So the quantity will just be the item data
+            create_order_from_bag saves the order and a line item for each
+            bag item (and size) in one transaction.The products come from one
+            query shared with the bag context processor.
             """
-            for item_id, item_data in bag.items():
-                try:
-                    product = Product.objects.get(id=item_id)
-                    if isinstance(item_data, int):
-                        order_line_item = OrderLineItem(
-                            order=order,
-                            product=product,
-                            quantity=item_data,
-                        )
-                        order_line_item.save()
-                    else:
-                        # Otherwise, if the item has sizes. we'll iterate through each size and create a line item accordingly.
-                        for size, quantity in item_data['items_by_size'].items():
-                            order_line_item = OrderLineItem(
-                                order=order,
-                                product=product,
-                                quantity=quantity,
-                                product_size=size,
-                            )
-                            order_line_item.save()
-                # just in case a product isn't found we'll add an error message.
-                # Delete the empty order and return the user to the shopping bag page.
-                except Product.DoesNotExist:
-                    messages.error(request, (
-                        "One of the products in your bag wasn't found in our database. "
-                        "Please call us for assistance!")
-                    )
-                    order.delete()
-                    return redirect(reverse('view_bag'))
+            try:
+                create_order_from_bag(order, bag, get_bag_products(request, bag))
+            # just in case a product isn't found we'll add an error message.
+            # Nothing was saved, so just return the user to the shopping bag page.
+            except Product.DoesNotExist:
+                messages.error(request, (
+                    "One of the products in your bag wasn't found in our database. "
+                    "Please call us for assistance!")
+                )
+                return redirect(reverse('view_bag'))
+            except IntegrityError:
+                # the webhook created the order for this payment in the meantime
+                existing_order = Order.objects.get(stripe_pid=pid)
+                request.session['save_info'] = 'save-info' in request.POST
+                return redirect(reverse('checkout_success', args=[existing_order.order_number]))
             """
             We'll attach whether or not the user wanted to save their profile information to the session.
             And then redirect them to a new page. We'll name the new URL check out success.
@@ -114,9 +108,11 @@ def checkout(request):
             # if form is not valid the errors would show
             messages.error(request, 'There was an error with your form. \
                 Please double check your information.')
+            # show the form again with the same payment intent
+            client_secret = request.POST.get('client_secret')
     else:
-        # retrieve bag from session
-        bag = request.session.get('bag', {})
+        # retrieve bag from the bag storage
+        bag = get_bag(request)
         if not bag:
             # if there's nothing present in the bag 
             messages.error(request, "There's nothing in your bag at the moment")
@@ -125,16 +121,13 @@ def checkout(request):
 
         # to get the python dictionary from bag app
         # to calculate the current bag total 
-        current_bag = bag_contents(request)
+        current_bag = get_bag_contents(request)
         # retrieve grand total from current bag
         total = current_bag['grand_total']
         stripe_total = round(total * 100)
-        stripe.api_key = stripe_secret_key
-        # creating payment intent
-        intent = stripe.PaymentIntent.create(
-            amount=stripe_total,
-            currency=settings.STRIPE_CURRENCY,
-        )
+        # the payment intent from the last time the page was shown is used again if it can be,
+        # so refreshing the page (or coming back from the bag) doesn't create another one
+        client_secret = get_payment_intent_secret(request, bag, stripe_total)
 
         # Attempt to prefill the form on checkout page with any info the user maintains in their profile
         # use the initial parameter on the order form to pre-fill all its fields with the relevant information
@@ -167,7 +160,7 @@ def checkout(request):
     context = {
         'order_form': order_form,
         'stripe_public_key': stripe_public_key,
-        'client_secret': intent.client_secret,
+        'client_secret': client_secret,
     }
 
     return render(request, template, context)
@@ -181,18 +174,20 @@ def checkout_success(request, order_number):
     know that their payment is complete
     first check whether the user wanted to save their information by getting that from the session
     """
-    save_info = request.session.get('save_info')
+    save_info = request.session.pop('save_info', None)  # only used the first time the page is shown for this order
     # use the order number to get the order created in the previous view
-    # which we'll send back to the template.
-    order = get_object_or_404(Order, order_number=order_number)
+    # which we'll send back to the template, with its line items and products.
+    order = get_order_detail(order_number)
 
     #  check if the user is authenticated because
     #  if so they'll have a profile that was created when they created their account
-    if request.user.is_authenticated:
-        profile = UserProfile.objects.get(user=request.user)  # retrieve user profile
+    #  The profile only needs attaching (and saving the info) once, so refreshing
+    #  the success page doesn't update the order and the profile all over again.
+    if request.user.is_authenticated and order.user_profile_id is None:
+        profile = request.user.userprofile  # retrieve user profile
         # Attach the user's profile to the order ad save
         order.user_profile = profile
-        order.save()
+        order.save(update_fields=['user_profile'])
 
         # Save the user's info
         """
@@ -220,9 +215,10 @@ def checkout_success(request, order_number):
         Your order number is {order_number}. A confirmation \
         email will be sent to {order.email}.')
 
-    # Finally, I'll delete the user shopping bag from the session since it'll no longer be needed for this session.
-    if 'bag' in request.session:
-        del request.session['bag']
+    # Finally, I'll empty the user shopping bag since it'll no longer be needed.
+    # And forget its payment intent, the next order needs a new one.
+    clear_bag(request)
+    forget_payment_intent(request)
 
     template = 'checkout/checkout_success.html'
     context = {
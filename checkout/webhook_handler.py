@@ -1,14 +1,13 @@
 from django.http import HttpResponse
-from django.core.mail import send_mail  # assist to send email
-from django.template.loader import render_to_string
-from django.conf import settings
+from django.db import IntegrityError, transaction
 
-from .models import Order, OrderLineItem
-from products.models import Product
+from .models import Order
+from .orders import create_order_from_bag
+from .outbox import enqueue_order_confirmation
 from profiles.models import UserProfile
+from bag.contexts import get_bag_products
 
 import json
-import time
 """
 Handle Stripe webhooks
 The idea here is that for each type of webhook.
@@ -29,24 +28,14 @@ class StripeWH_Handler:
         self.request = request
 
     # It just starts with an underscore since it'll only be used inside this class.
-    # use the render_to_string method to render both confirmation email texts into two strings.
     def _send_confirmation_email(self, order):
-        """Send the user a confirmation email"""
-        cust_email = order.email  # retrieve customers email
-        subject = render_to_string(
-            'checkout/confirmation_emails/confirmation_email_subject.txt',
-            {'order': order})  # context just like we pass to a template
-        body = render_to_string(
-            'checkout/confirmation_emails/confirmation_email_body.txt',
-            {'order': order, 'contact_email': settings.DEFAULT_FROM_EMAIL})
-        
-        # send the email
-        send_mail(
-            subject,
-            body,
-            settings.DEFAULT_FROM_EMAIL,  # the email we want to send from
-            [cust_email]  # a list of emails were sending to, which in this case will be only the customer's email.
-        ) 
+        """
+        Queue the confirmation email for the user.It's written to the outbox
+        table and sent by the send_outbox_emails command, so the webhook never
+        waits on the mail server.Queuing it twice for the same order (when
+        stripe retries the webhook) does nothing.
+        """
+        enqueue_order_confirmation(order)
 
     def handle_event(self, event):
         """
@@ -75,7 +64,6 @@ class StripeWH_Handler:
 
         billing_details = intent.charges.data[0].billing_details
         shipping_details = intent.shipping
-        grand_total = round(intent.charges.data[0].amount / 100, 2)
 
         # Clean data in the shipping details
         """
@@ -115,44 +103,15 @@ class StripeWH_Handler:
         The first thing then is to check if the order exists already.
         If it does we'll just return a response, and say everything is all set.
         And if it doesn't we'll create it here in the webhook.
-        start by assuming the order doesn't exist.
-        """
-        order_exists = False
-        """
-        Instead of just immediately going to create the order if it's
-        not found in the database by creating a bit of delay
-        """
-        attempt = 1
-        """
-        All of this ensures that when we receive a webhook from stripe that a payment has been processed successfully.
-        We'll try to find an order with the same customer information and the same grand total,
-        Which was created with the exact same shopping bag.And it's associated with the same payment intent.
-        get the order using all the information from the payment intent.
-        the iexact lookup will provide an exact match but case-insensitive
-        """
-        while attempt <= 5:
-            try:
-                order = Order.objects.get(
-                    full_name__iexact=shipping_details.name,
-                    email__iexact=billing_details.email,
-                    phone_number__iexact=shipping_details.phone,
-                    country__iexact=shipping_details.address.country,
-                    postcode__iexact=shipping_details.address.postal_code,
-                    town_or_city__iexact=shipping_details.address.city,
-                    street_address1__iexact=shipping_details.address.line1,
-                    street_address2__iexact=shipping_details.address.line2,
-                    county__iexact=shipping_details.address.state,
-                    grand_total=grand_total,
-                    original_bag=bag,
-                    stripe_pid=pid,
-                )
-                order_exists = True  # if order is found set true
-                break  # if order is found
-            # This will in effect cause the webhook handler to try to find the order five times over five seconds
-            # before giving up and creating the order itself.
-            except Order.DoesNotExist:
-                attempt += 1
-                time.sleep(1)
+        Every order stores the id of the payment intent that paid for it,
+        which has a unique index, so a single index probe on it tells us whether the
+        checkout form already created the order.There's no need to wait
+        and retry (which tied up a worker for up to five seconds), if the
+        form hasn't got there yet we create the order now and the checkout
+        view will pick up this order instead of creating a second one.
+        """
+        order = Order.objects.filter(stripe_pid=pid).first()
+        order_exists = order is not None
         # If we found the order in the database because it was already created by the form. Let's send it just before returning that response to stripe
         if order_exists:
             self._send_confirmation_email(order) # If the order was created by the webhook handler send the before returning that response to stripe.
@@ -161,13 +120,14 @@ class StripeWH_Handler:
                 status=200)  # if order is true return a 200 HTTP response to stripe, with the message that we verified the order already exists
         else:
             # if the order does not exist, create it just like we would if the form were submitted (checkout method in views.py)
-            order = None
             """
             In this way, the webhook handler can create orders for both authenticated users by attaching their profile.
             And for anonymous users by setting that field to none.
+            create_order_from_bag saves the order and its line items in one transaction
+            so a failure part way through never leaves a half built order behind.
             """
             try:
-                order = Order.objects.create(
+                order = Order(
                     full_name=shipping_details.name,
                     user_profile=profile,
                     email=billing_details.email,
@@ -182,36 +142,30 @@ class StripeWH_Handler:
                     stripe_pid=pid,
                 )
                 """
-                still want to iterate through the bag items, the only difference here is
+                still want to create a line item for each bag item, the only difference here is
                 that we're going to load the bag from the JSON version in the payment intent
                 instead of from the session
                 """
-                for item_id, item_data in json.loads(bag).items():
-                    product = Product.objects.get(id=item_id)
-                    if isinstance(item_data, int):
-                        order_line_item = OrderLineItem(
-                            order=order,
-                            product=product,
-                            quantity=item_data,
-                        )
-                        order_line_item.save()
-                    else:
-                        for size, quantity in item_data['items_by_size'].items():
-                            order_line_item = OrderLineItem(
-                                order=order,
-                                product=product,
-                                quantity=quantity,
-                                product_size=size,
-                            )
-                            order_line_item.save()
-            #  if anything goes wrong I'll just delete the order if it was created and return a 500 server error response to stripe
+                bag_data = json.loads(bag)
+                # the confirmation email is queued in the same transaction as the order,
+                # so there's never an order without its email or an email without its order
+                with transaction.atomic():
+                    create_order_from_bag(order, bag_data, get_bag_products(self.request, bag_data))
+                    self._send_confirmation_email(order)
+            # the payment intent id is unique, so if the checkout form created the
+            # order while we were building ours the insert fails and we use theirs
+            except IntegrityError:
+                order = Order.objects.get(stripe_pid=pid)
+                self._send_confirmation_email(order)
+                return HttpResponse(
+                    content=f'Webhook received: {event["type"]} | SUCCESS: Verified order already in database',
+                    status=200)
+            #  if anything goes wrong the transaction is rolled back and we return a 500 server error response to stripe
             except Exception as e:
-                if order:
-                    order.delete()
                 return HttpResponse(
                     content=f'Webhook received: {event["type"]} | ERROR: {e}',
                     status=500)
-        self._send_confirmation_email(order)  # If the order was created by the webhook handler send the email
+        # the email was queued along with the order, so we can answer stripe as soon as it's committed
         return HttpResponse(
             # order must have been created by the webhook handler. So we should return a response to stripe indicating that.
             content=f'Webhook received: {event["type"]} | SUCCESS: Created order in webhook',
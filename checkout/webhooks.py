@@ -1,8 +1,9 @@
-from django.conf import settings
 from django.http import HttpResponse
 from django.views.decorators.http import require_POST
 from django.views.decorators.csrf import csrf_exempt
 
+from checkout.models import ProcessedStripeEvent
+from checkout.stripe_gateway import get_gateway
 from checkout.webhook_handler import StripeWH_Handler
 
 import stripe
@@ -11,19 +12,13 @@ import stripe
 @csrf_exempt
 def webhook(request):
     """Listen for webhooks from Stripe"""
-    # Setup
-    wh_secret = settings.STRIPE_WH_SECRET
-    stripe.api_key = settings.STRIPE_SECRET_KEY
-
     # Get the webhook data and verify its signature
     payload = request.body
     sig_header = request.META['HTTP_STRIPE_SIGNATURE']
     event = None
 
     try:
-        event = stripe.Webhook.construct_event(
-        payload, sig_header, wh_secret
-        )
+        event = get_gateway().construct_webhook_event(payload, sig_header)
     except ValueError as e:
         # Invalid payload
         return HttpResponse(status=400)
@@ -33,6 +28,16 @@ def webhook(request):
     except Exception as e:
         return HttpResponse(content=e, status=400)
 
+    """
+    Stripe can deliver the same event more than once.If we've already
+    processed this event id we say so straight away, a single lookup on
+    the unique event id index, without running the handler again.
+    """
+    if ProcessedStripeEvent.objects.filter(event_id=event.id).exists():
+        return HttpResponse(
+            content=f'Webhook received: {event["type"]} | SUCCESS: Event already processed',
+            status=200)
+
     """
     by using a class we can make our work reusable such that we
     could import it into other projects,Subclass it to override the methods.
@@ -67,4 +72,11 @@ def webhook(request):
 
     # Call the event handler with the event to get the response from the webhook handler
     response = event_handler(event)
+
+    # remember the event once it's been handled, so a repeat delivery is skipped.
+    # A failed event isn't recorded, stripe will send it again and we'll retry it.
+    # If a duplicate delivery got here at the same time, ignore_conflicts keeps the first row
+    if response.status_code < 300:
+        ProcessedStripeEvent.objects.bulk_create(
+            [ProcessedStripeEvent(event_id=event.id, event_type=event_type)], ignore_conflicts=True)
     return response
\ No newline at end of file
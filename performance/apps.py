@@ -0,0 +1,15 @@
+from django.apps import AppConfig
+
+
+class PerformanceConfig(AppConfig):
+    default_auto_field = 'django.db.models.BigAutoField'
+    name = 'performance'
+
+    def ready(self):
+        # time every template render, see performance/timing.py
+        from .timing import instrument_template_rendering
+        instrument_template_rendering()
+        # log slow queries from every database connection, see performance/querylog.py
+        from django.db.backends.signals import connection_created
+        from .querylog import install_query_log
+        connection_created.connect(install_query_log)
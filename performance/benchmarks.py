@@ -0,0 +1,243 @@
+import gc
+import statistics
+import time
+import tracemalloc
+from contextlib import contextmanager
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import transaction
+from django.test import RequestFactory, override_settings
+
+from bag.contexts import bag_contents
+from bag.storage import SessionBagStorage
+from bag.templatetags.bag_tools import calc_subtotal
+from checkout.models import Order, OrderLineItem
+from products.models import Product
+
+"""
+Micro-benchmarks for the pricing code that runs on nearly every request:
+    bag_contents - the bag context processor working out the bag items,
+        total and delivery (the products come from the request memo, so
+        this is the arithmetic and not the product query)
+    update_total - Order.update_total, the line item sum and the save
+    calc_subtotal - the bag template filter, called once per bag line
+Each one runs for bags of 1 to 500 lines, of products with and without
+sizes (but calc_subtotal, which only sees a price and a quantity), and
+with totals below and above FREE_DELIVERY_THRESHOLD.
+run_benchmarks returns the time per call for each one, along with the
+peak memory of a call and the memory calls leave allocated, and
+compare_results checks the times against an earlier run, so a change
+that makes any of them slower than allowed can fail the build.
+"""
+
+BAG_SIZES = [1, 10, 100, 500]
+SIZES = ['xs', 's', 'm', 'l', 'xl']
+# a price that keeps even a 500 line bag under the free delivery threshold, and one that's over it with a single line
+PRICES = {'below': Decimal('0.01'), 'above': Decimal('99.99')}
+
+
+def make_bag(lines, sized):
+    """
+    A bag with the given number of lines (product and size pairs), as the
+    bag storage keeps it.Sized bags put up to five sizes on each product.
+    """
+    if not sized:
+        return {str(i): 1 for i in range(1, lines + 1)}
+    bag = {}
+    for line in range(lines):
+        product_id = str(line // len(SIZES) + 1)
+        bag.setdefault(product_id, {'items_by_size': {}})['items_by_size'][SIZES[line % len(SIZES)]] = 1
+    return bag
+
+
+@contextmanager
+def _bag_contents_case(lines, sized, price):
+    bag = make_bag(lines, sized)
+    request = RequestFactory().get('/')
+    request.session = {'bag': bag}
+    request._bag_storage = SessionBagStorage(request)
+    # the products are already in the request memo, like after the cart has been loaded
+    request._bag_products = {
+        item_id: Product(id=int(item_id), name=f'Product {item_id}', price=price) for item_id in bag
+    }
+
+    def call():
+        # forget the totals worked out by the last call
+        request.__dict__.pop('_bag_contents', None)
+        return bag_contents(request)['grand_total']()
+    yield call
+
+
+@contextmanager
+def _calc_subtotal_case(lines, sized, price):
+    # the filter is given the price and quantity of each line, sizes never reach it
+    quantities = [1] * lines
+
+    def call():
+        for quantity in quantities:
+            calc_subtotal(price, quantity)
+    yield call
+
+
+@contextmanager
+def _update_total_case(lines, sized, price):
+    """
+    An order with the given number of line items, made inside a transaction
+    that's rolled back afterwards, so nothing is left in the database.
+    """
+    with transaction.atomic():
+        yield _make_order(lines, sized, price).update_total
+        transaction.set_rollback(True)
+
+
+def _make_order(lines, sized, price):
+    # bulk_create skips the product signals too, which bump the listing version in the
+    # shared cache and that isn't undone by the rollback.SQLite doesn't give back the
+    # new id from a bulk insert, so the product is looked up again by its sku.
+    Product.objects.bulk_create([
+        Product(name='Benchmark product', sku='benchmark', description='', price=price, has_sizes=sized)
+    ])
+    product = Product.objects.filter(sku='benchmark').latest('pk')
+    order = Order.objects.create(
+        full_name='Benchmark', email='benchmark@example.com', phone_number='0',
+        country='GB', town_or_city='Town', street_address1='Street')
+    # bulk_create skips the line item signal, which would call update_total for every line
+    OrderLineItem.objects.bulk_create([
+        OrderLineItem(order=order, product=product, quantity=1, lineitem_total=price,
+                      product_size=SIZES[line % len(SIZES)] if sized else None)
+        for line in range(lines)
+    ])
+    return order
+
+
+CASES = {
+    'bag_contents': _bag_contents_case,
+    'update_total': _update_total_case,
+    'calc_subtotal': _calc_subtotal_case,
+}
+# the cases where a sized bag does different work to an unsized one
+SIZED_CASES = ('bag_contents', 'update_total')
+
+
+def benchmark_names():
+    """ Every benchmark, named like bag_contents[100 lines, sized, above] """
+    for case in CASES:
+        for lines in BAG_SIZES:
+            for sized in ((False, True) if case in SIZED_CASES else (False,)):
+                for side in PRICES:
+                    name = f'{case}[{lines} lines, {"sized" if sized else "unsized"}, {side}]'
+                    yield name, case, lines, sized, side
+
+
+def _time_call(call, repeats, min_time):
+    """
+    Time the call like timeit: find a number of loops that takes at least
+    min_time seconds, then time that many loops repeats times, with the
+    garbage collector off so a collection doesn't land in one repeat.
+    """
+    loops = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(loops):
+            call()
+        if time.perf_counter() - start >= min_time:
+            break
+        loops *= 2
+
+    timings = []
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for _ in range(repeats):
+            start = time.perf_counter()
+            for _ in range(loops):
+                call()
+            timings.append((time.perf_counter() - start) / loops)
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+    return timings, loops
+
+
+def _memory(call, calls=20):
+    """
+    Return the most memory one call has in use at once (over what was in
+    use before it) and the bytes each call leaves allocated, from the
+    memory tracemalloc sees in use before and after a number of calls.
+    Those calls come after as many again, so things that are only set up
+    once (caches filling, dictionaries growing) aren't put down to every
+    call.tracemalloc only sees memory that's in use, so memory a call
+    allocates and frees again counts towards the peak but not towards
+    what it leaves allocated.
+    """
+    call()
+    tracemalloc.start()
+    try:
+        base = tracemalloc.get_traced_memory()[0]
+        call()
+        peak = tracemalloc.get_traced_memory()[1] - base
+        for _ in range(calls):
+            call()
+        settled = tracemalloc.get_traced_memory()[0]
+        for _ in range(calls):
+            call()
+        retained = tracemalloc.get_traced_memory()[0] - settled
+    finally:
+        tracemalloc.stop()
+    return peak, retained / calls
+
+
+def run_benchmarks(name_filter='', repeats=7, min_time=0.05):
+    """
+    Run every benchmark whose name contains name_filter and return
+    a dictionary of name -> results.The time per call is the median of
+    the repeats, which a single unlucky (or lucky) repeat doesn't move, so
+    it's what the regression gate compares.The fastest repeat is there to
+    show how noisy the run was.
+    They run with DEBUG off, as in production, so the queries aren't also
+    being kept in connection.queries.
+    """
+    results = {}
+    for name, case, lines, sized, side in benchmark_names():
+        if name_filter not in name:
+            continue
+        with override_settings(DEBUG=False), CASES[case](lines, sized, PRICES[side]) as call:
+            timings, loops = _time_call(call, repeats, min_time)
+            peak, retained = _memory(call)
+        results[name] = {
+            'us_per_call': round(statistics.median(timings) * 1e6, 3),
+            'min_us_per_call': round(min(timings) * 1e6, 3),
+            'loops': loops,
+            'repeats': repeats,
+            'peak_memory_bytes': peak,
+            'retained_bytes_per_call': round(retained, 1),
+        }
+    return results
+
+
+def compare_results(baseline, results, max_regression):
+    """
+    Return (name, baseline us, new us, change) for every benchmark that got
+    more than max_regression (a fraction, 0.1 for 10%) slower than the baseline.
+    Both the median and the fastest repeat have to be that much slower, a
+    busy machine slows some repeats down but a slower change slows them all.
+    """
+    regressions = []
+    for name, result in results.items():
+        before = baseline.get(name)
+        if not before or not before['us_per_call'] or not before['min_us_per_call']:
+            continue
+        change = min(result['us_per_call'] / before['us_per_call'],
+                     result['min_us_per_call'] / before['min_us_per_call']) - 1
+        if change > max_regression:
+            regressions.append((name, before['us_per_call'], result['us_per_call'], change))
+    return regressions
+
+
+def benchmark_settings():
+    """ The settings the results depend on, saved with them """
+    return {
+        'FREE_DELIVERY_THRESHOLD': settings.FREE_DELIVERY_THRESHOLD,
+        'STANDARD_DELIVERY_PERCENTAGE': settings.STANDARD_DELIVERY_PERCENTAGE,
+    }
@@ -0,0 +1,277 @@
+import hashlib
+import hmac
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+from urllib.parse import urljoin
+
+import requests
+
+"""
+An end to end load test of the whole purchase path.
+Each virtual user is a requests session (with its own cookies, so its own
+bag) going through what a shopper's browser does:
+    listing -> product_detail -> add_to_bag -> checkout (GET) ->
+    cache_checkout_data -> checkout (POST) -> checkout_success -> webhook
+and the webhook step plays Stripe, posting a signed payment_intent.succeeded
+event for the order's payment intent.
+A share of the journeys (webhook_first) post the webhook, with the amount
+the checkout page said the card would be charged, before the checkout form:
+    ... -> cache_checkout_data -> webhook_first -> checkout_post_late -> checkout_success
+like a shopper who closes the page while the payment is confirmed, so the
+webhook creates the order and the late form finds it instead of the other
+way round. Those two steps are recorded under their own names, as they do
+different work to webhook and checkout_post.
+The server is expected to be using the fake stripe (STRIPE_FAKE) so no
+payment ever leaves the machine, and the webhook secret given here.
+Every step records its latency, status and the number of queries it ran,
+read from the Server-Timing header the performance middleware adds, and
+report() turns them into throughput and p50/p95/p99 latency per step.
+"""
+
+STEPS = [
+    'listing', 'product_detail', 'add_to_bag', 'checkout_get',
+    'cache_checkout_data', 'checkout_post', 'checkout_success', 'webhook',
+    'webhook_first', 'checkout_post_late',
+]
+
+_PRODUCT_LINKS = re.compile(r'href="/products/(\d+)/"')
+_SIZE_OPTION = re.compile(r'name="product_size".*?<option value="([^"]+)"', re.S)
+_CLIENT_SECRET = re.compile(r'<input type="hidden" value="([^"]*)" name="client_secret">')
+_CHARGE_AMOUNT = re.compile(r'Your card will be charged <strong>\$([\d.]+)</strong>')
+_ORDER_NUMBER = re.compile(r'/checkout/checkout_success/(\w+)')
+_SQL_QUERIES = re.compile(r'SQL \((\d+) queries\)')
+
+SHIPPING = {
+    'full_name': 'Load Test',
+    'email': 'loadtest@example.com',
+    'phone_number': '0123456789',
+    'country': 'GB',
+    'postcode': 'AB1 2CD',
+    'town_or_city': 'Testville',
+    'street_address1': '1 Test Street',
+    'street_address2': '',
+    'county': 'Testshire',
+}
+
+
+class StepFailed(Exception):
+    pass
+
+
+def percentile(values, p):
+    """ The p (0 to 1) percentile of the values, by the nearest rank """
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(p * (len(ordered) - 1))))]
+
+
+def sign_webhook(payload, secret, timestamp=None):
+    """ A Stripe-Signature header for the payload, the same as Stripe would send """
+    timestamp = int(time.time()) if timestamp is None else timestamp
+    signature = hmac.new(secret.encode(), f'{timestamp}.{payload}'.encode(), hashlib.sha256).hexdigest()
+    return f't={timestamp},v1={signature}'
+
+
+def payment_intent_succeeded(pid, bag, amount):
+    """ A payment_intent.succeeded event with everything the webhook handler reads """
+    address = {
+        'line1': SHIPPING['street_address1'],
+        'line2': SHIPPING['street_address2'],
+        'city': SHIPPING['town_or_city'],
+        'state': SHIPPING['county'],
+        'postal_code': SHIPPING['postcode'],
+        'country': SHIPPING['country'],
+    }
+    return {
+        'id': f'evt_load_{uuid.uuid4().hex[:24]}',
+        'object': 'event',
+        'type': 'payment_intent.succeeded',
+        'data': {'object': {
+            'id': pid,
+            'object': 'payment_intent',
+            'amount': amount,
+            'metadata': {'bag': json.dumps(bag), 'save_info': '', 'username': 'AnonymousUser'},
+            'charges': {'object': 'list', 'data': [{
+                'object': 'charge',
+                'amount': amount,
+                'billing_details': {'email': SHIPPING['email'], 'name': SHIPPING['full_name'],
+                                    'phone': SHIPPING['phone_number'], 'address': address},
+            }]},
+            'shipping': {'name': SHIPPING['full_name'], 'phone': SHIPPING['phone_number'], 'address': address},
+        }},
+    }
+
+
+class Recorder:
+    """ The samples for every step, shared by all the virtual users """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = {step: [] for step in STEPS}
+        self.errors = {step: [] for step in STEPS}
+        self.purchases = 0
+
+    def add(self, step, seconds, queries):
+        with self.lock:
+            self.samples[step].append((seconds, queries))
+
+    def fail(self, step, message):
+        with self.lock:
+            self.errors[step].append(message)
+
+    def purchased(self):
+        with self.lock:
+            self.purchases += 1
+
+
+class Shopper:
+    """ One virtual user, going through the purchase path with its own cookies """
+    def __init__(self, base_url, webhook_secret, recorder, rng, webhook_first=0.0, timeout=30):
+        self.base_url = base_url
+        self.webhook_secret = webhook_secret
+        self.webhook_first = webhook_first
+        self.recorder = recorder
+        self.rng = rng
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.step = None
+
+    def _request(self, step, method, path, expect, **kwargs):
+        self.step = step
+        start = time.perf_counter()
+        response = self.session.request(
+            method, urljoin(self.base_url, path), allow_redirects=False, timeout=self.timeout, **kwargs)
+        seconds = time.perf_counter() - start
+        if response.status_code not in expect:
+            raise StepFailed(f'{method} {path} returned {response.status_code}')
+        # the sql timing is left out of the header when a request runs no queries at all
+        server_timing = response.headers.get('Server-Timing')
+        match = _SQL_QUERIES.search(server_timing or '')
+        queries = int(match.group(1)) if match else (0 if server_timing else None)
+        self.recorder.add(step, seconds, queries)
+        return response
+
+    def _post(self, step, path, data, expect):
+        data = {'csrfmiddlewaretoken': self.session.cookies.get('csrftoken', ''), **data}
+        return self._request(step, 'POST', path, expect, data=data)
+
+    def _post_webhook(self, step, pid, bag, amount):
+        payload = json.dumps(payment_intent_succeeded(pid, bag, amount))
+        return self._request(step, 'POST', '/checkout/wh/', {200}, data=payload, headers={
+            'Content-Type': 'application/json',
+            'Stripe-Signature': sign_webhook(payload, self.webhook_secret),
+        })
+
+    def buy(self):
+        """ One purchase, from the listing to the webhook.Returns the order number """
+        webhook_first = self.rng.random() < self.webhook_first
+        listing = self._request('listing', 'GET', '/products/', {200})
+        product_ids = _PRODUCT_LINKS.findall(listing.text)
+        if not product_ids:
+            raise StepFailed('the product listing has no products')
+        product_id = self.rng.choice(product_ids)
+
+        detail = self._request('product_detail', 'GET', f'/products/{product_id}/', {200})
+        form = {'quantity': self.rng.randint(1, 3), 'redirect_url': f'/products/{product_id}/'}
+        size = _SIZE_OPTION.search(detail.text)
+        if size:
+            form['product_size'] = size.group(1)
+        self._post('add_to_bag', f'/bag/add/{product_id}/', form, {302})
+        bag = {product_id: form['quantity'] if not size else {'items_by_size': {size.group(1): form['quantity']}}}
+
+        checkout = self._request('checkout_get', 'GET', '/checkout/', {200})
+        match = _CLIENT_SECRET.search(checkout.text)
+        if not match or not match.group(1):
+            raise StepFailed('the checkout page has no client secret')
+        client_secret = match.group(1)
+        pid = client_secret.split('_secret')[0]
+        charge = _CHARGE_AMOUNT.search(checkout.text)
+        if not charge:
+            raise StepFailed('the checkout page has no amount to charge')
+        amount = int(Decimal(charge.group(1)) * 100)
+
+        self._post('cache_checkout_data', '/checkout/cache_checkout_data/',
+                   {'client_secret': client_secret, 'save_info': ''}, {200})
+
+        if webhook_first:
+            # stripe got there before the form, so the webhook has to build the order from the bag in the metadata
+            response = self._post_webhook('webhook_first', pid, bag, amount)
+            if 'Created order in webhook' not in response.text:
+                raise StepFailed(f'the webhook did not create the order: {response.text}')
+            response = self._post('checkout_post_late', '/checkout/',
+                                  {**SHIPPING, 'client_secret': client_secret}, {302})
+        else:
+            response = self._post('checkout_post', '/checkout/',
+                                  {**SHIPPING, 'client_secret': client_secret}, {302})
+        order_number = _ORDER_NUMBER.search(response.headers.get('Location', ''))
+        if not order_number:
+            raise StepFailed(f'the checkout form redirected to {response.headers.get("Location")}')
+        self._request('checkout_success', 'GET', response.headers['Location'], {200})
+
+        if not webhook_first:
+            # the order already exists by now, so the handler only checks for it and queues the email
+            self._post_webhook('webhook', pid, bag, amount)
+        self.recorder.purchased()
+        return order_number.group(1)
+
+    def run(self, journeys):
+        for i in range(journeys):
+            try:
+                self.buy()
+            except StepFailed as e:
+                self.recorder.fail(self.step, str(e))
+            except requests.RequestException as e:
+                self.recorder.fail(self.step, f'{type(e).__name__}: {e}')
+            # start the next purchase with an empty bag, like a new shopper
+            self.session.cookies.clear()
+
+
+def run_load_test(base_url, webhook_secret, users=4, journeys=5, seed=None, webhook_first=0.0):
+    """
+    Send users virtual shoppers through the purchase path journeys times
+    each, all at once, and return the recorder and the wall clock seconds.
+    webhook_first (0 to 1) is the share of the journeys where the webhook
+    comes before the checkout form.
+    """
+    recorder = Recorder()
+    rng = random.Random(seed)
+    shoppers = [
+        Shopper(base_url, webhook_secret, recorder, random.Random(rng.random()), webhook_first)
+        for i in range(users)
+    ]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=users) as pool:
+        list(pool.map(lambda shopper: shopper.run(journeys), shoppers))
+    return recorder, time.perf_counter() - start
+
+
+def report(recorder, seconds):
+    """ Throughput, latency percentiles and queries for each step, as a dictionary ready for JSON """
+    steps = {}
+    for step in STEPS:
+        samples = recorder.samples[step]
+        latencies = [latency * 1000 for latency, queries in samples]
+        queries = [queries for latency, queries in samples if queries is not None]
+        steps[step] = {
+            'requests': len(samples),
+            'errors': len(recorder.errors[step]),
+            'throughput_rps': round(len(samples) / seconds, 2) if seconds else 0.0,
+            'p50_ms': round(percentile(latencies, 0.5), 2),
+            'p95_ms': round(percentile(latencies, 0.95), 2),
+            'p99_ms': round(percentile(latencies, 0.99), 2),
+            'queries_mean': round(sum(queries) / len(queries), 2) if queries else None,
+            'queries_max': max(queries) if queries else None,
+        }
+    return {
+        'seconds': round(seconds, 3),
+        'purchases': recorder.purchases,
+        'purchases_per_second': round(recorder.purchases / seconds, 2) if seconds else 0.0,
+        'steps': steps,
+        'error_samples': {step: errors[:5] for step, errors in recorder.errors.items() if errors},
+    }
@@ -0,0 +1,66 @@
+import json
+import platform
+
+from django.core.management.base import BaseCommand, CommandError
+
+from performance.benchmarks import benchmark_settings, compare_results, run_benchmarks
+
+
+class Command(BaseCommand):
+    help = (
+        'Benchmark the bag totals, Order.update_total and the calc_subtotal filter for bags of '
+        '1 to 500 lines, and fail if any got slower than a saved baseline allows'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--filter', default='', help='Only run the benchmarks whose name contains this')
+        parser.add_argument('--repeats', type=int, default=7, help='How many times to time each benchmark')
+        parser.add_argument('--min-time', type=float, default=0.05,
+                            help='Seconds each timing should take at least, more calls are made to fill it')
+        parser.add_argument('--output', help='Save the results as JSON, to use as a baseline later')
+        parser.add_argument('--json', action='store_true', help='Print the results as JSON instead of a table')
+        parser.add_argument('--baseline', help='Results saved by an earlier run to compare against')
+        parser.add_argument('--max-regression', type=float, default=10,
+                            help='Fail if any benchmark is more than this percentage slower than the baseline '
+                                 '(raise it on a shared or busy machine, where timings vary more)')
+
+    def handle(self, *args, **options):
+        baseline = None
+        if options['baseline']:
+            with open(options['baseline']) as f:
+                baseline = json.load(f)
+
+        results = run_benchmarks(options['filter'], options['repeats'], options['min_time'])
+        if not results:
+            raise CommandError(f'No benchmarks match {options["filter"]!r}')
+        output = {
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'settings': benchmark_settings(),
+            'benchmarks': results,
+        }
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(output, f, indent=2)
+
+        if options['json']:
+            self.stdout.write(json.dumps(output, indent=2))
+        else:
+            self.stdout.write(
+                f'{"benchmark":<48}{"us/call":>11}{"fastest":>11}{"peak KiB":>10}{"kept B":>9}' + (f'{"vs base":>9}' if baseline else ''))
+            for name, result in results.items():
+                line = (f'{name:<48}{result["us_per_call"]:>11.2f}{result["min_us_per_call"]:>11.2f}'
+                        f'{result["peak_memory_bytes"] / 1024:>10.1f}{result["retained_bytes_per_call"]:>9.0f}')
+                before = baseline['benchmarks'].get(name) if baseline else None
+                if before and before['us_per_call']:
+                    line += f'{result["us_per_call"] / before["us_per_call"] - 1:>+9.0%}'
+                self.stdout.write(line)
+
+        if baseline is not None:
+            regressions = compare_results(baseline['benchmarks'], results, options['max_regression'] / 100)
+            for name, before, after, change in regressions:
+                self.stderr.write(f'{name}: {before:.2f}us -> {after:.2f}us ({change:+.0%})')
+            if regressions:
+                raise CommandError(
+                    f'{len(regressions)} benchmarks are more than {options["max_regression"]:g}% slower '
+                    'than the baseline')
@@ -0,0 +1,155 @@
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+
+import requests
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from performance.loadtest import STEPS, report, run_load_test
+
+
+class Command(BaseCommand):
+    help = (
+        'Load test the purchase path (listing, product, bag, checkout, success page and '
+        'webhook) against a dev server using the fake stripe, and save the results as JSON'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--base-url',
+                            help='A server that is already running, started with STRIPE_FAKE and the same '
+                                 'webhook secret.By default a dev server is started just for the test')
+        parser.add_argument('--users', type=int, default=4, help='How many shoppers at once')
+        parser.add_argument('--journeys', type=int, default=5, help='How many purchases each shopper makes')
+        parser.add_argument('--webhook-secret', default='whsec_loadtest',
+                            help='The STRIPE_WH_SECRET the server checks the webhook signature with')
+        parser.add_argument('--seed', type=int, help='Seed the shoppers\' choices to repeat a run')
+        parser.add_argument('--webhook-first', type=float, default=0.25,
+                            help='The share (0 to 1) of purchases where the webhook comes before the '
+                                 'checkout form and creates the order itself')
+        parser.add_argument('--output-dir', default=os.path.join(settings.BASE_DIR, 'loadtest_results'),
+                            help='Where to save the JSON results')
+        parser.add_argument('--compare', help='A previous results file to compare this run with')
+
+    def _free_port(self):
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            return sock.getsockname()[1]
+
+    def _start_server(self, webhook_secret, log_path):
+        """
+        Start manage.py runserver with the fake stripe and the console email
+        backend, and wait for it to answer.
+        """
+        port = self._free_port()
+        env = {
+            **os.environ,
+            'STRIPE_FAKE': '1',
+            'DEVELOPMENT': '1',
+            'STRIPE_WH_SECRET': webhook_secret,
+            'PERFORMANCE_PROFILE_SAMPLE_RATE': '0',
+        }
+        self.server_log = open(log_path, 'w')
+        self.server = subprocess.Popen(
+            [sys.executable, os.path.join(settings.BASE_DIR, 'manage.py'), 'runserver', '--noreload',
+             f'127.0.0.1:{port}'],
+            env=env, stdout=self.server_log, stderr=subprocess.STDOUT)
+        base_url = f'http://localhost:{port}'
+        deadline = time.monotonic() + 30
+        while time.monotonic() < deadline:
+            if self.server.poll() is not None:
+                raise CommandError(f'The dev server stopped, see {log_path}')
+            try:
+                requests.get(f'{base_url}/products/', timeout=5)
+                return base_url
+            except requests.ConnectionError:
+                time.sleep(0.2)
+        raise CommandError(f'The dev server did not start within 30 seconds, see {log_path}')
+
+    def _stop_server(self):
+        self.server.terminate()
+        self.server.wait(timeout=10)
+        self.server_log.close()
+
+    def _commit(self):
+        """ The current commit (with + if there are uncommitted changes), so runs can be compared across commits """
+        try:
+            commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=settings.BASE_DIR,
+                                    capture_output=True, text=True, check=True).stdout.strip()
+            dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=settings.BASE_DIR,
+                                   capture_output=True, text=True, check=True).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return 'unknown'
+        return f'{commit}+' if dirty else commit
+
+    def _print_results(self, results, previous):
+        self.stdout.write(
+            f'{"step":<21}{"requests":>9}{"errors":>8}{"req/s":>8}{"p50 ms":>9}{"p95 ms":>9}{"p99 ms":>9}'
+            f'{"queries":>9}' + (f'{"p95 vs":>10}' if previous else ''))
+        for step in STEPS:
+            result = results['steps'][step]
+            if not result['requests'] and not result['errors']:
+                continue
+            queries = '-' if result['queries_mean'] is None else f'{result["queries_mean"]:.1f}'
+            line = (
+                f'{step:<21}{result["requests"]:>9}{result["errors"]:>8}{result["throughput_rps"]:>8.1f}'
+                f'{result["p50_ms"]:>9.1f}{result["p95_ms"]:>9.1f}{result["p99_ms"]:>9.1f}{queries:>9}')
+            before = previous['steps'].get(step) if previous else None
+            if before and before['p95_ms']:
+                line += f'{(result["p95_ms"] - before["p95_ms"]) / before["p95_ms"]:>+10.0%}'
+            self.stdout.write(line)
+        self.stdout.write(
+            f'{results["purchases"]} purchases in {results["seconds"]:.1f}s, '
+            f'{results["purchases_per_second"]:.2f}/s')
+        for step, errors in results['error_samples'].items():
+            self.stdout.write(self.style.ERROR(f'{step}: {errors[0]}'))
+
+    def handle(self, *args, **options):
+        if not 0 <= options['webhook_first'] <= 1:
+            raise CommandError('--webhook-first is a share of the purchases, from 0 to 1')
+        previous = None
+        if options['compare']:
+            with open(options['compare']) as f:
+                previous = json.load(f)
+
+        os.makedirs(options['output_dir'], exist_ok=True)
+        commit = self._commit()
+        started = datetime.now(timezone.utc)
+        name = f'{started:%Y%m%dT%H%M%SZ}-{commit.rstrip("+")}'
+
+        base_url = options['base_url']
+        if base_url is None:
+            base_url = self._start_server(
+                options['webhook_secret'], os.path.join(options['output_dir'], f'{name}.server.log'))
+        try:
+            recorder, seconds = run_load_test(
+                base_url, options['webhook_secret'],
+                users=options['users'], journeys=options['journeys'], seed=options['seed'],
+                webhook_first=options['webhook_first'])
+        finally:
+            if options['base_url'] is None:
+                self._stop_server()
+
+        results = {
+            'commit': commit,
+            'started': started.isoformat(),
+            'base_url': base_url,
+            'database': settings.DATABASES['default']['ENGINE'],
+            'users': options['users'],
+            'journeys': options['journeys'],
+            'seed': options['seed'],
+            'webhook_first': options['webhook_first'],
+            **report(recorder, seconds),
+        }
+        path = os.path.join(options['output_dir'], f'{name}.json')
+        with open(path, 'w') as f:
+            json.dump(results, f, indent=2)
+
+        self._print_results(results, previous)
+        self.stdout.write(f'Saved to {path}')
+        if any(results['steps'][step]['errors'] for step in STEPS):
+            raise CommandError('Some purchases failed')
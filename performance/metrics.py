@@ -0,0 +1,151 @@
+import json
+import os
+import threading
+import time
+
+from django.conf import settings
+
+"""
+Request metrics aggregated per view, in the Prometheus text format.
+Each gunicorn worker is its own process, so each keeps its histograms in
+memory and writes them to its own file in PERFORMANCE_METRICS_DIR at most
+every PERFORMANCE_METRICS_FLUSH_INTERVAL seconds (the same idea as the
+prometheus client's multiprocess mode).The metrics endpoint adds up the
+files from every worker, so whichever worker answers the scrape reports
+the whole server.Recording a request is just a few dictionary updates.
+When a worker exits (gunicorn restarts them with max_requests, and on
+every deploy) its file would otherwise be added in forever, so collect
+deletes the files of processes that are no longer running.Their counts
+leave the totals with them, which Prometheus treats as a counter reset,
+the same as a worker starting again from zero.
+"""
+
+# upper bounds of the histogram buckets, in seconds
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# the parts of a request we time, see performance/timing.py
+COMPONENTS = ('total', 'sql', 'template', 'stripe', 'bag')
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}  # "view|component" -> [bucket counts..., sum, count]
+        self.counters = {}  # "name|view|status" -> value
+        self.last_flush = 0.0
+
+    def _observe(self, key, seconds):
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = [0] * len(BUCKETS) + [0.0, 0]
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                histogram[i] += 1
+                break
+        histogram[-2] += seconds
+        histogram[-1] += 1
+
+    def record_request(self, view, status, durations, sql_count):
+        """ Record one request: its total time and the time in each component """
+        status_class = f'{status // 100}xx'
+        with self.lock:
+            for component in COMPONENTS:
+                if component == 'total' or component in durations:
+                    self._observe(f'{view}|{component}', durations.get(component, 0.0))
+            for name, value in (('requests', 1), ('sql_queries', sql_count)):
+                key = f'{name}|{view}|{status_class}'
+                self.counters[key] = self.counters.get(key, 0) + value
+        if time.monotonic() - self.last_flush > settings.PERFORMANCE_METRICS_FLUSH_INTERVAL:
+            self.flush()
+
+    def flush(self):
+        """ Write this process's metrics to its file, replacing it in one go """
+        with self.lock:
+            data = json.dumps({'histograms': self.histograms, 'counters': self.counters})
+            self.last_flush = time.monotonic()
+        directory = settings.PERFORMANCE_METRICS_DIR
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f'metrics-{os.getpid()}.json')
+        with open(f'{path}.tmp', 'w') as f:
+            f.write(data)
+        os.replace(f'{path}.tmp', path)
+
+
+registry = MetricsRegistry()
+
+
+def _process_is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # it's there, it just belongs to someone else
+        pass
+    return True
+
+
+def collect():
+    """ Add up the metrics written by every worker, this one included """
+    registry.flush()
+    histograms, counters = {}, {}
+    directory = settings.PERFORMANCE_METRICS_DIR
+    for name in os.listdir(directory):
+        if not (name.startswith('metrics-') and name.endswith('.json')):
+            continue
+        pid = name[len('metrics-'):-len('.json')]
+        if not pid.isdigit():
+            continue
+        path = os.path.join(directory, name)
+        if int(pid) != os.getpid() and not _process_is_running(int(pid)):
+            # a worker that has exited, whichever worker gets here first clears it up
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            continue
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            # a worker that is half way through replacing its file, we'll get it next time
+            continue
+        for key, values in data['histograms'].items():
+            total = histograms.setdefault(key, [0] * len(values))
+            for i, value in enumerate(values):
+                total[i] += value
+        for key, value in data['counters'].items():
+            counters[key] = counters.get(key, 0) + value
+    return histograms, counters
+
+
+def _labels(**labels):
+    return ','.join(f'{name}="{value}"' for name, value in labels.items())
+
+
+def render_prometheus():
+    """ The aggregated metrics in the Prometheus text exposition format """
+    histograms, counters = collect()
+    lines = [
+        '# HELP boutique_request_duration_seconds Time spent per view in each part of the request',
+        '# TYPE boutique_request_duration_seconds histogram',
+    ]
+    for key in sorted(histograms):
+        view, component = key.split('|')
+        values = histograms[key]
+        cumulative = 0
+        for bound, count in zip(BUCKETS, values):
+            cumulative += count
+            lines.append(f'boutique_request_duration_seconds_bucket{{{_labels(view=view, component=component, le=bound)}}} {cumulative}')
+        lines.append(f'boutique_request_duration_seconds_bucket{{{_labels(view=view, component=component, le="+Inf")}}} {values[-1]}')
+        lines.append(f'boutique_request_duration_seconds_sum{{{_labels(view=view, component=component)}}} {values[-2]}')
+        lines.append(f'boutique_request_duration_seconds_count{{{_labels(view=view, component=component)}}} {values[-1]}')
+
+    for name, help_text in (('requests', 'Requests handled per view and status'),
+                            ('sql_queries', 'SQL queries run per view and status')):
+        lines.append(f'# HELP boutique_{name}_total {help_text}')
+        lines.append(f'# TYPE boutique_{name}_total counter')
+        for key in sorted(counters):
+            counter, view, status = key.split('|')
+            if counter == name:
+                lines.append(f'boutique_{name}_total{{{_labels(view=view, status=status)}}} {counters[key]}')
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,136 @@
+import random
+import time
+import uuid
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.db import connections
+
+from .metrics import registry
+from .profiler import SamplingProfiler
+from .querylog import track_repeated_queries
+from .timing import collect_timings, get_current_timings
+
+"""
+Time every request and break it down into SQL, template rendering,
+Stripe calls and the bag (see performance/timing.py).
+The breakdown goes back to the browser in a Server-Timing header, which
+shows up in the network tab of the browser's developer tools, and into
+the per view histograms served by the metrics endpoint.
+"""
+
+# names and descriptions for the Server-Timing header
+SERVER_TIMING = (
+    ('sql', 'SQL'),
+    ('template', 'Templates'),
+    ('stripe', 'Stripe'),
+    ('bag', 'Bag'),
+)
+
+
+class InstrumentationMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not settings.PERFORMANCE_INSTRUMENTATION:
+            return self.get_response(request)
+
+        start = time.perf_counter()
+        with collect_timings() as timings, ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(timings.sql_wrapper))
+            response = self.get_response(request)
+        timings.durations['total'] = time.perf_counter() - start
+
+        # the url name, like products or checkout, so every product page is counted together
+        match = request.resolver_match
+        view = (match.view_name if match else None) or 'unresolved'
+        registry.record_request(view, response.status_code, timings.durations, timings.sql_count)
+
+        header = [
+            f'{name};dur={timings.durations[name] * 1000:.1f};desc="{description}'
+            + (f' ({timings.sql_count} queries)"' if name == 'sql' else '"')
+            for name, description in SERVER_TIMING if name in timings.durations
+        ]
+        header.append(f'total;dur={timings.durations["total"] * 1000:.1f}')
+        response['Server-Timing'] = ', '.join(header)
+        return response
+
+
+class ProfilingMiddleware:
+    """
+    Profile a single request with the sampling profiler and write the
+    result to PERFORMANCE_PROFILE_DIR.A request is profiled when
+        a superuser asks for it with the X-Profile header or a profile
+        query parameter (the file name comes back in X-Profile-File), or
+        it's picked at random, for PERFORMANCE_PROFILE_SAMPLE_RATE of requests
+    Otherwise it does nothing at all, so it costs nothing when it's off.
+    It goes after the authentication middleware so it can check the user.
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def _requested(self, request):
+        asked = 'HTTP_X_PROFILE' in request.META or 'profile' in request.GET
+        return asked and request.user.is_superuser
+
+    def __call__(self, request):
+        rate = settings.PERFORMANCE_PROFILE_SAMPLE_RATE
+        requested = self._requested(request)
+        if not requested and not (rate and random.random() < rate):
+            return self.get_response(request)
+
+        queries = []
+
+        def record_query(execute, sql, params, many, context):
+            start = time.perf_counter()
+            try:
+                return execute(sql, params, many, context)
+            finally:
+                queries.append({'sql': sql, 'ms': round((time.perf_counter() - start) * 1000, 3)})
+
+        profiler = SamplingProfiler(settings.PERFORMANCE_PROFILE_INTERVAL)
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(record_query))
+            profiler.start()
+            try:
+                response = self.get_response(request)
+            finally:
+                profiler.stop()
+
+        timings = get_current_timings()
+        metadata = {
+            'url': request.get_full_path(),
+            'method': request.method,
+            'view': request.resolver_match.view_name if request.resolver_match else None,
+            'status': response.status_code,
+            'trigger': 'requested' if requested else 'sampled',
+            'total_ms': round((profiler.end_time - profiler.start_time) * 1000, 3),
+            'timings_ms': {
+                name: round(seconds * 1000, 3) for name, seconds in timings.durations.items()
+            } if timings else {},
+            'sql_queries': queries,
+        }
+        filename = f'profile-{time.strftime("%Y%m%d-%H%M%S")}-{uuid.uuid4().hex[:8]}.speedscope.json'
+        profiler.write(settings.PERFORMANCE_PROFILE_DIR, filename, f'{request.method} {metadata["url"]}', metadata)
+        if requested:
+            response['X-Profile-File'] = filename
+        return response
+
+
+class QueryLogMiddleware:
+    """
+    Report any query shape repeated PERFORMANCE_REPEATED_QUERY_THRESHOLD
+    or more times within one request (see performance/querylog.py).
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not settings.PERFORMANCE_QUERY_LOG:
+            return self.get_response(request)
+        with track_repeated_queries(f'{request.method} {request.path}'):
+            return self.get_response(request)
+
@@ -0,0 +1,98 @@
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+"""
+A small statistical profiler for a single request.
+A background thread looks at the request thread's stack every
+PERFORMANCE_PROFILE_INTERVAL seconds and counts how often each stack is
+seen, so the cost to the request is the same however deep the code goes
+(unlike cProfile, which slows every function call down).Python only
+switches threads every few milliseconds, so in practice samples are taken
+at roughly that rate.
+The result is written in the speedscope file format, which opens as a
+flame graph at https://www.speedscope.app, with the url, the SQL queries
+and the timings added under "metadata".
+"""
+
+
+class SamplingProfiler:
+    def __init__(self, interval):
+        self.interval = interval
+        self.samples = Counter()
+        self.thread_id = None
+        self.stopped = threading.Event()
+        self.sampler = None
+        self.start_time = self.end_time = None
+
+    def _stack(self, frame):
+        """ The stack as a tuple of (function, file, line) from the outermost frame in """
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append((code.co_name, code.co_filename, code.co_firstlineno))
+            frame = frame.f_back
+        return tuple(reversed(stack))
+
+    def _sample(self):
+        last = time.perf_counter()
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            now = time.perf_counter()
+            if frame is not None:
+                # weigh each sample by the time since the last one, as the thread switching
+                # can make the gaps longer than the interval
+                self.samples[self._stack(frame)] += now - last
+            last = now
+
+    def start(self):
+        self.thread_id = threading.get_ident()
+        self.start_time = time.perf_counter()
+        self.sampler = threading.Thread(target=self._sample, name='request-profiler', daemon=True)
+        self.sampler.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.sampler.join()
+        self.end_time = time.perf_counter()
+
+    def to_speedscope(self, name, metadata):
+        frames, frame_index = [], {}
+        samples, weights = [], []
+        for stack, seconds in self.samples.most_common():
+            indexes = []
+            for frame in stack:
+                if frame not in frame_index:
+                    frame_index[frame] = len(frames)
+                    frames.append({'name': frame[0], 'file': frame[1], 'line': frame[2]})
+                indexes.append(frame_index[frame])
+            samples.append(indexes)
+            weights.append(round(seconds * 1000, 3))
+        return {
+            '$schema': 'https://www.speedscope.app/file-format-schema.json',
+            'name': name,
+            'exporter': 'boutique_ado performance.profiler',
+            'activeProfileIndex': 0,
+            'shared': {'frames': frames},
+            'profiles': [{
+                'type': 'sampled',
+                'name': name,
+                'unit': 'milliseconds',
+                'startValue': 0,
+                'endValue': round(sum(weights), 3),
+                'samples': samples,
+                'weights': weights,
+            }],
+            'metadata': metadata,
+        }
+
+    def write(self, directory, filename, name, metadata):
+        """ Write the profile to the directory and return its path """
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, filename)
+        with open(path, 'w') as f:
+            json.dump(self.to_speedscope(name, metadata), f)
+        return path
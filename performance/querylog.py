@@ -0,0 +1,140 @@
+import logging
+import os
+import re
+import sys
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+
+"""
+The slow query log.
+A database execute wrapper, added to every connection as it's opened, so
+it sees every query whether it comes from a view, the webhook handler, a
+signal or a management command.It logs two kinds of event to the
+performance.queries logger:
+    slow_query - a query that took longer than PERFORMANCE_SLOW_QUERY_MS
+    repeated_query - the same query shape run PERFORMANCE_REPEATED_QUERY_THRESHOLD
+        or more times in one request, the usual sign of an N+1 (a query
+        inside a loop that could have been one query, or select_related)
+Each event names the line in our own code that ran the query
+(file:line:function), rather than somewhere deep inside the ORM, and the
+query is normalised (the values taken out) so the same query with
+different values is recognised as the same shape.
+"""
+
+logger = logging.getLogger('performance.queries')
+
+_request_queries = ContextVar('request_queries', default=None)
+
+# quoted strings, numbers, and lists of placeholders like IN (%s, %s, %s)
+_STRINGS = re.compile(r"'(?:[^']|'')*'")
+_NUMBERS = re.compile(r'\b\d+(?:\.\d+)?\b')
+_PLACEHOLDER_LISTS = re.compile(r'\((?:\s*(?:%s|\?)\s*,)+\s*(?:%s|\?)\s*\)')
+_SPACES = re.compile(r'\s+')
+
+# the performance package's own wrappers and middleware are on the stack of
+# every query in a request, but never where the query comes from
+_PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+_TESTS_FILE = os.path.join(_PACKAGE_DIR, 'tests.py')
+
+
+def normalise_sql(sql):
+    """ The shape of a query, with every value replaced by ? """
+    sql = _STRINGS.sub('?', sql)
+    sql = sql.replace('%s', '?')
+    sql = _NUMBERS.sub('?', sql)
+    sql = _PLACEHOLDER_LISTS.sub('(...)', sql)
+    return _SPACES.sub(' ', sql).strip()
+
+
+def find_caller():
+    """
+    The innermost frame in our own code (under BASE_DIR, but not an
+    installed package or the performance package itself) as
+    'path:line:function', or None if the query didn't come from our code
+    at all.
+    """
+    base_dir = str(settings.BASE_DIR)
+    frame = sys._getframe(1)
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        own = os.path.dirname(filename) == _PACKAGE_DIR and filename != _TESTS_FILE
+        if (filename.startswith(base_dir) and not own
+                and 'site-packages' not in filename and f'{os.sep}.venv' not in filename):
+            return f'{os.path.relpath(filename, base_dir)}:{frame.f_lineno}:{frame.f_code.co_name}'
+        frame = frame.f_back
+    return None
+
+
+class RequestQueries:
+    """ The query shapes seen during one request: shape -> [count, total seconds, caller] """
+    def __init__(self, label):
+        self.label = label
+        self.shapes = {}
+
+    def add(self, shape, seconds):
+        seen = self.shapes.get(shape)
+        if seen is None:
+            # only look up the caller the first time, it's the same line for a query in a loop
+            self.shapes[shape] = [1, seconds, find_caller()]
+        else:
+            seen[0] += 1
+            seen[1] += seconds
+
+    def report_repeated(self):
+        threshold = settings.PERFORMANCE_REPEATED_QUERY_THRESHOLD
+        for shape, (count, seconds, caller) in self.shapes.items():
+            if count >= threshold:
+                logger.warning(
+                    'repeated_query %dx %.1fms %s %s at %s',
+                    count, seconds * 1000, self.label, shape, caller,
+                    extra={'event': 'repeated_query', 'count': count, 'duration_ms': seconds * 1000,
+                           'request': self.label, 'sql': shape, 'caller': caller})
+
+
+def log_queries(execute, sql, params, many, context):
+    """ The execute wrapper, see install_query_log """
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        seconds = time.perf_counter() - start
+        request_queries = _request_queries.get()
+        slow = seconds * 1000 >= settings.PERFORMANCE_SLOW_QUERY_MS
+        if request_queries is not None or slow:
+            shape = normalise_sql(sql)
+            if request_queries is not None:
+                request_queries.add(shape, seconds)
+            if slow:
+                caller = find_caller()
+                logger.warning(
+                    'slow_query %.1fms %s at %s', seconds * 1000, shape, caller,
+                    extra={'event': 'slow_query', 'duration_ms': seconds * 1000, 'sql': shape, 'caller': caller})
+
+
+def install_query_log(sender, connection, **kwargs):
+    """
+    A connection_created receiver adding the wrapper to each new database
+    connection.With CONN_MAX_AGE=0 the connection is opened again inside
+    each request, after the instrumentation middleware has pushed its own
+    wrapper with connection.execute_wrapper(), which pops the last wrapper
+    off the list when the request is done.So this one goes at the bottom
+    of the list, where it's never popped by mistake (and it's the outermost
+    wrapper, so it times the other wrappers too).
+    """
+    if settings.PERFORMANCE_QUERY_LOG and log_queries not in connection.execute_wrappers:
+        connection.execute_wrappers.insert(0, log_queries)
+
+
+@contextmanager
+def track_repeated_queries(label):
+    """ Look for repeated query shapes among the queries run inside the block """
+    request_queries = RequestQueries(label)
+    token = _request_queries.set(request_queries)
+    try:
+        yield request_queries
+    finally:
+        _request_queries.reset(token)
+        request_queries.report_repeated()
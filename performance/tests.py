@@ -0,0 +1,282 @@
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+from django.contrib.auth.models import User
+from django.db import connection
+from django.db.backends.signals import connection_created
+from django.test import LiveServerTestCase, TestCase, modify_settings, override_settings
+from django.urls import reverse
+
+from checkout import fake_stripe
+from checkout.models import Order, OrderLineItem, OutboxEmail
+from products.caching import get_listing_version
+from products.models import Product
+from .benchmarks import compare_results, make_bag, run_benchmarks
+from .loadtest import STEPS, report, run_load_test
+from .metrics import registry
+from .querylog import log_queries, normalise_sql, track_repeated_queries
+
+
+class InstrumentationTests(TestCase):
+    """
+    Every request gets a Server-Timing breakdown, and the per view
+    histograms from every worker are served to Prometheus.
+    """
+    def setUp(self):
+        self.metrics_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.metrics_dir)
+        override = override_settings(PERFORMANCE_METRICS_DIR=self.metrics_dir, PERFORMANCE_METRICS_TOKEN='scrape')
+        override.enable()
+        self.addCleanup(override.disable)
+        registry.histograms.clear()
+        registry.counters.clear()
+        Product.objects.create(name='Jacket', description='A jacket', price=20)
+
+    def test_server_timing_header(self):
+        response = self.client.get(reverse('products'))
+        timing = response['Server-Timing']
+        self.assertRegex(timing, r'sql;dur=[\d.]+;desc="SQL \(\d+ queries\)"')
+        self.assertIn('template;dur=', timing)
+        self.assertIn('bag;dur=', timing)
+        self.assertRegex(timing, r'total;dur=[\d.]+$')
+
+    def test_metrics_need_a_token_or_superuser(self):
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, 403)
+        self.assertEqual(self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer wrong').status_code, 403)
+        User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.client.login(username='admin', password='password')
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, 200)
+
+    def test_metrics_add_up_every_worker(self):
+        self.client.get(reverse('products'))
+        # another worker process's file, it only has to be a process that's still running
+        with open(os.path.join(self.metrics_dir, f'metrics-{os.getppid()}.json'), 'w') as f:
+            json.dump({'histograms': {}, 'counters': {'requests|products|2xx': 4, 'sql_queries|products|2xx': 8}}, f)
+
+        response = self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer scrape')
+        body = response.content.decode()
+        self.assertIn('boutique_requests_total{view="products",status="2xx"} 5', body)
+        self.assertIn('boutique_request_duration_seconds_count{view="products",component="total"} 1', body)
+        self.assertIn('boutique_request_duration_seconds_bucket{view="products",component="sql",le="+Inf"} 1', body)
+
+    def test_metrics_of_exited_workers_are_dropped(self):
+        self.client.get(reverse('products'))
+        worker = subprocess.Popen([sys.executable, '-c', 'pass'])
+        worker.wait()
+        path = os.path.join(self.metrics_dir, f'metrics-{worker.pid}.json')
+        with open(path, 'w') as f:
+            json.dump({'histograms': {}, 'counters': {'requests|products|2xx': 4}}, f)
+
+        response = self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer scrape')
+        self.assertIn('boutique_requests_total{view="products",status="2xx"} 1', response.content.decode())
+        self.assertFalse(os.path.exists(path))
+
+
+class ProfilingTests(TestCase):
+    """
+    Superusers can ask for a request to be profiled, others can't,
+    and a sample rate profiles requests at random.
+    """
+    def setUp(self):
+        self.profile_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.profile_dir)
+        override = override_settings(PERFORMANCE_PROFILE_DIR=self.profile_dir, PERFORMANCE_PROFILE_SAMPLE_RATE=0)
+        override.enable()
+        self.addCleanup(override.disable)
+        Product.objects.create(name='Jacket', description='A jacket', price=20)
+
+    def test_superuser_can_profile_a_request(self):
+        User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.client.login(username='admin', password='password')
+        response = self.client.get(reverse('products'), {'q': 'jacket'}, HTTP_X_PROFILE='1')
+        with open(os.path.join(self.profile_dir, response['X-Profile-File'])) as f:
+            profile = json.load(f)
+        self.assertEqual(profile['profiles'][0]['type'], 'sampled')
+        metadata = profile['metadata']
+        self.assertEqual(metadata['url'], '/products/?q=jacket')
+        self.assertEqual(metadata['view'], 'products')
+        self.assertTrue(any('products_product' in query['sql'] for query in metadata['sql_queries']))
+        self.assertIn('template', metadata['timings_ms'])
+
+    def test_other_users_cannot_profile(self):
+        User.objects.create_user('shopper', 'shopper@example.com', 'password')
+        self.client.login(username='shopper', password='password')
+        response = self.client.get(reverse('products'), {'profile': '1'})
+        self.assertNotIn('X-Profile-File', response)
+        self.assertEqual(os.listdir(self.profile_dir), [])
+
+    @override_settings(PERFORMANCE_PROFILE_SAMPLE_RATE=1)
+    def test_sampled_requests_are_profiled(self):
+        response = self.client.get(reverse('products'))
+        self.assertNotIn('X-Profile-File', response)
+        self.assertEqual(len(os.listdir(self.profile_dir)), 1)
+
+
+class ReconnectMiddleware:
+    """
+    Opens the database connection again part way through every request,
+    as it is with CONN_MAX_AGE=0 (the tests keep one connection open).
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if log_queries in connection.execute_wrappers:
+            connection.execute_wrappers.remove(log_queries)
+        connection_created.send(sender=connection.__class__, connection=connection)
+        return self.get_response(request)
+
+
+class QueryLogTests(TestCase):
+    """
+    Slow queries and queries repeated within one request are logged
+    with the line of our code that ran them.
+    """
+    def setUp(self):
+        self.products = [
+            Product.objects.create(name=f'Jacket {i}', description='A jacket', price=20) for i in range(6)
+        ]
+
+    def test_normalise_sql(self):
+        self.assertEqual(
+            normalise_sql("SELECT * FROM t WHERE  name = 'it''s' AND id IN (%s, %s, %s) LIMIT 21"),
+            'SELECT * FROM t WHERE name = ? AND id IN (...) LIMIT ?')
+
+    @override_settings(PERFORMANCE_SLOW_QUERY_MS=0)
+    def test_slow_queries_name_the_caller(self):
+        with self.assertLogs('performance.queries', 'WARNING') as logs:
+            Product.objects.filter(name='Jacket 1').first()
+        record = logs.records[0]
+        self.assertEqual(record.event, 'slow_query')
+        self.assertIn('?', record.sql)
+        self.assertNotIn('Jacket 1', record.sql)
+        self.assertRegex(record.caller, r'^performance/tests.py:\d+:test_slow_queries_name_the_caller$')
+
+    def test_repeated_queries_are_reported(self):
+        with self.assertLogs('performance.queries', 'WARNING') as logs:
+            with track_repeated_queries('GET /products/'):
+                for product in self.products:
+                    Product.objects.get(pk=product.pk)
+                Product.objects.count()
+        self.assertEqual(len(logs.records), 1)
+        record = logs.records[0]
+        self.assertEqual(record.event, 'repeated_query')
+        self.assertEqual(record.count, 6)
+        self.assertIn('test_repeated_queries_are_reported', record.caller)
+
+    @override_settings(PERFORMANCE_SLOW_QUERY_MS=0)
+    @modify_settings(MIDDLEWARE={'append': 'performance.tests.ReconnectMiddleware'})
+    def test_query_log_keeps_working_request_after_request(self):
+        wrappers = list(connection.execute_wrappers)
+        with self.assertLogs('performance.queries', 'WARNING') as logs:
+            for product in self.products[:5]:
+                self.client.get(reverse('product_detail', args=[product.id]))
+        # the timing wrapper each request pushed was popped, not the query log
+        self.assertEqual(connection.execute_wrappers, wrappers)
+        self.assertIn(log_queries, connection.execute_wrappers)
+        callers = [record.caller for record in logs.records if record.event == 'slow_query' and record.caller]
+        self.assertTrue(any(caller.startswith('products/views.py:') for caller in callers))
+        self.assertFalse([caller for caller in callers if caller.startswith('performance/')])
+
+    def test_listing_has_no_repeated_queries(self):
+        with self.assertRaises(AssertionError):
+            with self.assertLogs('performance.queries', 'WARNING'):
+                self.client.get(reverse('products'))
+
+
+@override_settings(STRIPE_FAKE=True, STRIPE_WH_SECRET='whsec_test', DEFAULT_FROM_EMAIL='shop@example.com')
+class LoadTestTests(LiveServerTestCase):
+    """ The load test shoppers get all the way through the purchase path """
+    def setUp(self):
+        fake_stripe.reset()
+        Product.objects.create(name='Jacket', description='A jacket', price=20)
+        Product.objects.create(name='Shirt', description='A shirt', price=10, has_sizes=True)
+
+    def test_purchases_complete(self):
+        # one shopper, the live server shares the test's in-memory database connection between its threads
+        recorder, seconds = run_load_test(self.live_server_url, 'whsec_test', users=1, journeys=4, seed=1)
+        results = report(recorder, seconds)
+        self.assertEqual(results['error_samples'], {})
+        self.assertEqual(results['purchases'], 4)
+        for step in STEPS:
+            if step in ('webhook_first', 'checkout_post_late'):
+                self.assertEqual(results['steps'][step]['requests'], 0)
+                continue
+            self.assertEqual(results['steps'][step]['requests'], 4)
+            self.assertIsNotNone(results['steps'][step]['queries_mean'])
+        self.assertEqual(Order.objects.count(), 4)
+        # the webhook found each order and queued its confirmation email
+        self.assertEqual(OutboxEmail.objects.count(), 4)
+
+    def test_webhook_first_purchases_complete(self):
+        recorder, seconds = run_load_test(
+            self.live_server_url, 'whsec_test', users=1, journeys=3, seed=1, webhook_first=1)
+        results = report(recorder, seconds)
+        self.assertEqual(results['error_samples'], {})
+        self.assertEqual(results['purchases'], 3)
+        for step in ('webhook_first', 'checkout_post_late', 'checkout_success'):
+            self.assertEqual(results['steps'][step]['requests'], 3)
+        for step in ('checkout_post', 'webhook'):
+            self.assertEqual(results['steps'][step]['requests'], 0)
+        # the webhook made each order, for the amount the checkout page showed, and the late form used it
+        self.assertEqual(Order.objects.count(), 3)
+        self.assertEqual(OutboxEmail.objects.count(), 3)
+        for order in Order.objects.all():
+            self.assertGreater(order.grand_total, 0)
+            self.assertTrue(order.lineitems.exists())
+
+    def test_bad_webhook_signature_is_an_error(self):
+        recorder, seconds = run_load_test(self.live_server_url, 'whsec_wrong', users=1, journeys=1)
+        results = report(recorder, seconds)
+        self.assertEqual(results['steps']['webhook']['errors'], 1)
+        self.assertEqual(results['purchases'], 0)
+
+
+class BenchmarkTests(TestCase):
+    """ The pricing benchmarks run, clean up after themselves, and the gate catches a slower change """
+    def test_sized_bags_have_the_given_number_of_lines(self):
+        bag = make_bag(12, sized=True)
+        self.assertEqual(len(bag), 3)
+        self.assertEqual(sum(len(item['items_by_size']) for item in bag.values()), 12)
+        self.assertEqual(len(make_bag(12, sized=False)), 12)
+
+    def test_run_benchmarks(self):
+        listing_version = get_listing_version()
+        results = run_benchmarks('[10 lines, sized', repeats=2, min_time=0.001)
+        # calc_subtotal never sees the sizes, so it only has unsized cases
+        self.assertEqual(len(results), 4)
+        self.assertFalse(any(name.startswith('calc_subtotal') for name in results))
+        for result in results.values():
+            self.assertGreater(result['us_per_call'], 0)
+            self.assertGreaterEqual(result['us_per_call'], result['min_us_per_call'])
+            self.assertGreater(result['peak_memory_bytes'], 0)
+            self.assertIn('retained_bytes_per_call', result)
+        # the orders made for update_total were rolled back
+        self.assertFalse(Order.objects.exists())
+        self.assertFalse(OrderLineItem.objects.exists())
+        self.assertFalse(Product.objects.exists())
+        # and the cached listings weren't invalidated by the products made for them
+        self.assertEqual(get_listing_version(), listing_version)
+
+    def test_regression_gate(self):
+        baseline = {
+            'calc_subtotal[1 lines, unsized, below]': {'us_per_call': 1.0, 'min_us_per_call': 0.9},
+            'bag_contents[1 lines, unsized, below]': {'us_per_call': 20.0, 'min_us_per_call': 18.0},
+            'update_total[1 lines, unsized, below]': {'us_per_call': 100.0, 'min_us_per_call': 90.0},
+        }
+        results = {
+            # slower through and through
+            'calc_subtotal[1 lines, unsized, below]': {'us_per_call': 1.5, 'min_us_per_call': 1.3},
+            # a noisy median, but the fastest repeat is as fast as ever
+            'bag_contents[1 lines, unsized, below]': {'us_per_call': 30.0, 'min_us_per_call': 18.5},
+            'update_total[1 lines, unsized, below]': {'us_per_call': 105.0, 'min_us_per_call': 95.0},
+            'update_total[10 lines, unsized, below]': {'us_per_call': 500.0, 'min_us_per_call': 400.0},
+        }
+        regressions = compare_results(baseline, results, 0.1)
+        self.assertEqual([name for name, before, after, change in regressions],
+                         ['calc_subtotal[1 lines, unsized, below]'])
+        self.assertAlmostEqual(regressions[0][3], 0.4444, places=3)
@@ -0,0 +1,102 @@
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+
+"""
+Where the time goes within one request.
+The instrumentation middleware starts a RequestTimings for each request
+and the code we want to see in the breakdown adds to it:
+    sql - every query, through a database execute wrapper
+    template - every template rendered with render() or render_to_string()
+    stripe - every call through checkout/stripe_gateway.py
+    bag - working out the bag contents in bag/contexts.py
+Outside a request (management commands, tests calling functions directly)
+there's no RequestTimings and add_timing does nothing, so it's safe to
+call from anywhere.
+"""
+
+_current = ContextVar('request_timings', default=None)
+
+
+class RequestTimings:
+    def __init__(self):
+        self.durations = defaultdict(float)
+        self.sql_count = 0
+        self.rendering = False
+
+    def sql_wrapper(self, execute, sql, params, many, context):
+        """ A database execute wrapper counting and timing the queries """
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.durations['sql'] += time.perf_counter() - start
+            self.sql_count += 1
+
+
+def get_current_timings():
+    return _current.get()
+
+
+@contextmanager
+def collect_timings():
+    """ Collect the timings for everything run inside the block """
+    timings = RequestTimings()
+    token = _current.set(timings)
+    try:
+        yield timings
+    finally:
+        _current.reset(token)
+
+
+def add_timing(name, seconds):
+    """ Add some time to the named part of the current request, if there is one """
+    timings = _current.get()
+    if timings is not None:
+        timings.durations[name] += seconds
+
+
+@contextmanager
+def timed(name):
+    """ Time the block as part of the named part of the current request """
+    if _current.get() is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_timing(name, time.perf_counter() - start)
+
+
+def instrument_template_rendering():
+    """
+    Wrap the django template backend's render, used by render() and
+    render_to_string(), so the time spent rendering is added to 'template'.
+    Templates included by other templates are part of the outer render
+    and aren't counted twice.
+    """
+    from django.template.backends.django import Template
+
+    if getattr(Template.render, 'instrumented', False):
+        return
+    render = Template.render
+
+    @wraps(render)
+    def timed_render(self, *args, **kwargs):
+        timings = _current.get()
+        # a template rendered while another is rendering is already being timed
+        if timings is None or timings.rendering:
+            return render(self, *args, **kwargs)
+        timings.rendering = True
+        start = time.perf_counter()
+        try:
+            return render(self, *args, **kwargs)
+        finally:
+            timings.rendering = False
+            timings.durations['template'] += time.perf_counter() - start
+
+    timed_render.instrumented = True
+    Template.render = timed_render
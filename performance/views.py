@@ -0,0 +1,19 @@
+import hmac
+
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden
+
+from .metrics import render_prometheus
+
+
+def metrics(request):
+    """
+    The request metrics for Prometheus to scrape.Only superusers, or a
+    scraper sending the PERFORMANCE_METRICS_TOKEN as a bearer token, can see them.
+    """
+    token = settings.PERFORMANCE_METRICS_TOKEN
+    authorization = request.META.get('HTTP_AUTHORIZATION', '')
+    allowed = (token and hmac.compare_digest(authorization, f'Bearer {token}')) or request.user.is_superuser
+    if not allowed:
+        return HttpResponseForbidden()
+    return HttpResponse(render_prometheus(), content_type='text/plain; version=0.0.4; charset=utf-8')
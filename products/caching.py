@@ -0,0 +1,71 @@
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+
+"""
+Caching for the product listing.
+The products on a listing page are the same for every user with the same
+sort, direction, category, search and page parameters, so we cache the
+page of products (not the rendered html, which holds the user's bag and
+admin links) under a key made from those parameters.
+Every key includes a version number which the signals in products/signals.py
+bump whenever a product or category is saved or deleted, from the store
+views or the admin, so old listings are simply never looked up again.
+The listings themselves are in each worker's own cache, but the version is
+kept in the shared cache (PRODUCTS_LISTING_VERSION_CACHE_ALIAS) so a change
+made in one worker moves every worker on to the new version at once.
+Versions are taken from the clock and only ever go up, so if the version is
+ever lost from the cache the new one can't match any old listing.
+"""
+
+LISTING_VERSION_KEY = 'products_listing_version'
+# the get parameters that change what the listing shows, anything else is ignored
+LISTING_PARAMS = ('sort', 'direction', 'category', 'q', 'cursor', 'per_page')
+
+
+def _version_cache():
+    return caches[settings.PRODUCTS_LISTING_VERSION_CACHE_ALIAS]
+
+
+def _new_version(previous=None):
+    """ A version newer than previous and than any version handed out before """
+    return max(time.time_ns(), (previous or 0) + 1)
+
+
+def get_listing_version():
+    """ Return the current listing version, starting a new one if there isn't one """
+    version_cache = _version_cache()
+    version = version_cache.get(LISTING_VERSION_KEY)
+    if version is None:
+        # add, so if another worker got there first we use its version
+        version_cache.add(LISTING_VERSION_KEY, _new_version(), None)
+        version = version_cache.get(LISTING_VERSION_KEY)
+    return version or _new_version()
+
+
+def bump_listing_version():
+    """ Invalidate every cached listing, in every worker, by moving on to a new version """
+    version_cache = _version_cache()
+    version_cache.set(LISTING_VERSION_KEY, _new_version(version_cache.get(LISTING_VERSION_KEY)), None)
+
+
+def get_listing_cache_key(prefix, params):
+    """
+    Build a cache key from the listing parameters.The parameters are
+    normalised first so that the same listing always gets the same key,
+    whatever order the parameters or categories were given in.
+    """
+    normalised = []
+    for name in LISTING_PARAMS:
+        value = params.get(name)
+        if value is None:
+            continue
+        if name == 'category':
+            value = ','.join(sorted(set(value.split(','))))
+        elif name == 'q':
+            value = ' '.join(value.lower().split())
+        normalised.append(f'{name}={value}')
+    digest = hashlib.md5('&'.join(normalised).encode()).hexdigest()
+    return f'{prefix}:{get_listing_version()}:{digest}'
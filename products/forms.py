@@ -1,6 +1,7 @@
 from django import forms
 from .widgets import CustomClearableFileInput
 from .models import Product, Category
+from .images import update_product_derivatives
 
 
 class ProductForm(forms.ModelForm):
@@ -22,3 +23,13 @@ class ProductForm(forms.ModelForm):
         # iterate through the rest of these fields and set classes on them to make them match the theme of our store.
         for field_name, field in self.fields.items():
             field.widget.attrs['class'] = 'border-black rounded-0'
+
+    def save(self, commit=True):
+        """
+        When a new image is uploaded (or the image is cleared) make the
+        thumbnails and webp/avif copies the templates use for srcset.
+        """
+        product = super().save(commit)
+        if commit and 'image' in self.changed_data:
+            update_product_derivatives(product)
+        return product
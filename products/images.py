@@ -0,0 +1,126 @@
+import os
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from PIL import Image, ImageOps, features
+
+"""
+Smaller copies of the product images for the listing and detail pages.
+The originals are full size JPEGs, far bigger than the cards they're shown
+in, so each image gets a set of derivatives: one per width in the
+PRODUCT_IMAGE_WIDTHS setting, in each of the PRODUCT_IMAGE_FORMATS.
+They're saved next to the originals in the media storage (the local media
+folder or S3) under derivatives/, and what was generated is recorded on
+the product so the templates can build srcset urls without asking the
+storage whether any files exist.
+Derivatives are made when ProductForm saves a new image, and the
+generate_image_derivatives management command backfills the catalogue.
+"""
+
+# format name -> (Pillow format, mime type, save options)
+IMAGE_FORMATS = {
+    'avif': ('AVIF', 'image/avif', {'quality': 55}),
+    'webp': ('WEBP', 'image/webp', {'quality': 75, 'method': 6}),
+    'jpeg': ('JPEG', 'image/jpeg', {'quality': 80, 'optimize': True, 'progressive': True}),
+}
+FORMAT_EXTENSIONS = {'avif': 'avif', 'webp': 'webp', 'jpeg': 'jpg'}
+
+
+def get_image_formats():
+    """
+    The formats to generate, leaving out any this build of Pillow can't write
+    (AVIF needs Pillow built with libavif).JPEG is always made as the fallback.
+    """
+    formats = [
+        name for name in settings.PRODUCT_IMAGE_FORMATS
+        if name == 'jpeg' or features.check(name)
+    ]
+    if 'jpeg' not in formats:
+        formats.append('jpeg')
+    return formats
+
+
+def derivative_name(image_name, width, image_format):
+    stem = os.path.splitext(image_name)[0]
+    return f'derivatives/{stem}-{width}w.{FORMAT_EXTENSIONS[image_format]}'
+
+
+def generate_derivatives(image_name, storage):
+    """
+    Make every derivative of the named image and save them to the storage,
+    returning the record to keep on the product:
+        {'source': image name, 'widths': [...], 'formats': [...]}
+    Widths bigger than the original are left out (a small original is
+    only re-encoded at its own width) so nothing is ever scaled up.
+    """
+    with storage.open(image_name, 'rb') as f:
+        original = Image.open(f)
+        # apply any camera rotation before the metadata is dropped
+        original = ImageOps.exif_transpose(original)
+        original.load()
+    if original.mode not in ('RGB', 'RGBA'):
+        original = original.convert('RGBA' if 'transparency' in original.info else 'RGB')
+
+    widths = sorted({min(width, original.width) for width in settings.PRODUCT_IMAGE_WIDTHS})
+    formats = get_image_formats()
+    for width in widths:
+        height = round(original.height * width / original.width)
+        resized = original.resize((width, height), Image.LANCZOS) if width != original.width else original
+        for image_format in formats:
+            pil_format, mime_type, options = IMAGE_FORMATS[image_format]
+            image = resized.convert('RGB') if pil_format == 'JPEG' else resized
+            buffer = BytesIO()
+            image.save(buffer, pil_format, **options)
+            name = derivative_name(image_name, width, image_format)
+            # saving over an existing file would give it a new random name
+            if storage.exists(name):
+                storage.delete(name)
+            storage.save(name, ContentFile(buffer.getvalue()))
+
+    return {'source': image_name, 'widths': widths, 'formats': formats}
+
+
+def update_product_derivatives(product):
+    """
+    Generate the derivatives for a product's image and record them,
+    or forget the old ones if the image has been removed.
+    """
+    if product.image:
+        derivatives = generate_derivatives(product.image.name, product.image.storage)
+    else:
+        derivatives = {}
+    product.image_derivatives = derivatives
+    product.save(update_fields=['image_derivatives'])
+
+
+def get_image_sources(product):
+    """
+    The <source> and <img> attributes for a product's image as a dictionary:
+        sources - a list of {'type', 'srcset'} for the modern formats, best first
+        srcset - the JPEG srcset for the <img> itself
+        src - the smallest JPEG, for browsers that ignore srcset
+    Products whose derivatives are missing or out of date (the image has
+    been changed since) just get the original image.
+    """
+    derivatives = product.image_derivatives or {}
+    name = product.image.name
+    if derivatives.get('source') != name:
+        return {'sources': [], 'srcset': '', 'src': product.image.url}
+
+    storage = product.image.storage
+
+    def srcset(image_format):
+        return ', '.join(
+            f'{storage.url(derivative_name(name, width, image_format))} {width}w'
+            for width in derivatives['widths']
+        )
+
+    return {
+        'sources': [
+            {'type': IMAGE_FORMATS[image_format][1], 'srcset': srcset(image_format)}
+            for image_format in derivatives['formats'] if image_format != 'jpeg'
+        ],
+        'srcset': srcset('jpeg'),
+        'src': storage.url(derivative_name(name, derivatives['widths'][0], 'jpeg')),
+    }
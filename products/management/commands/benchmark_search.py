@@ -0,0 +1,49 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from products.models import Product
+from products.pagination import keyset_paginate
+from products.search import IContainsSearchBackend, get_search_backend
+
+DEFAULT_QUERIES = ['shirt', 'jea', 'blue cotton', 'women dress', 'zzznomatch']
+
+
+class Command(BaseCommand):
+    help = 'Compare the indexed search backend against the original icontains search'
+
+    def add_arguments(self, parser):
+        parser.add_argument('queries', nargs='*', default=DEFAULT_QUERIES)
+        parser.add_argument('--repeat', type=int, default=50,
+                            help='How many times to run each query')
+
+    def _time(self, backend, query, repeat):
+        """
+        Return the average time per search in milliseconds and the number of results.
+        Each search does what the product listing does with it: count the
+        results and fetch the first page, best matches first.
+        """
+        queryset = Product.objects.select_related('category')
+        results = 0
+        start = time.perf_counter()
+        for _ in range(repeat):
+            products = backend.search(queryset, query)
+            results = products.count()
+            keyset_paginate(products, 'search_rank', False, None, settings.PRODUCTS_PER_PAGE)
+        return (time.perf_counter() - start) * 1000 / repeat, results
+
+    def handle(self, *args, **options):
+        indexed = get_search_backend()
+        baseline = IContainsSearchBackend()
+        repeat = options['repeat']
+        self.stdout.write(f'{Product.objects.count()} products, {repeat} runs per query, '
+                          f'indexed backend: {type(indexed).__name__}')
+        self.stdout.write(f'{"query":<20}{"icontains ms":>14}{"hits":>6}{"indexed ms":>14}{"hits":>6}{"speedup":>9}')
+        for query in options['queries']:
+            baseline_ms, baseline_hits = self._time(baseline, query, repeat)
+            indexed_ms, indexed_hits = self._time(indexed, query, repeat)
+            speedup = baseline_ms / indexed_ms if indexed_ms else 0
+            self.stdout.write(
+                f'{query:<20}{baseline_ms:>14.3f}{baseline_hits:>6}'
+                f'{indexed_ms:>14.3f}{indexed_hits:>6}{speedup:>8.1f}x')
@@ -0,0 +1,154 @@
+import itertools
+
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.messages.storage.fallback import FallbackStorage
+from django.contrib.sessions.backends.base import SessionBase
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext
+
+from products.pagination import encode_cursor
+from products.search import SearchResultsJoin
+from products.views import all_products
+
+# A cursor value of the right type for each sort key, so deep pages get explained too
+SAMPLE_CURSOR_VALUES = {
+    None: '1',
+    'price': '10',
+    'rating': '3',
+    'name': 'm',
+    'category': 'm',
+}
+
+
+class Command(BaseCommand):
+    help = (
+        'Run EXPLAIN on every query the all_products view can produce '
+        'and report any full scans or sorts of the catalogue, and any deep '
+        'page that walks an index instead of seeking to its cursor'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--fail-on-seq-scan', action='store_true',
+                            help='Exit with an error if any full scans or sorts are found')
+        parser.add_argument('--verbose-plans', action='store_true',
+                            help='Print every plan, not just the ones with problems')
+
+    def _listing_params(self):
+        """ Every combination of the sorting, category, search and cursor parameters """
+        sorts = [None, 'price', 'rating', 'name', 'category']
+        directions = ['asc', 'desc']
+        categories = [None, 'jeans,shirts']
+        queries = [None, 'shirt']
+        for sort, direction, category, query, deep in itertools.product(
+                sorts, directions, categories, queries, [False, True]):
+            if sort is None and direction == 'desc':
+                continue
+            params = {}
+            if sort:
+                params['sort'] = sort
+                params['direction'] = direction
+            if category:
+                params['category'] = category
+            if query:
+                params['q'] = query
+            if deep:
+                value = '-1' if query and not sort else SAMPLE_CURSOR_VALUES[sort]
+                params['cursor'] = encode_cursor(value, 1)
+            yield params
+
+    def _capture_queries(self, params):
+        request = RequestFactory().get('/products/', params)
+        request.session = SessionBase()
+        request.user = AnonymousUser()
+        request._messages = FallbackStorage(request)
+        with CaptureQueriesContext(connection) as queries:
+            all_products(request)
+        return [q['sql'] for q in queries.captured_queries if q['sql'].startswith('SELECT')]
+
+    def _plan_problems(self, sql, plan, deep):
+        """
+        Return the lines of the plan that read more of the catalogue than
+        the page needs:
+            a full scan of a table
+            a sort of the products (SQLite's temporary b-tree, a Sort node
+                on Postgres), which has to read every product it sorts
+            on a deep page, or with no LIMIT, an index walked from one end
+                rather than searched from the cursor
+        A search sorts its matches by rank or the chosen sort, there are only
+        as many of them as match, and a count has to touch every row it
+        counts (that's what cached_count is for), so those are left alone.
+        """
+        if sql.startswith('SELECT COUNT('):
+            return []
+        searching = SearchResultsJoin.table_name in sql
+        bounded = not deep and ' LIMIT ' in sql
+        if connection.vendor == 'postgresql':
+            return self._postgres_problems(plan, searching, bounded)
+        # SQLite reports "SCAN table" for a full scan, "SCAN table USING INDEX"
+        # for walking a whole index and "SEARCH table" when an index is searched.
+        # A SQLite table is itself a b-tree on the id, so walking it in id order
+        # (with no temporary b-tree for the ORDER BY) is an index walk too.
+        sorts_products = 'FROM "products_product"' in sql
+        problems = []
+        for line in plan:
+            if 'TEMP B-TREE' in line:
+                # sorting a few categories is fine, sorting the products isn't
+                if sorts_products and not searching:
+                    problems.append(line)
+            elif 'SCAN ' in line and 'VIRTUAL TABLE' not in line:
+                in_id_order = 'ORDER BY "products_product"."id"' in sql and 'SCAN products_product' in line
+                if 'USING' not in line and not in_id_order:
+                    problems.append(line)
+                elif 'SCAN products_product' in line and not bounded:
+                    problems.append(line)
+        return problems
+
+    def _postgres_problems(self, plan, searching, bounded):
+        """ The same checks for Postgres's plan tree, one node or detail per line """
+        problems = []
+        for i, line in enumerate(plan):
+            node = line.strip().lstrip('-> ')
+            # the node's details and children are the lines indented further than it
+            indent = len(line) - len(line.lstrip())
+            subtree = list(itertools.takewhile(lambda l: len(l) - len(l.lstrip()) > indent, plan[i + 1:]))
+            if node.startswith('Seq Scan'):
+                problems.append(line)
+            elif node.startswith(('Sort', 'Incremental Sort')) and not searching:
+                # sorting a few categories is fine, sorting the products isn't
+                if any('products_product ' in l or 'on products_product' in l for l in subtree):
+                    problems.append(line)
+            elif (node.startswith(('Index Scan', 'Index Only Scan')) and ' on products_product ' in f'{node} '
+                  and not bounded and not any('Index Cond' in l for l in subtree[:3])):
+                problems.append(line)
+        return problems
+
+    def _explain(self, sql):
+        prefix = 'EXPLAIN QUERY PLAN' if connection.vendor == 'sqlite' else 'EXPLAIN'
+        with connection.cursor() as cursor:
+            cursor.execute(f'{prefix} {sql}')
+            return [' '.join(str(col) for col in row) for row in cursor.fetchall()]
+
+    def handle(self, *args, **options):
+        seen = set()
+        problems = 0
+        for params in self._listing_params():
+            for sql in self._capture_queries(params):
+                if sql in seen:
+                    continue
+                seen.add(sql)
+                plan = self._explain(sql)
+                scans = self._plan_problems(sql, plan, 'cursor' in params)
+                if scans:
+                    problems += 1
+                if scans or options['verbose_plans']:
+                    self.stdout.write(self.style.WARNING(f'{params}') if scans else f'{params}')
+                    self.stdout.write(f'  {sql}')
+                    for line in plan:
+                        self.stdout.write(f'    {line}')
+
+        summary = f'Explained {len(seen)} distinct queries, {problems} with full scans or sorts'
+        if problems and options['fail_on_seq_scan']:
+            raise CommandError(summary)
+        self.stdout.write(self.style.SUCCESS(summary) if not problems else summary)
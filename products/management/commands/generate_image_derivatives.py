@@ -0,0 +1,71 @@
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import django
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from products.caching import bump_listing_version
+from products.images import derivative_name, generate_derivatives
+from products.models import Product
+
+
+def _generate(image_name):
+    """
+    Run in a worker process: make the derivatives for one image and return
+    (record, original bytes, bytes of the smallest copy in the best format).
+    Workers only touch the media storage, the database is updated by the parent.
+    """
+    storage = Product._meta.get_field('image').storage
+    record = generate_derivatives(image_name, storage)
+    smallest = derivative_name(image_name, record['widths'][0], record['formats'][0])
+    return record, storage.size(image_name), storage.size(smallest)
+
+
+class Command(BaseCommand):
+    help = (
+        'Generate the thumbnails and webp/avif copies of every product image '
+        'in parallel, skipping products whose copies are already up to date'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                            help='How many processes to resize images with')
+        parser.add_argument('--force', action='store_true',
+                            help='Generate the copies again even if they are up to date')
+
+    def handle(self, *args, **options):
+        products = [
+            product for product in Product.objects.exclude(image='').exclude(image__isnull=True)
+            if options['force'] or product.image_derivatives.get('source') != product.image.name
+        ]
+        if not products:
+            self.stdout.write(self.style.SUCCESS('Every product image is up to date'))
+            return
+
+        # the workers are forked from this process, so don't let them inherit an open connection
+        connections.close_all()
+        original_bytes = smallest_bytes = 0
+        failed = 0
+        with ProcessPoolExecutor(max_workers=options['workers'], initializer=django.setup) as pool:
+            futures = {pool.submit(_generate, product.image.name): product for product in products}
+            for future in as_completed(futures):
+                product = futures[future]
+                try:
+                    product.image_derivatives, original, smallest = future.result()
+                except Exception as e:
+                    failed += 1
+                    self.stderr.write(f'{product.image.name}: {e}')
+                    continue
+                original_bytes += original
+                smallest_bytes += smallest
+
+        done = [product for product in products if product.image_derivatives.get('source')]
+        # one update for the lot, rather than a save (and a reindex) per product
+        Product.objects.bulk_update(done, ['image_derivatives'], batch_size=500)
+        bump_listing_version()
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Generated copies of {len(done)} images ({failed} failed) with {options["workers"]} workers: '
+            f'originals {original_bytes / 1024:.0f} KB, '
+            f'smallest copies {smallest_bytes / 1024:.0f} KB'))
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from products.models import Product
+from products.search import get_search_backend
+
+
+class Command(BaseCommand):
+    help = 'Index every product again from scratch, e.g. after loading the product fixtures'
+
+    def handle(self, *args, **options):
+        backend = get_search_backend()
+        backend.rebuild()
+        self.stdout.write(self.style.SUCCESS(
+            f'Indexed {Product.objects.count()} products with {type(backend).__name__}'))
@@ -0,0 +1,67 @@
+from django.db import migrations
+
+"""
+Create the side table used by the search backend for this database
+(see products/search.py) and fill it with the existing catalogue.
+Other databases keep using the icontains search so nothing is created.
+"""
+
+SQLITE_CREATE = (
+    'CREATE VIRTUAL TABLE IF NOT EXISTS products_product_fts '
+    "USING fts5(name, sku, category, description, tokenize='unicode61')"
+)
+SQLITE_POPULATE = (
+    'INSERT INTO products_product_fts (rowid, name, sku, category, description) '
+    "SELECT p.id, p.name, COALESCE(p.sku, ''), "
+    "COALESCE(c.name, '') || ' ' || COALESCE(c.friendly_name, ''), p.description "
+    'FROM products_product p LEFT JOIN products_category c ON c.id = p.category_id'
+)
+
+POSTGRES_CREATE = (
+    'CREATE TABLE IF NOT EXISTS products_product_search '
+    '(product_id bigint PRIMARY KEY, document tsvector NOT NULL)',
+    'CREATE INDEX IF NOT EXISTS products_product_search_document_gin '
+    'ON products_product_search USING GIN (document)',
+)
+POSTGRES_POPULATE = (
+    'INSERT INTO products_product_search (product_id, document) '
+    "SELECT p.id, setweight(to_tsvector('english', p.name), 'A') || "
+    "setweight(to_tsvector('english', COALESCE(p.sku, '')), 'A') || "
+    "setweight(to_tsvector('english', COALESCE(c.name, '') || ' ' || COALESCE(c.friendly_name, '')), 'B') || "
+    "setweight(to_tsvector('english', p.description), 'C') "
+    'FROM products_product p LEFT JOIN products_category c ON c.id = p.category_id'
+)
+
+
+def create_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        try:
+            schema_editor.execute(SQLITE_CREATE)
+        except Exception:
+            # this SQLite build has no FTS5, the icontains search will be used instead
+            return
+        schema_editor.execute(SQLITE_POPULATE)
+    elif vendor == 'postgresql':
+        for sql in POSTGRES_CREATE:
+            schema_editor.execute(sql)
+        schema_editor.execute(POSTGRES_POPULATE)
+
+
+def drop_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        schema_editor.execute('DROP TABLE IF EXISTS products_product_fts')
+    elif vendor == 'postgresql':
+        schema_editor.execute('DROP TABLE IF EXISTS products_product_search')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0003_product_has_sizes'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 3.2 on 2026-10-18 20:46
+
+import django.db.models.expressions
+import django.db.models.functions.text
+from django.db import migrations, models
+
+"""
+Adding a column on SQLite rebuilds the table, and Django 3.2 can't copy
+the functional (Lower(name)) indexes across when it does, so they are
+dropped before the new column is added and created again afterwards.
+"""
+
+
+def functional_indexes():
+    return [
+        models.Index(django.db.models.functions.text.Lower('name'), django.db.models.expressions.F('id'), name='product_lower_name_idx'),
+        models.Index(django.db.models.expressions.F('category'), django.db.models.functions.text.Lower('name'), name='product_category_name_idx'),
+    ]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0005_catalogue_indexes'),
+    ]
+
+    operations = [
+        *[
+            migrations.RemoveIndex(model_name='product', name=index.name)
+            for index in functional_indexes()
+        ],
+        migrations.AddField(
+            model_name='product',
+            name='image_derivatives',
+            field=models.JSONField(blank=True, default=dict, editable=False),
+        ),
+        *[
+            migrations.AddIndex(model_name='product', index=index)
+            for index in functional_indexes()
+        ],
+    ]
@@ -1,4 +1,7 @@
 from django.db import models
+from django.db.models.functions import Lower
+
+from .images import get_image_sources
 
 # Create your models here.
 
@@ -10,7 +13,8 @@ class Category(models.Model):
     """
     class Meta:
         verbose_name_plural = 'Categories'
-    name = models.CharField(max_length=254)
+    # indexed because the product listing filters categories by name
+    name = models.CharField(max_length=254, db_index=True)
     # makes the name appear more friendly on the front end and is optional.
     # the name field gives us a programmatic way to find it in things
     # like views and other code.
@@ -49,7 +53,29 @@ class Product(models.Model):
     rating = models.DecimalField(max_digits=6, decimal_places=2, null=True, blank=True)
     image_url = models.URLField(max_length=1024, null=True, blank=True)
     image = models.ImageField(null=True, blank=True)
+    # the thumbnails and webp/avif copies made from the image, see products/images.py
+    image_derivatives = models.JSONField(default=dict, blank=True, editable=False)
+
+    class Meta:
+        """
+        Indexes for the sorts the product listing offers.Each sort key is
+        paired with the id because the listing always uses the id as a tie
+        breaker, and the category versions cover sorting within a category filter.
+        Run the explain_listing management command to check the query plans.
+        """
+        indexes = [
+            models.Index(fields=['price', 'id'], name='product_price_idx'),
+            models.Index(fields=['rating', 'id'], name='product_rating_idx'),
+            models.Index(Lower('name'), 'id', name='product_lower_name_idx'),
+            models.Index(fields=['category', 'price'], name='product_category_price_idx'),
+            models.Index(fields=['category', 'rating'], name='product_category_rating_idx'),
+            models.Index('category', Lower('name'), name='product_category_name_idx'),
+        ]
 
     # return product name
     def __str__(self):
         return self.name
+
+    def image_sources(self):
+        """ The srcset urls for the image, used by the product_image include """
+        return get_image_sources(self)
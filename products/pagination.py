@@ -0,0 +1,242 @@
+import hashlib
+import heapq
+import itertools
+
+from django.conf import settings
+from django.core import signing
+from django.core.cache import cache
+from django.core.exceptions import EmptyResultSet, FieldDoesNotExist
+from django.db import connections
+from django.db.models import CharField, F, Q, TextField, Value
+from django.db.models.expressions import Col
+from django.db.models.functions import Lower, Upper
+
+from .caching import get_listing_version
+from .search import is_search
+
+"""
+Keyset (or "seek") pagination for the product listing.
+Rather than using OFFSET, which makes the database walk past every row
+on the earlier pages, each page remembers the sort value and id of its
+last product in a signed cursor.The next page then asks for the products
+that sort after that pair, so page 500 costs the same as page 1.
+"""
+
+CURSOR_SALT = 'products.pagination.cursor'
+
+
+def get_page_size(request):
+    """
+    Use the per_page get parameter if one was given.
+    but never go above the PRODUCTS_MAX_PAGE_SIZE setting.
+    """
+    try:
+        page_size = int(request.GET.get('per_page', settings.PRODUCTS_PER_PAGE))
+    except ValueError:
+        page_size = settings.PRODUCTS_PER_PAGE
+    return max(1, min(page_size, settings.PRODUCTS_MAX_PAGE_SIZE))
+
+
+def encode_cursor(value, pk):
+    """ Sign the sort value and id of the last product on a page """
+    return signing.dumps([None if value is None else str(value), pk], salt=CURSOR_SALT, compress=True)
+
+
+def decode_cursor(cursor):
+    """
+    Return the (value, id) pair stored in a cursor or None if the
+    cursor is missing or has been tampered with, in which case we
+    just start again from the first page.
+    """
+    if not cursor:
+        return None
+    try:
+        value, pk = signing.loads(cursor, salt=CURSOR_SALT)
+        return value, int(pk)
+    except (signing.BadSignature, TypeError, ValueError):
+        return None
+
+
+def keyset_paginate(queryset, sortkey, descending, cursor, page_size, partition=None):
+    """
+    Return a page of products and the cursor for the next page.
+    sortkey is the field (or annotation) the listing is sorted by and the
+    product id is always added as a tie breaker so that the order is total.
+    Products with no value for the sort key (like an unrated product)
+    are always put last whatever the direction.
+    partition is an optional (field, values) pair, like the ids of the
+    categories the listing is filtered to.An index on (category, price)
+    gives each category's products in price order, but not all of them
+    together, so the page is read from each category separately and the
+    pieces are merged.
+    We fetch one extra row to find out whether there is a next page
+    without having to count anything.
+    """
+    queryset = queryset.annotate(cursor_value=F(sortkey))
+    position = decode_cursor(cursor)
+    limit = page_size + 1
+    if sortkey == 'id':
+        # sorting by the id alone, so a simple range on the primary key will do
+        page = _ordered(queryset, descending, by_value=False)
+        if position:
+            page = page.filter(_after_id(descending, position[1]))
+        page = _fetch(page, descending, limit, partition, by_value=False)
+    elif '__' in sortkey and sortkey not in queryset.query.annotations and not is_search(queryset):
+        page = _related_page(queryset, sortkey, descending, position, limit, partition)
+    else:
+        page = _column_page(queryset, sortkey, descending, position, limit, partition)
+
+    next_cursor = None
+    if len(page) > page_size:
+        page = page[:page_size]
+        last = page[-1]
+        next_cursor = encode_cursor(last.cursor_value, last.id)
+    return page, next_cursor
+
+
+def _ordered(queryset, descending, by_value=True):
+    if descending:
+        return queryset.order_by(*(['-cursor_value'] if by_value else []), '-id')
+    return queryset.order_by(*(['cursor_value'] if by_value else []), 'id')
+
+
+def _after_id(descending, pk):
+    return Q(id__lt=pk) if descending else Q(id__gt=pk)
+
+
+def _fetch(products, descending, limit, partition, by_value=True):
+    """ The first limit products, read from each part of the partition and merged if there is one """
+    if partition is None:
+        return list(products[:limit])
+    field, values = partition
+    parts = [list(products.filter(**{field: value})[:limit]) for value in values]
+    key = (lambda product: (product.cursor_value, product.id)) if by_value else (lambda product: product.id)
+    return list(itertools.islice(heapq.merge(*parts, key=key, reverse=descending), limit))
+
+
+def _column_page(queryset, sortkey, descending, position, limit, partition):
+    """
+    A page sorted by a column (or an expression) of the product itself.
+    The products with a value come first, found with a range on the sort
+    key's index, and only once they run out do the products without one
+    follow, in id order (IS NULL is a range on the same index).Keeping
+    the two apart means neither query has an OR in it that would stop
+    the database seeking straight to the cursor.
+    """
+    nullable = _is_nullable(queryset, sortkey)
+    if partition and not _sorts_like_python(queryset):
+        partition = None
+    page = []
+    if position is None or position[0] is not None:
+        products = _ordered(queryset, descending)
+        if nullable:
+            products = products.filter(cursor_value__isnull=False)
+        if position:
+            value, pk = position
+            after_value = Q(cursor_value__lt=value) if descending else Q(cursor_value__gt=value)
+            products = products.filter(after_value | (Q(cursor_value=value) & _after_id(descending, pk)))
+        page = _fetch(products, descending, limit, partition)
+        # if we carry on into the products with no value, it's from the first of them
+        position = None
+    if nullable and len(page) < limit:
+        products = _ordered(queryset.filter(cursor_value__isnull=True), descending, by_value=False)
+        if position:
+            products = products.filter(_after_id(descending, position[1]))
+        page += _fetch(products, descending, limit - len(page), partition, by_value=False)
+    return page
+
+
+def _related_page(queryset, sortkey, descending, position, limit, partition):
+    """
+    A page sorted by a field of a related model, like category__name.
+    No index on the products can give that order, so rather than sorting
+    every product we go through the related rows in order of the field
+    (there are only a few categories) and take each one's products in
+    id order, which the foreign key's index gives us, until the page is
+    full.Products with no related row at all come last.
+    A search would have to match the index again for every related row,
+    so the matches of a search are sorted in one go instead.
+    """
+    relation, field_name = sortkey.split('__', 1)
+    foreign_key = queryset.model._meta.get_field(relation)
+    related = foreign_key.related_model.objects.order_by(
+        *([f'-{field_name}', '-pk'] if descending else [field_name, 'pk']))
+    if position and position[0] is not None:
+        related = related.filter(**{f'{field_name}__{"lte" if descending else "gte"}': position[0]})
+    if partition and partition[0] == foreign_key.attname:
+        # only the related rows the listing is filtered to can have any products
+        related = related.filter(pk__in=partition[1])
+    groups = {}
+    for pk, value in related.values_list('pk', field_name):
+        groups.setdefault(value, []).append(pk)
+
+    page = []
+    if position is None or position[0] is not None:
+        for value, pks in groups.items():
+            products = queryset.filter(**{f'{relation}__in': pks})
+            if position and str(value) == position[0]:
+                products = products.filter(_after_id(descending, position[1]))
+            page += list(_ordered(products, descending, by_value=False)[:limit - len(page)])
+            if len(page) == limit:
+                return page
+        position = None
+    if foreign_key.null:
+        products = _ordered(queryset.filter(**{f'{relation}__isnull': True}), descending, by_value=False)
+        if position:
+            products = products.filter(_after_id(descending, position[1]))
+        page += list(products[:limit - len(page)])
+    return page
+
+
+def _sorts_like_python(queryset):
+    """
+    Whether the pieces of a partitioned page can be merged in Python.Numbers
+    always can, but text only on SQLite, which compares it character by
+    character like Python does, where Postgres uses the locale's collation.
+    """
+    output_field = queryset.query.annotations['cursor_value'].output_field
+    return connections[queryset.db].vendor == 'sqlite' or not isinstance(output_field, (CharField, TextField))
+
+
+def _is_nullable(queryset, sortkey):
+    """
+    Whether the sort key can be empty.Lower('name') of a field that can't
+    be empty can't be either, anything else that isn't a plain field on
+    the model is treated as nullable to be safe, unless it says otherwise.
+    """
+    annotation = queryset.query.annotations.get(sortkey)
+    if annotation is not None:
+        return _expression_is_nullable(annotation)
+    try:
+        return queryset.model._meta.get_field(sortkey).null
+    except FieldDoesNotExist:
+        return True
+
+
+def _expression_is_nullable(expression):
+    if isinstance(expression, Col):
+        return expression.target.null
+    if isinstance(expression, Value):
+        return expression.value is None
+    if isinstance(expression, (Lower, Upper)):
+        return any(_expression_is_nullable(source) for source in expression.get_source_expressions())
+    # like the search rank, which says whether it can be empty
+    return getattr(expression, 'nullable', True)
+
+
+def cached_count(queryset):
+    """
+    Count the products matching the current filters.The count is cached
+    for PRODUCTS_COUNT_CACHE_TIMEOUT seconds using the generated SQL as the
+    key, so paging through the same listing doesn't keep counting the table.
+    The key includes the listing version so a product change resets the counts.
+    A queryset that can't match anything (like a search with no words in it)
+    has no SQL at all, so it's just counted as empty.
+    """
+    try:
+        sql = str(queryset.order_by().query)
+    except EmptyResultSet:
+        return 0
+    digest = hashlib.md5(sql.encode()).hexdigest()
+    key = f'products_count:{get_listing_version()}:{digest}'
+    return cache.get_or_set(key, queryset.count, settings.PRODUCTS_COUNT_CACHE_TIMEOUT)
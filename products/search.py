@@ -0,0 +1,275 @@
+import re
+from functools import lru_cache
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import Expression, FloatField, Q, Value
+from django.db.models.sql.constants import INNER
+from django.utils.module_loading import import_string
+
+"""
+Search backends for the products q parameter.
+Every backend has the same small interface:
+    search(queryset, query) - filter the queryset down to the matching
+        products and annotate them with a search_rank where a lower
+        rank means a better match
+    index_product(product) - add or update a single product in the index
+    remove_product(product_id) - take a deleted product out of the index
+    rebuild() - index the whole catalogue again from scratch
+The indexed backends keep a side table up to date through the signals
+in products/signals.py, so adding, editing or deleting a product from the
+store or the admin updates the index straight away.
+"""
+
+
+def get_search_terms(query):
+    """
+    Split the search query into lower case words, leaving out anything
+    that isn't a letter or number so it can't break the match syntax.
+    """
+    return re.findall(r'\w+', query.lower())
+
+
+def _category_text(product):
+    category = product.category
+    if not category:
+        return ''
+    return f'{category.name} {category.friendly_name or ""}'
+
+
+class SearchResultsJoin:
+    """
+    An INNER JOIN from the products to the search results, a derived table
+    of (product_id, rank) rows from one match against the index:
+        INNER JOIN (SELECT rowid AS product_id, bm25(...) AS rank
+                    FROM products_product_fts WHERE products_product_fts MATCH %s)
+            search_results ON search_results.product_id = products_product.id
+    The index is searched once per query this way.Filtering with id IN (...)
+    and ranking with a subquery per row ran the match again for every
+    matching product, which took seconds for a common word in a big catalogue.
+    The ORM has no way to join to raw SQL so this provides what the query
+    needs from an entry in its alias_map (see django.db.models.sql.datastructures.Join).
+    """
+    table_name = 'search_results'
+    join_type = INNER
+    nullable = False
+    filtered_relation = None
+
+    def __init__(self, sql, params, parent_alias, table_alias=None):
+        self.sql = sql
+        self.params = params
+        self.parent_alias = parent_alias
+        self.table_alias = table_alias
+
+    def as_sql(self, compiler, connection):
+        qn = compiler.quote_name_unless_alias
+        return (
+            f'INNER JOIN ({self.sql}) {qn(self.table_alias)} '
+            f'ON ({qn(self.table_alias)}.{qn("product_id")} = {qn(self.parent_alias)}.{qn("id")})',
+            list(self.params))
+
+    def relabeled_clone(self, change_map):
+        return self.__class__(
+            self.sql, self.params, change_map.get(self.parent_alias, self.parent_alias),
+            change_map.get(self.table_alias, self.table_alias))
+
+    # the results are a filter, so the join is never turned into an outer join
+    def promote(self):
+        return self
+
+    def demote(self):
+        return self
+
+    def _identity(self):
+        return self.sql, tuple(self.params), self.parent_alias
+
+    def __eq__(self, other):
+        return isinstance(other, SearchResultsJoin) and self._identity() == other._identity()
+
+    def __hash__(self):
+        return hash(self._identity())
+
+    def equals(self, other, with_filtered_relation=True):
+        return self == other
+
+
+class SearchRank(Expression):
+    """ The rank column of the joined search results """
+    output_field = FloatField()
+    # it's an inner join, so every product in the results has a rank (see products/pagination.py)
+    nullable = False
+
+    def __init__(self, alias):
+        super().__init__()
+        self.alias = alias
+
+    def as_sql(self, compiler, connection):
+        return f'{compiler.quote_name_unless_alias(self.alias)}.{connection.ops.quote_name("rank")}', []
+
+    def relabeled_clone(self, change_map):
+        return SearchRank(change_map.get(self.alias, self.alias))
+
+
+def is_search(queryset):
+    """ Whether the queryset has been narrowed down to the results of a search """
+    return any(isinstance(join, SearchResultsJoin) for join in queryset.query.alias_map.values())
+
+
+def join_search_results(queryset, sql, params):
+    """
+    Narrow the queryset down to the products in the search results and
+    annotate each one with its search_rank
+    """
+    queryset = queryset.all()
+    query = queryset.query
+    alias = query.join(SearchResultsJoin(sql, params, query.get_initial_alias()))
+    return queryset.annotate(search_rank=SearchRank(alias))
+
+
+class IContainsSearchBackend:
+    """
+    The original search, a case insensitive LIKE over the name and
+    description.It can't use an index but it works on any database,
+    so it's used whenever there is no indexed backend available.
+    """
+    def search(self, queryset, query):
+        queries = Q(name__icontains=query) | Q(description__icontains=query)
+        return queryset.filter(queries).annotate(
+            search_rank=Value(0.0, output_field=FloatField()))
+
+    def index_product(self, product):
+        pass
+
+    def remove_product(self, product_id):
+        pass
+
+    def rebuild(self):
+        pass
+
+
+class SQLiteFTSSearchBackend:
+    """
+    Uses an FTS5 virtual table whose rowid is the product id.
+    Each search word is matched as a prefix and the results are ranked
+    with bm25, weighting matches in the name and sku above the category
+    and the description.
+    """
+    table = 'products_product_fts'
+
+    def _match(self, query):
+        return ' '.join(f'"{term}"*' for term in get_search_terms(query))
+
+    def search(self, queryset, query):
+        match = self._match(query)
+        if not match:
+            return queryset.none().annotate(
+                search_rank=Value(0.0, output_field=FloatField()))
+        table = self.table
+        return join_search_results(
+            queryset,
+            f'SELECT rowid AS product_id, bm25({table}, 10.0, 10.0, 3.0, 1.0) AS rank '
+            f'FROM {table} WHERE {table} MATCH %s',
+            [match])
+
+    def index_product(self, product):
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {self.table} WHERE rowid = %s', [product.pk])
+            cursor.execute(
+                f'INSERT INTO {self.table} (rowid, name, sku, category, description) '
+                'VALUES (%s, %s, %s, %s, %s)',
+                [product.pk, product.name, product.sku or '', _category_text(product),
+                 product.description])
+
+    def remove_product(self, product_id):
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {self.table} WHERE rowid = %s', [product_id])
+
+    def rebuild(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {self.table}')
+            cursor.execute(
+                f'INSERT INTO {self.table} (rowid, name, sku, category, description) '
+                "SELECT p.id, p.name, COALESCE(p.sku, ''), "
+                "COALESCE(c.name, '') || ' ' || COALESCE(c.friendly_name, ''), p.description "
+                'FROM products_product p LEFT JOIN products_category c ON c.id = p.category_id')
+
+
+class PostgresSearchBackend:
+    """
+    Uses a side table holding a weighted tsvector per product with a GIN
+    index on it.Each search word is matched as a prefix and the results
+    are ranked with ts_rank (negated so that a lower rank is better,
+    like the other backends).
+    """
+    table = 'products_product_search'
+    document_sql = (
+        "setweight(to_tsvector('english', %s), 'A') || "
+        "setweight(to_tsvector('english', %s), 'A') || "
+        "setweight(to_tsvector('english', %s), 'B') || "
+        "setweight(to_tsvector('english', %s), 'C')"
+    )
+
+    def _tsquery(self, query):
+        return ' & '.join(f'{term}:*' for term in get_search_terms(query))
+
+    def search(self, queryset, query):
+        tsquery = self._tsquery(query)
+        if not tsquery:
+            return queryset.none().annotate(
+                search_rank=Value(0.0, output_field=FloatField()))
+        return join_search_results(
+            queryset,
+            "SELECT product_id, -ts_rank(document, search_query) AS rank "
+            f"FROM {self.table}, to_tsquery('english', %s) search_query WHERE document @@ search_query",
+            [tsquery])
+
+    def index_product(self, product):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'INSERT INTO {self.table} (product_id, document) '
+                f'VALUES (%s, {self.document_sql}) '
+                'ON CONFLICT (product_id) DO UPDATE SET document = EXCLUDED.document',
+                [product.pk, product.name, product.sku or '', _category_text(product),
+                 product.description])
+
+    def remove_product(self, product_id):
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {self.table} WHERE product_id = %s', [product_id])
+
+    def rebuild(self):
+        document_sql = self.document_sql % (
+            'p.name', "COALESCE(p.sku, '')",
+            "COALESCE(c.name, '') || ' ' || COALESCE(c.friendly_name, '')", 'p.description')
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {self.table}')
+            cursor.execute(
+                f'INSERT INTO {self.table} (product_id, document) '
+                f'SELECT p.id, {document_sql} '
+                'FROM products_product p LEFT JOIN products_category c ON c.id = p.category_id')
+
+
+@lru_cache(maxsize=None)
+def get_search_backend():
+    """
+    Return the search backend named in the PRODUCTS_SEARCH_BACKEND setting.
+    If it isn't set, pick the indexed backend for the database we're
+    connected to, falling back to the original icontains search if the
+    index table hasn't been created (for example SQLite built without FTS5).
+    """
+    backend_path = getattr(settings, 'PRODUCTS_SEARCH_BACKEND', None)
+    if backend_path:
+        return import_string(backend_path)()
+
+    backends = {
+        'sqlite': SQLiteFTSSearchBackend,
+        'postgresql': PostgresSearchBackend,
+    }
+    backend_class = backends.get(connection.vendor)
+    if backend_class and backend_class.table in connection.introspection.table_names():
+        return backend_class()
+    return IContainsSearchBackend()
+
+
+def search_products(queryset, query):
+    """ Filter and rank the products queryset with the current search backend """
+    return get_search_backend().search(queryset, query)
@@ -0,0 +1,76 @@
+"""
+Keep the search index and the listing cache up to date.
+Whenever a product is added, edited or deleted (from the store views,
+the admin or anywhere else) these receivers update its entry in the
+search backend, so searches never need a full rebuild of the index,
+and move the cached product listings on to a new version.
+loaddata (raw) saves are the exception, a fixture would index every
+product one at a time, so the index is rebuilt once, in one statement,
+when the fixture's transaction commits instead.
+"""
+from django.db import connection, transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from .models import Category, Product
+from .search import get_search_backend
+from .caching import bump_listing_version
+
+
+def _rebuild_search_index():
+    get_search_backend().rebuild()
+
+
+def rebuild_search_index_on_commit():
+    """
+    Rebuild the whole index when the current transaction commits, only
+    once however many rows of the fixture ask for it
+    """
+    if not any(func is _rebuild_search_index for savepoints, func in connection.run_on_commit):
+        transaction.on_commit(_rebuild_search_index)
+
+
+@receiver(post_save, sender=Product)
+def index_product_on_save(sender, instance, raw=False, **kwargs):
+    """
+    Add or update the product in the search index
+    """
+    if raw:
+        rebuild_search_index_on_commit()
+        return
+    get_search_backend().index_product(instance)
+
+
+@receiver(post_delete, sender=Product)
+def remove_product_on_delete(sender, instance, **kwargs):
+    """
+    Take the deleted product out of the search index
+    """
+    get_search_backend().remove_product(instance.pk)
+
+
+@receiver(post_save, sender=Category)
+def reindex_category_products(sender, instance, created, raw, **kwargs):
+    """
+    The category names are indexed along with each product,
+    so when a category is renamed its products need indexing again.
+    """
+    if raw:
+        rebuild_search_index_on_commit()
+        return
+    if created:
+        return
+    backend = get_search_backend()
+    for product in Product.objects.filter(category=instance).select_related('category').iterator():
+        backend.index_product(product)
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+def invalidate_product_listings(sender, **kwargs):
+    """
+    Any change to a product or category can change a listing page
+    """
+    bump_listing_version()
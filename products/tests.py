@@ -1,3 +1,332 @@
-from django.test import TestCase
+import os
+import shutil
+import tempfile
+from io import BytesIO, StringIO
 
-# Create your tests here.
+from django.conf import settings
+from django.core.cache import cache, caches
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from django.urls import reverse
+
+from PIL import Image
+
+from .caching import LISTING_VERSION_KEY, bump_listing_version, get_listing_version
+from .forms import ProductForm
+from .management.commands.explain_listing import Command as ExplainListingCommand
+from .models import Category, Product
+from .search import search_products
+
+
+@override_settings(PRODUCTS_PER_PAGE=4)
+class ProductListingPaginationTests(TestCase):
+    """
+    Walking the listing page by page with the cursors should visit
+    every product exactly once, in order, for every sort the template offers.
+    """
+    @classmethod
+    def setUpTestData(cls):
+        categories = [
+            Category.objects.create(name=name, friendly_name=name.title())
+            for name in ('jeans', 'activewear', 'shirts')
+        ]
+        for i in range(11):
+            Product.objects.create(
+                category=categories[i % 3] if i != 5 else None,
+                name=f'{"ab"[i % 2]}Product {i % 4}',
+                description='A product',
+                price=(i % 5) + 1,
+                rating=None if i % 4 == 0 else i,
+            )
+
+    def setUp(self):
+        cache.clear()
+
+    def _walk(self, params, total=11):
+        seen = []
+        url = reverse('products')
+        response = self.client.get(url, params)
+        while True:
+            self.assertEqual(response.context['product_total'], total)
+            seen.extend(p.id for p in response.context['products'])
+            next_page_url = response.context['next_page_url']
+            if not next_page_url:
+                return seen
+            response = self.client.get(next_page_url)
+
+    def test_every_sort_visits_each_product_once(self):
+        for sort in ('price', 'rating', 'name', 'category'):
+            for direction in ('asc', 'desc'):
+                seen = self._walk({'sort': sort, 'direction': direction})
+                self.assertEqual(len(seen), 11, (sort, direction))
+                self.assertEqual(len(set(seen)), 11, (sort, direction))
+
+    def _expected(self, sort, direction, categories=None):
+        """ The ids in listing order, worked out in Python: the products with a value, then those without """
+        products = list(Product.objects.select_related('category'))
+        if categories:
+            products = [p for p in products if p.category and p.category.name in categories]
+        key = {
+            'price': lambda p: p.price,
+            'rating': lambda p: p.rating,
+            'name': lambda p: p.name.lower(),
+            'category': lambda p: p.category.name if p.category else None,
+        }[sort]
+        descending = direction == 'desc'
+        with_value = sorted((p for p in products if key(p) is not None), key=lambda p: (key(p), p.id), reverse=descending)
+        without = sorted((p.id for p in products if key(p) is None), reverse=descending)
+        return [p.id for p in with_value] + without
+
+    def test_pages_follow_the_sort_order(self):
+        for sort in ('price', 'rating', 'name', 'category'):
+            for direction in ('asc', 'desc'):
+                self.assertEqual(self._walk({'sort': sort, 'direction': direction}),
+                                 self._expected(sort, direction), (sort, direction))
+                # the pages of a listing filtered to several categories are merged from each one
+                params = {'sort': sort, 'direction': direction, 'category': 'jeans,shirts'}
+                expected = self._expected(sort, direction, ['jeans', 'shirts'])
+                self.assertEqual(self._walk(params, total=len(expected)), expected, (sort, direction))
+
+    def test_price_descending_order_is_kept_across_pages(self):
+        seen = self._walk({'sort': 'price', 'direction': 'desc'})
+        prices = [Product.objects.get(id=pk).price for pk in seen]
+        self.assertEqual(prices, sorted(prices, reverse=True))
+
+    def test_default_listing_is_in_id_order(self):
+        seen = self._walk({})
+        self.assertEqual(seen, list(Product.objects.order_by('id').values_list('id', flat=True)))
+
+    def test_tampered_cursor_starts_from_first_page(self):
+        response = self.client.get(reverse('products'), {'cursor': 'not-a-cursor'})
+        self.assertEqual(len(response.context['products']), 4)
+
+
+class ProductListingQueryTests(TestCase):
+    """
+    The listing should load the categories along with the products
+    rather than running a query per product card.
+    """
+    def setUp(self):
+        cache.clear()
+        self.category = Category.objects.create(name='jeans', friendly_name='Jeans')
+
+    def _add_products(self, count):
+        for i in range(count):
+            Product.objects.create(category=self.category, name=f'Product {i}',
+                                   description='A product', price=10)
+
+    def test_listing_query_count_does_not_depend_on_product_count(self):
+        self._add_products(2)
+        cache.clear()
+        with self.assertNumQueries(2) as small:
+            response = self.client.get(reverse('products'))
+        self.assertContains(response, 'fa-tag mr-1', count=2)
+
+        self._add_products(10)
+        cache.clear()
+        with self.assertNumQueries(len(small.captured_queries)):
+            response = self.client.get(reverse('products'))
+        self.assertContains(response, 'fa-tag mr-1', count=12)
+
+
+class ExplainListingTests(TestCase):
+    """
+    explain_listing should pass on the listing as it is, and catch
+    the plans that read more of the catalogue than a page needs.
+    """
+    def test_listing_plans_have_no_full_scans_or_sorts(self):
+        category = Category.objects.create(name='jeans', friendly_name='Jeans')
+        for i in range(3):
+            Product.objects.create(category=category, name=f'Shirt {i}',
+                                   description='A shirt', price=10 + i)
+        out = StringIO()
+        call_command('explain_listing', '--fail-on-seq-scan', stdout=out)
+        self.assertIn('0 with full scans or sorts', out.getvalue())
+
+    def test_flags_index_walks_and_sorts(self):
+        command = ExplainListingCommand()
+        sql = 'SELECT "products_product"."id" FROM "products_product" ORDER BY "products_product"."price" ASC LIMIT 5'
+        walk = ['SCAN products_product USING INDEX product_price_idx']
+        self.assertEqual(command._plan_problems(sql, walk, deep=False), [])
+        self.assertEqual(command._plan_problems(sql, walk, deep=True), walk)
+        seek = ['SEARCH products_product USING INDEX product_price_idx (price>?)']
+        self.assertEqual(command._plan_problems(sql, seek, deep=True), [])
+        sort = ['SCAN products_product', 'USE TEMP B-TREE FOR ORDER BY']
+        self.assertEqual(command._plan_problems(sql, sort, deep=False), sort)
+
+    def test_flags_postgres_sorts_and_index_walks(self):
+        command = ExplainListingCommand()
+        # the (rating, id) index can't serve DESC NULLS LAST, so Postgres sorts
+        nulls_last = [
+            'Limit  (cost=0.42..1.31 rows=5 width=100)',
+            '  ->  Incremental Sort  (cost=0.42..880.12 rows=5000 width=100)',
+            '        Sort Key: products_product.rating DESC NULLS LAST, products_product.id DESC',
+            '        ->  Index Scan using product_rating_idx on products_product  (cost=0.29..700.00 rows=5000 width=100)',
+        ]
+        self.assertEqual(command._postgres_problems(nulls_last, searching=False, bounded=True), [nulls_last[1]])
+        walk = [
+            'Limit  (cost=0.29..0.60 rows=5 width=100)',
+            '  ->  Index Scan Backward using product_rating_idx on products_product  (cost=0.29..700.00 rows=5000 width=100)',
+            '        Filter: (rating < 3.5)',
+        ]
+        self.assertEqual(command._postgres_problems(walk, searching=False, bounded=False), [walk[1]])
+        seek = walk[:2] + ['        Index Cond: (rating < 3.5)']
+        self.assertEqual(command._postgres_problems(seek, searching=False, bounded=False), [])
+
+
+class ProductSearchTests(TestCase):
+    """
+    Searches go through the indexed backend, which is kept
+    up to date as products are added, edited and deleted.
+    """
+    def setUp(self):
+        cache.clear()
+        self.jeans = Category.objects.create(name='jeans', friendly_name='Jeans')
+        self.denim = Product.objects.create(
+            category=self.jeans, name='Blue Denim Jacket', sku='pp5001',
+            description='A classic jacket', price=40)
+        self.shirt = Product.objects.create(
+            name='Plain Shirt', description='Goes well with a denim jacket', price=20)
+
+    def _search(self, query):
+        response = self.client.get(reverse('products'), {'q': query})
+        return [p.id for p in response.context['products']]
+
+    def test_prefix_match_ranks_name_above_description(self):
+        self.assertEqual(self._search('deni'), [self.denim.id, self.shirt.id])
+
+    def test_search_matches_sku_and_category(self):
+        self.assertEqual(self._search('pp5001'), [self.denim.id])
+        self.assertEqual(self._search('jeans'), [self.denim.id])
+
+    def test_index_follows_edits_and_deletes(self):
+        self.shirt.name = 'Plain Tee'
+        self.shirt.save()
+        self.assertEqual(self._search('tee'), [self.shirt.id])
+        self.shirt.delete()
+        self.assertEqual(self._search('plain'), [])
+
+    def test_index_follows_category_renames(self):
+        self.jeans.friendly_name = 'Trousers'
+        self.jeans.save()
+        self.assertEqual(self._search('trousers'), [self.denim.id])
+
+    def test_search_without_any_words_is_an_empty_listing(self):
+        for query in ['"', '!!']:
+            response = self.client.get(reverse('products'), {'q': query})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(list(response.context['products']), [])
+            self.assertEqual(response.context['product_total'], 0)
+
+    def test_index_is_matched_once_per_query(self):
+        products = search_products(Product.objects.all(), 'jacket')
+        sql = str(products.order_by().query)
+        self.assertEqual(sql.count(' MATCH ') + sql.count(' @@ '), 1)
+        self.assertEqual(products.count(), 2)
+
+    def test_loaddata_rebuilds_the_index_once(self):
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            call_command('loaddata', 'categories', 'products', verbosity=0)
+        self.assertEqual(len(callbacks), 1)
+        self.assertIn(1, self._search('bootcut'))
+        # the category names from the fixture are indexed with the products
+        self.assertIn(1, self._search('jeans'))
+
+    @override_settings(PRODUCTS_PER_PAGE=1)
+    def test_results_page_in_rank_order(self):
+        response = self.client.get(reverse('products'), {'q': 'deni'})
+        self.assertEqual([p.id for p in response.context['products']], [self.denim.id])
+        response = self.client.get(response.context['next_page_url'])
+        self.assertEqual([p.id for p in response.context['products']], [self.shirt.id])
+        self.assertIsNone(response.context['next_page_url'])
+
+
+class ProductListingCacheTests(TestCase):
+    """
+    Listings are cached per set of parameters until a product changes.
+    """
+    def setUp(self):
+        cache.clear()
+        self.product = Product.objects.create(name='Blue Jacket', description='A jacket', price=40)
+
+    def test_repeat_listing_is_served_from_cache(self):
+        self.client.get(reverse('products'), {'sort': 'price', 'direction': 'asc'})
+        with self.assertNumQueries(0):
+            response = self.client.get(reverse('products'), {'direction': 'asc', 'sort': 'price'})
+        self.assertContains(response, 'Blue Jacket')
+
+    def test_editing_a_product_invalidates_the_listing(self):
+        self.client.get(reverse('products'))
+        self.product.name = 'Red Jacket'
+        self.product.save()
+        response = self.client.get(reverse('products'))
+        self.assertContains(response, 'Red Jacket')
+        self.assertEqual(response.context['product_total'], 1)
+
+    def test_a_change_in_another_worker_invalidates_the_listing(self):
+        self.client.get(reverse('products'))
+        # another worker saves the product: the database and the shared version
+        # change, but not this worker's local cache
+        Product.objects.filter(pk=self.product.pk).update(name='Red Jacket')
+        bump_listing_version()
+        response = self.client.get(reverse('products'))
+        self.assertContains(response, 'Red Jacket')
+
+    def test_a_lost_version_never_goes_back_to_an_old_one(self):
+        version = get_listing_version()
+        caches[settings.PRODUCTS_LISTING_VERSION_CACHE_ALIAS].delete(LISTING_VERSION_KEY)
+        self.assertGreater(get_listing_version(), version)
+
+
+class ProductImageDerivativeTests(TestCase):
+    """
+    Saving an image through the product form makes the smaller copies
+    and the templates offer them to the browser with srcset.
+    """
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+        override = override_settings(MEDIA_ROOT=self.media_root, PRODUCT_IMAGE_WIDTHS=[100, 200, 1000],
+                                     PRODUCT_IMAGE_FORMATS=['webp', 'jpeg'])
+        override.enable()
+        self.addCleanup(override.disable)
+        self.category = Category.objects.create(name='jackets', friendly_name='Jackets')
+
+    def _upload(self, name='jacket.jpg', size=(400, 300)):
+        buffer = BytesIO()
+        Image.new('RGB', size, 'navy').save(buffer, 'JPEG')
+        return SimpleUploadedFile(name, buffer.getvalue(), content_type='image/jpeg')
+
+    def _save_form(self, instance=None, **files):
+        form = ProductForm({
+            'category': self.category.id, 'name': 'Jacket', 'description': 'A jacket', 'price': '40',
+        }, files, instance=instance)
+        self.assertTrue(form.is_valid(), form.errors)
+        return form.save()
+
+    def test_form_save_generates_derivatives(self):
+        product = self._save_form(image=self._upload())
+        product.refresh_from_db()
+        self.assertEqual(product.image_derivatives, {
+            'source': product.image.name, 'widths': [100, 200, 400], 'formats': ['webp', 'jpeg'],
+        })
+        with Image.open(os.path.join(self.media_root, 'derivatives', 'jacket-100w.webp')) as image:
+            self.assertEqual(image.size, (100, 75))
+
+        response = self.client.get(reverse('product_detail', args=[product.id]))
+        self.assertContains(response, 'type="image/webp" srcset="/media/derivatives/jacket-100w.webp 100w, '
+                                      '/media/derivatives/jacket-200w.webp 200w, '
+                                      '/media/derivatives/jacket-400w.webp 400w"')
+        self.assertContains(response, 'src="/media/derivatives/jacket-100w.jpg"')
+
+    def test_saving_without_a_new_image_keeps_the_derivatives(self):
+        product = self._save_form(image=self._upload())
+        derivatives = Product.objects.get(pk=product.pk).image_derivatives
+        product = self._save_form(instance=Product.objects.get(pk=product.pk))
+        self.assertEqual(Product.objects.get(pk=product.pk).image_derivatives, derivatives)
+
+    def test_out_of_date_derivatives_fall_back_to_the_original(self):
+        product = Product.objects.create(name='Jacket', description='A jacket', price=40, image='jacket.jpg',
+                                         image_derivatives={'source': 'old.jpg', 'widths': [100], 'formats': ['jpeg']})
+        self.assertEqual(product.image_sources(), {'sources': [], 'srcset': '', 'src': '/media/jacket.jpg'})
@@ -1,11 +1,15 @@
 from django.shortcuts import render, redirect, reverse, get_object_or_404
+from django.conf import settings
+from django.core.cache import cache
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
-from django.db.models import Q  # generate search query
 from django.db.models.functions import Lower
 
 from .models import Product, Category
 from .forms import ProductForm
+from .pagination import get_page_size, keyset_paginate, cached_count
+from .search import search_products
+from .caching import get_listing_cache_key
 
 # Create your views here.
 
@@ -16,7 +20,9 @@ def all_products(request):
     the context allows us to send things back to the template
     """
     # return all products from database
-    products = Product.objects.all()
+    # select_related fetches each product's category in the same query
+    # so the product cards don't each run their own query for the category name.
+    products = Product.objects.select_related('category')
     # need to make sure what we want to query such as sort is defined in order
     # to return the template properly when we're not using any of the queries
     # and when not remove any errors
@@ -25,6 +31,8 @@ def all_products(request):
     categories = None
     sort = None
     direction = None
+    # with no sorting selected the products are listed in the order they were added.
+    sortkey = 'id'
 
     if request.GET:
         """
@@ -65,13 +73,6 @@ def all_products(request):
 
             if 'direction' in request.GET:
                 direction = request.GET['direction']
-                # check whether the direction is descending in order
-                # to decide whether to reverse the order.
-                if direction == 'desc':
-                    # minus in front of the sort key will reverse the order.
-                    sortkey = f'-{sortkey}'
-            # sort products
-            products = products.order_by(sortkey)
 
         """
         if category exist in request, split it into a list at the commas.
@@ -110,24 +111,71 @@ def all_products(request):
                 return redirect(reverse('products'))
 
             """
-            return results where the query was matched in either
-            the product name or the description.
+            return results where the query was matched in the product
+            name, sku, category or description.The search backend uses
+            the full text index for this database and ranks the results,
+            so unless the user picked a sort order the best matches come first.
             """
-            # The pipe here is what generates the or statement
-            # the i in front of contains makes the queries case insensitive.
-            queries = Q(name__icontains=query) | Q(description__icontains=query)
-            # filter method in order to actually filter the products.
-            products = products.filter(queries)
+            products = search_products(products, query)
+            if not sort:
+                sortkey = 'search_rank'
     # is a string made up of two other variables: sort and direction
     # If neither of these variables is determined, they are set to what
     # they were at the top of the view which is none_none.
     # If there is no sorting.
     current_sorting = f'{sort}_{direction}'
 
+    """
+    Only one page of products is sent to the template.keyset_paginate sorts
+    the products (in reverse if the direction is descending) and uses the
+    cursor in the url to carry on from where the previous page finished.
+    """
+    """
+    The page of products is cached for everyone asking for the same listing
+    and the cache is invalidated whenever a product or category changes.
+    Only the data is cached, the page is still rendered for each user
+    so their bag and any admin links are always their own.
+    """
+    cache_key = get_listing_cache_key('products_listing', request.GET)
+    listing = cache.get(cache_key)
+    if listing is None:
+        # read the page from each selected category on its own, so each one can seek
+        # on its (category, sort key) index, a search ranks all its matches anyway
+        partition = None
+        if categories is not None and query is None:
+            categories = list(categories)
+            partition = ('category_id', [category.id for category in categories])
+        page, next_cursor = keyset_paginate(
+            products, sortkey, direction == 'desc',
+            request.GET.get('cursor'), get_page_size(request), partition)
+        listing = {
+            'products': page,
+            'product_total': cached_count(products),
+            'next_cursor': next_cursor,
+            'current_categories': None if categories is None else list(categories),
+        }
+        cache.set(cache_key, listing, settings.PRODUCTS_LISTING_CACHE_TIMEOUT)
+    next_cursor = listing['next_cursor']
+
+    # keep the current sorting, categories and search term in the page links
+    next_page_url = None
+    if next_cursor:
+        params = request.GET.copy()
+        params['cursor'] = next_cursor
+        next_page_url = f"{reverse('products')}?{params.urlencode()}"
+    first_page_url = None
+    if 'cursor' in request.GET:
+        params = request.GET.copy()
+        del params['cursor']
+        first_page_url = f"{reverse('products')}?{params.urlencode()}"
+
     context = {
-        'products': products,
+        'products': listing['products'],
+        'product_total': listing['product_total'],
+        'next_page_url': next_page_url,
+        'first_page_url': first_page_url,
         'search_term': query,
-        'current_categories': categories,
+        'current_categories': listing['current_categories'],
         'current_sorting': current_sorting,
     }
     return render(request, 'products/products.html', context)
@@ -136,7 +184,7 @@ def all_products(request):
 def product_detail(request, product_id):
     """ A view to show individual product details """
 
-    product = get_object_or_404(Product, pk=product_id)
+    product = get_object_or_404(Product.objects.select_related('category'), pk=product_id)
 
     context = {
         'product': product,
@@ -1,3 +1,50 @@
+from django.contrib.auth.models import User
 from django.test import TestCase
+from django.urls import reverse
 
-# Create your tests here.
+from checkout.models import Order
+from checkout.orders import create_order_from_bag
+from products.models import Product
+
+
+class OrderHistoryTests(TestCase):
+    """
+    The profile page lists a page of orders and the number of queries
+    doesn't depend on how many orders or line items there are.
+    """
+    def setUp(self):
+        self.user = User.objects.create_user('shopper', 'shopper@example.com', 'password')
+        self.products = {
+            str(p.id): p for p in (
+                Product.objects.create(name=f'Product {i}', description='A product', price=5)
+                for i in range(5)
+            )
+        }
+        self.client.force_login(self.user)
+
+    def _add_orders(self, count, lines):
+        bag = {item_id: 1 for item_id in list(self.products)[:lines]}
+        for _ in range(count):
+            create_order_from_bag(Order(
+                user_profile=self.user.userprofile, full_name='A Shopper',
+                email='shopper@example.com', phone_number='123', country='IE',
+                town_or_city='Dublin', street_address1='1 Main Street',
+            ), bag, self.products)
+
+    def test_query_count_does_not_depend_on_line_items(self):
+        self._add_orders(1, 1)
+        # the header bag badge reads the saved cart, one joined query
+        with self.assertNumQueries(7) as small:
+            self.client.get(reverse('profile'))
+
+        self._add_orders(20, 5)
+        with self.assertNumQueries(len(small.captured_queries)):
+            response = self.client.get(reverse('profile'))
+        self.assertEqual(len(response.context['orders']), 10)
+        self.assertContains(response, 'Page 1 of 3')
+
+    def test_orders_are_newest_first(self):
+        self._add_orders(3, 1)
+        response = self.client.get(reverse('profile'))
+        orders = list(response.context['orders'])
+        self.assertEqual(orders, list(Order.objects.order_by('-date', '-id')))
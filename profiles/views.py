@@ -1,11 +1,15 @@
 from django.shortcuts import render, get_object_or_404
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
+from django.core.paginator import Paginator
+from django.conf import settings
+from django.db.models import Prefetch
 
 from .models import UserProfile
 from .forms import UserProfileForm
 
-from checkout.models import Order
+from checkout.models import OrderLineItem
+from checkout.orders import get_order_detail
 
 # only logged in users should have access to this view
 @login_required
@@ -25,8 +29,14 @@ def profile(request):
     """
     use the profile and the related name on the order model.
     To get the users orders and return those to the template
+    newest first, one page at a time.The line items and their products
+    are fetched for the whole page in one extra query, rather than
+    a query per order and another per line item in the template.
     """
-    orders = profile.orders.all()
+    orders = profile.orders.order_by('-date', '-id').prefetch_related(
+        Prefetch('lineitems', queryset=OrderLineItem.objects.select_related('product'))
+    )
+    orders = Paginator(orders, settings.ORDERS_PER_PAGE).get_page(request.GET.get('page'))
 
     template = 'profiles/profile.html'
     context = {
@@ -39,7 +49,7 @@ def profile(request):
 
 
 def order_history(request, order_number):
-    order = get_object_or_404(Order, order_number=order_number)  # retrieve order
+    order = get_order_detail(order_number)  # retrieve order with its line items and products
 
     # message letting the user know they're looking at a past order confirmation.
     messages.info(request, (